@@ -61,11 +61,14 @@ def svm_loss_naive(W, X, y, reg):
   return loss, dW
 
 
-def svm_loss_vectorized(W, X, y, reg):
+def svm_loss_vectorized(W, X, y, reg, block_size=1024):
   """
   Structured SVM loss function, vectorized implementation.
 
-  Inputs and outputs are the same as svm_loss_naive.
+  Inputs and outputs are the same as svm_loss_naive, plus:
+  - block_size: Number of examples scored at a time. The N x C matrices of
+    scores and margins are never built; only block_size rows of them exist
+    at once.
   """
   loss = 0.0
   dW = np.zeros(W.shape) # initialize the gradient as zero
@@ -75,16 +78,29 @@ def svm_loss_vectorized(W, X, y, reg):
   # Implement a vectorized version of the structured SVM loss, storing the    #
   # result in loss.                                                           #
   #############################################################################
-  X_dot_W = X.dot(W)
   num_train = X.shape[0]
-  num_class = W.shape[1]
-  correct_class_scores = X_dot_W[range(num_train), y]
-
-  diff_scores = X_dot_W - np.array([correct_class_scores] * num_class ).transpose()  + 1
-  diff_scores[range(num_train), y] = 0.0
-  margins = np.maximum(0, diff_scores)
-  loss = np.sum(margins)/num_train
+  for start in xrange(0, num_train, block_size):
+    X_block = X[start:start + block_size]
+    y_block = y[start:start + block_size]
+    rows = np.arange(X_block.shape[0])
+
+    # the margins of the block, computed in place over its scores.
+    margins = X_block.dot(W)
+    correct_class_scores = margins[rows, y_block]
+    margins -= correct_class_scores[:, np.newaxis]
+    margins += 1
+    margins[rows, y_block] = 0.0
+    np.maximum(0, margins, out = margins)
+    loss += np.sum(margins)
+
+    # the margins are >= 0, so their sign marks the ones greater than zero.
+    X_margins_fire = np.sign(margins, out = margins)
+    # total number of times margins grater than zero
+    margins_in_correct_class = np.sum(X_margins_fire, axis = 1)
+    X_margins_fire[rows, y_block] = - margins_in_correct_class
+    dW += X_block.transpose().dot(X_margins_fire)
 
+  loss /= num_train
   loss += 0.5 * reg * np.sum(W * W)
   #############################################################################
   #                             END OF YOUR CODE                              #
@@ -100,20 +116,9 @@ def svm_loss_vectorized(W, X, y, reg):
   # to reuse some of the intermediate values that you used to compute the     #
   # loss.                                                                     #
   #############################################################################
-  # import pdb
-  # pdb.set_trace()
-
-   
-  X_margins_fire = np.zeros(margins.shape)
-  X_margins_fire[margins > 0] = 1
-  # total number of times margins grater than zero
-  margins_in_correct_class = np.sum(X_margins_fire, axis = 1)
-  X_margins_fire[range(num_train), y] = - margins_in_correct_class
-
-  gradient_loss = X.transpose().dot(X_margins_fire)
-  gradient_loss /= num_train
-
-  dW = gradient_loss + reg * W
+  # dW is accumulated above along with the loss, one block at a time.
+  dW /= num_train
+  dW += reg * W
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -54,9 +54,7 @@ def softmax_loss_naive(W, X, y, reg):
       factor = yi_minus_pk * X[index]
       dW[:, class_index] += factor
 
-  loss = sum_loss/num_train + 0.5 * reg * np.sum(W * W) 
-
-  loss = -1 * loss
+  loss = -sum_loss/num_train + 0.5 * reg * np.sum(W * W)
 
   dW  = dW/num_train + reg * W
   #############################################################################
@@ -72,11 +70,14 @@ def softmax(z):
   sum_on_rows = np.sum(np.exp(z), axis = 1)
   return np.exp(z)/sum_on_rows[:, np.newaxis]
 
-def softmax_loss_vectorized(W, X, y, reg):
+def softmax_loss_vectorized(W, X, y, reg, block_size=1024):
   """
   Softmax loss function, vectorized version.
 
-  Inputs and outputs are the same as softmax_loss_naive.
+  Inputs and outputs are the same as softmax_loss_naive, plus:
+  - block_size: Number of examples scored at a time. The N x C matrices of
+    scores and probabilities are never built; only block_size rows of them
+    exist at once.
   """
   # Initialize the loss and gradient to zero.
   loss = 0.0
@@ -89,33 +90,32 @@ def softmax_loss_vectorized(W, X, y, reg):
   # regularization!                                                           #
   #############################################################################
   num_train = X.shape[0]
-  num_class = W.shape[1]
-  num_feature = X.shape[1]
-
-  X_dot_W = X.dot(W)
-  # get the max, this is done for numeric instability.
-  X_dot_W_max = np.max(X_dot_W, axis = 1)
-  # subtract the max from each row.
-  X_dot_W_norm = X_dot_W - X_dot_W_max[:, np.newaxis]
-
-  soft_vector = softmax(X_dot_W_norm)
 
-  # get only the values of p(i) which has the correct class. 
-  soft_vector_fired = soft_vector[(range(num_train), y)]
-  sum_loss = np.sum(np.log(soft_vector_fired))
-  loss = sum_loss/num_train + 0.5 * reg * np.sum(W * W) 
-  loss = -1 * loss
-
-  # start of gradient calculation, 
-  # 1. we have to work in dimensions of N * C first.
-  y_rows_matrix = np.zeros((num_train, num_class))
-  y_rows_matrix[(range(num_train), y)] = 1
-
-  pi_rows_matrix = soft_vector
-  diff_yi_pi = pi_rows_matrix  - y_rows_matrix
-
-  yi_pi_xi = X.transpose().dot(diff_yi_pi)
-  dW  = yi_pi_xi/num_train + reg * W
+  sum_loss = 0.0
+  for start in xrange(0, num_train, block_size):
+    X_block = X[start:start + block_size]
+    y_block = y[start:start + block_size]
+    rows = np.arange(X_block.shape[0])
+
+    X_dot_W = X_block.dot(W)
+    # subtract the max from each row, this is done for numeric instability.
+    X_dot_W -= np.max(X_dot_W, axis = 1)[:, np.newaxis]
+    correct_scores = X_dot_W[rows, y_block]
+
+    # turn the scores into p(i) in place.
+    np.exp(X_dot_W, out = X_dot_W)
+    sum_exp = np.sum(X_dot_W, axis = 1)
+    X_dot_W /= sum_exp[:, np.newaxis]
+    # -log p(y(i)) = log(sum_j e^s(j)) - s(y(i)), which stays finite even
+    # when p(y(i)) underflows.
+    sum_loss += np.sum(np.log(sum_exp) - correct_scores)
+
+    # gradient of the block: (p(i) - y(i)) * x(i)
+    X_dot_W[rows, y_block] -= 1
+    dW += X_block.transpose().dot(X_dot_W)
+
+  loss = sum_loss/num_train + 0.5 * reg * np.sum(W * W)
+  dW  = dW/num_train + reg * W
   #############################################################################
   #                          END OF YOUR CODE                                 #
   #############################################################################
@@ -3,6 +3,7 @@ import numpy as np
 from cs231n.layers import *
 from cs231n.fast_layers import *
 from cs231n.layer_utils import *
+from cs231n.mixed_precision import *
 from fc_net import affine_backprop_relu_forward
 from fc_net import affine_back_prop_relu_backward
 
@@ -19,7 +20,7 @@ class ThreeLayerConvNet(object):
   
   def __init__(self, input_dim=(3, 32, 32), num_filters=32, filter_size=7,
                hidden_dim=100, num_classes=10, use_batchnorm=False, weight_scale=1e-3, reg=0.0,
-               dtype=np.float32):
+               dtype=np.float32, layout='NCHW', mixed_precision=False):
     """
     Initialize a new network.
     
@@ -33,11 +34,22 @@ class ThreeLayerConvNet(object):
       of weights.
     - reg: Scalar giving L2 regularization strength
     - dtype: numpy datatype to use for computation.
+    - layout: Memory layout of the conv layer activations, 'NCHW' or 'NHWC'.
+      The input to loss is always (N, C, H, W); with 'NHWC' it is transposed
+      once on entry and the conv, batchnorm and pool layers work channels-last.
+    - mixed_precision: If True, activations, caches and the gradients passed
+      between layers are stored in float16 while every layer computes in
+      float32 (see cs231n/mixed_precision.py). The params stay in dtype,
+      which should then be float32. The upstream gradient is multiplied by
+      self.loss_scale and the parameter gradients are divided by it again.
     """
     self.params = {}
     self.reg = reg
     self.dtype = dtype
     self.use_batchnorm = use_batchnorm
+    self.layout = layout
+    self.mixed_precision = mixed_precision
+    self.loss_scale = 1.0
 
     ############################################################################
     # TODO: Initialize weights and biases for the three-layer convolutional    #
@@ -74,6 +86,7 @@ class ThreeLayerConvNet(object):
     self.bn_params = []
     if self.use_batchnorm:
       self.bn_params = [{'mode': 'train'} for i in xrange(2)]
+      self.bn_params[0]['layout'] = layout
     
 
     ############################################################################
@@ -96,10 +109,18 @@ class ThreeLayerConvNet(object):
     
     # pass conv_param to the forward pass for the convolutional layer
     filter_size = W1.shape[2]
-    conv_param = {'stride': 1, 'pad': (filter_size - 1) / 2}
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) / 2,
+                  'layout': self.layout}
 
     # pass pool_param to the forward pass for the max-pooling layer
-    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2,
+                  'layout': self.layout}
+
+    if self.layout == 'NHWC':
+      X = np.ascontiguousarray(X.transpose(0, 2, 3, 1))
+    if self.mixed_precision:
+      X = X.astype(np.float16)
+    forward, backward = layer_runners(self.mixed_precision)
 
     mode = 'test' if y is None else 'train'
 
@@ -124,15 +145,16 @@ class ThreeLayerConvNet(object):
         beta2 = self.params["beta2"]
         # pdb.set_trace()
 
-        layer1_out, layer1_cache = conv_backprop_relu_pool_forward(X, W1, 
+        layer1_out, layer1_cache = forward(conv_backprop_relu_pool_forward, X, W1, 
             b1, conv_param, pool_param, gamma1, beta1, self.bn_params[0])
-        layer2_out, layer2_cache = affine_backprop_relu_forward(layer1_out, W2, 
+        layer2_out, layer2_cache = forward(affine_backprop_relu_forward, layer1_out, W2, 
             b2, gamma2, beta2, self.bn_params[1])
     else:
-        layer1_out, layer1_cache = conv_relu_pool_forward(X, W1, b1, conv_param, pool_param)
-        layer2_out, layer2_cache = affine_relu_forward(layer1_out, W2, b2)
+        layer1_out, layer1_cache = forward(conv_relu_pool_forward, X, W1, b1, conv_param, pool_param)
+        layer2_out, layer2_cache = forward(affine_relu_forward, layer1_out, W2, b2)
 
-    scores, layer3_cache = affine_forward(layer2_out, W3, b3)
+    scores, layer3_cache = forward(affine_forward, layer2_out, W3, b3)
+    scores = to_float(scores)
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
@@ -156,25 +178,22 @@ class ThreeLayerConvNet(object):
 
     loss += 0.5*self.reg * reg_loss
 
-    dout3, dW3, db3 = affine_backward(dx, layer3_cache)
+    if self.mixed_precision:
+        dx = to_half(dx * self.loss_scale)
+
+    dout3, dW3, db3 = backward(affine_backward, dx, layer3_cache)
 
     if self.use_batchnorm:
-        dout2, dW2, db2, dgamma2, dbeta2 = affine_back_prop_relu_backward(dout3, layer2_cache)
-        dout1, dW1, db1, dgamma1, dbeta1 = conv_backprop_relu_pool_backward(dout2, layer1_cache)
+        dout2, dW2, db2, dgamma2, dbeta2 = backward(affine_back_prop_relu_backward, dout3, layer2_cache)
+        dout1, dW1, db1, dgamma1, dbeta1 = backward(conv_backprop_relu_pool_backward, dout2, layer1_cache)
         grads["gamma2"] = dgamma2
         grads["beta2"] = dbeta2
         grads["gamma1"] = dgamma1
         grads["beta1"] = dbeta1
 
     else:
-        dout2, dW2, db2 = affine_relu_backward(dout3, layer2_cache)
-        dout1, dW1, db1 = conv_relu_pool_backward(dout2, layer1_cache)
-
-
-    # add regulization
-    dW3 += self.reg * self.params["W3"]
-    dW2 += self.reg * self.params["W2"]
-    dW1 += self.reg * self.params["W1"]
+        dout2, dW2, db2 = backward(affine_relu_backward, dout3, layer2_cache)
+        dout1, dW1, db1 = backward(conv_relu_pool_backward, dout2, layer1_cache)
 
     grads["W3"] = dW3
     grads["W2"] = dW2
@@ -182,6 +201,14 @@ class ThreeLayerConvNet(object):
     grads["b3"] = db3
     grads["b2"] = db2
     grads["b1"] = db1
+    if self.mixed_precision:
+        for k in grads:
+            grads[k] /= self.loss_scale
+
+    # add regulization
+    grads["W3"] += self.reg * self.params["W3"]
+    grads["W2"] += self.reg * self.params["W2"]
+    grads["W1"] += self.reg * self.params["W1"]
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
@@ -190,40 +217,20 @@ class ThreeLayerConvNet(object):
   
 
 def conv_backprop_relu_pool_forward(x, W, b, conv_param, pool_param, gamma, beta, bn_param):
-  conv_a, conv_cache = conv_forward_fast(x, W, b, conv_param)
-  # pdb.set_trace()
-  out, spatial_cache = spatial_batchnorm_forward(conv_a, gamma, beta, bn_param)
-  s, relu_cache = relu_forward(out)
-  out, pool_cache = max_pool_forward_fast(s, pool_param)
-  cache = (conv_cache, spatial_cache, relu_cache, pool_cache)
-  return out, cache
-
+  return conv_bn_relu_pool_forward(x, W, b, gamma, beta, conv_param, bn_param,
+                                   pool_param)
 
 
 def conv_backprop_relu_pool_backward(dout, cache):
-  conv_cache, spatial_cache, relu_cache, pool_cache = cache
-  ds = max_pool_backward_fast(dout, pool_cache)
-  da = relu_backward(ds, relu_cache)
-  dsb, dgamma, dbeta = spatial_batchnorm_backward(da, spatial_cache)
-  dx, dw, db = conv_backward_fast(dsb, conv_cache)
-  return dx, dw, db, dgamma, dbeta
+  return conv_bn_relu_pool_backward(dout, cache)
 
 
 def conv_batch_relu_forward(x, W, b, conv_param, gamma, beta, bn_param):
-  conv_a, conv_cache = conv_forward_fast(x, W, b, conv_param)
-  out, spatial_cache = spatial_batchnorm_forward(conv_a, gamma, beta, bn_param)
-  out, relu_cache = relu_forward(out)
-  cache = (conv_cache, spatial_cache, relu_cache)
-  return out, cache
-
+  return conv_bn_relu_forward(x, W, b, gamma, beta, conv_param, bn_param)
 
 
 def conv_batch_relu_backward(dout, cache):
-  conv_cache, spatial_cache, relu_cache = cache
-  da = relu_backward(dout, relu_cache)
-  dsb, dgamma, dbeta = spatial_batchnorm_backward(da, spatial_cache)
-  dx, dw, db = conv_backward_fast(dsb, conv_cache)
-  return dx, dw, db, dgamma, dbeta
+  return conv_bn_relu_backward(dout, cache)
 
 
   
@@ -1,3 +1,5 @@
+import copy
+
 import numpy as np
 
 from cs231n.layers import *
@@ -25,7 +27,8 @@ class DeepLayerConvNets(object):
                conv_layers_filter_size=[7, 7, 3, 3],
                affine_layers_hidden_dim=[100, 100, 100], num_classes=10, use_batchnorm=False, weight_scale=1e-3, reg=0.0,
                debugInit = False,
-               dtype=np.float32):
+               dtype=np.float32, layout='NCHW', checkpoint_every=None,
+               conv_layers_groups=None):
 
     """
     Initialize a new network.
@@ -42,11 +45,26 @@ class DeepLayerConvNets(object):
       of weights.
     - reg: Scalar giving L2 regularization strength
     - dtype: numpy datatype to use for computation.
+    - layout: Memory layout of the conv layer activations, 'NCHW' or 'NHWC'.
+      The input to loss is always (N, C, H, W); with 'NHWC' it is transposed
+      once on entry and the conv, batchnorm and pool layers work channels-last.
+    - checkpoint_every: If not None, the training forward pass keeps only the
+      input of every checkpoint_every-th layer instead of the caches of all
+      layers, and the backward pass recomputes each segment of layers from its
+      stored input just before running it backward. This costs roughly one
+      extra forward pass; setting it near the square root of the number of
+      layers keeps the fewest activations alive.
+    - conv_layers_groups: If not None, a list giving the number of groups of
+      each conv layer (see conv_forward_grouped); a layer whose groups equals
+      its number of input channels is a depthwise convolution. Its filters
+      then have shape (F, C / groups, HH, WW). Only supported with 'NCHW'.
     """
     self.params = {}
     self.reg = reg
     self.dtype = dtype
     self.use_batchnorm = use_batchnorm
+    self.layout = layout
+    self.checkpoint_every = checkpoint_every
 
     ############################################################################
     # TODO: Initialize weights and biases for the multi-layer convolutional    #
@@ -61,10 +79,17 @@ class DeepLayerConvNets(object):
     ############################################################################
     C, H, W = input_dim[0], input_dim[1], input_dim[2]
     # pass pool_param to the forward pass for the max-pooling layer
-    self.pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+    self.pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2,
+                       'layout': layout}
 
     # check if the filter size length equals number of filters per layer.
     assert(len(conv_layers_num_filters) == len(conv_layers_filter_size))
+    if conv_layers_groups is None:
+      conv_layers_groups = [1] * len(conv_layers_filter_size)
+    assert(len(conv_layers_groups) == len(conv_layers_filter_size))
+    if layout != 'NCHW' and max(conv_layers_groups) > 1:
+      raise ValueError('Grouped convolutions need the NCHW layout')
+    self.conv_layers_groups = conv_layers_groups
 
     n_cnn_layer, m_affine_layer = len(conv_layers_filter_size) - 1, len(affine_layers_hidden_dim)
 
@@ -88,7 +113,9 @@ class DeepLayerConvNets(object):
     for index in range(n_cnn_layer):
         c1 = conv_layers_filter_size[index]
         f1 = conv_layers_num_filters[index]
-        self.params["W1-" + str(index + 1)] = weight_scale * np.random.randn(f1, image_dim_depth, c1, c1)
+        g1 = conv_layers_groups[index]
+        assert image_dim_depth % g1 == 0 and f1 % g1 == 0
+        self.params["W1-" + str(index + 1)] = weight_scale * np.random.randn(f1, image_dim_depth / g1, c1, c1)
         self.params["b1-" + str(index + 1)] = np.zeros(f1)
         # conv. batch norm
         if use_batchnorm == True:
@@ -118,7 +145,9 @@ class DeepLayerConvNets(object):
     ############################################################################
     c1 = conv_layers_filter_size[n_cnn_layer]
     f1 = conv_layers_num_filters[n_cnn_layer]
-    self.params["W2"] = weight_scale * np.random.randn(f1, image_dim_depth, c1, c1)
+    g1 = conv_layers_groups[n_cnn_layer]
+    assert image_dim_depth % g1 == 0 and f1 % g1 == 0
+    self.params["W2"] = weight_scale * np.random.randn(f1, image_dim_depth / g1, c1, c1)
     self.params["b2"] = np.zeros(f1)
     # conv. batch norm
     if use_batchnorm == True:
@@ -171,7 +200,8 @@ class DeepLayerConvNets(object):
     self.bn_params = []
     self.bn_params_affine = []
     if self.use_batchnorm:
-      self.bn_params = [{'mode': 'train'} for i in xrange(len(conv_layers_filter_size))]
+      self.bn_params = [{'mode': 'train', 'layout': layout}
+                        for i in xrange(len(conv_layers_filter_size))]
       self.bn_params_affine = [{'mode': 'train'} for i in xrange(len(affine_layers_hidden_dim))]
 
     ############################################################################
@@ -189,85 +219,38 @@ class DeepLayerConvNets(object):
     Input / output: Same API as FullyConnectedNet in fc_net.py.
     """
     
-    pool_param = self.pool_param
     mode = 'test' if y is None else 'train'
 
     import pdb
     # pdb.set_trace()
     if self.use_batchnorm:
       for bn_param in self.bn_params:
-        bn_param[mode] = mode
+        bn_param['mode'] = mode
       for bn_param_affine in self.bn_params_affine:
-        bn_param_affine[mode] = mode
+        bn_param_affine['mode'] = mode
 
 
     scores = None
     ############################################################################
-    # TODO: Implement the forward pass for the Deep convolutional net,         #
-    # computing the class scores for X and storing them in the scores          #
-    # variable.                                                                #
-    ############################################################################
-    cache_cache = {}
-    cache_cache_affine = {}
-    ############################################################################
-    # 1. Forward pass for N -1  Conv. layers.
+    # Forward pass over the N - 1 conv-relu-pool layers, the single conv-relu #
+    # layer and the M affine layers, in that order; see layer_forward.        #
     ############################################################################
+    if self.layout == 'NHWC':
+      X = np.ascontiguousarray(X.transpose(0, 2, 3, 1))
+    layers = self.layer_names()
+    checkpoint = self.checkpoint_every if mode == 'train' else None
+    layer_caches = []
+    checkpoints = []
     out = X
-    for index in range(self.n_cnn_layer):
-        w_b_layer = str(index + 1)
-        w_affine_relu = self.params["W1-" + w_b_layer]
-        b_affine_relu = self.params["b1-" + w_b_layer]
-        # pass conv_param to the forward pass for the convolutional layer
-        # this change depening upon the filter size to keep image size preserved. (F-1)/2
-        filter_size =  w_affine_relu.shape[2]
-        conv_param = {'stride': 1, 'pad': (filter_size - 1) / 2}
-        if self.use_batchnorm:
-            gamma = self.params["gamma1-" + w_b_layer]
-            beta = self.params["beta1-" + w_b_layer]
-            bn_param = self.bn_params[index]
-            out, layer1_cache = conv_backprop_relu_pool_forward(out, w_affine_relu, b_affine_relu, conv_param, 
-                                                                pool_param, gamma, beta, bn_param)
-        else:
-            out, layer1_cache = conv_relu_pool_forward(out, w_affine_relu, b_affine_relu, conv_param, pool_param)
-        cache_cache[w_b_layer] = layer1_cache
-
-    ############################################################################
-    # 2. Forward pass for single Conv. layer.
-    ############################################################################
-    index += 1
-    w_affine_relu = self.params["W2"]
-    b_affine_relu = self.params["b2"]
-    filter_size =  w_affine_relu.shape[2]
-    conv_param = {'stride': 1, 'pad': (filter_size - 1) / 2}
-    if self.use_batchnorm:
-        gamma = self.params["gamma2"]
-        beta = self.params["beta2" ]
-        bn_param = self.bn_params[index]
-        out, layer1_cache = conv_batch_relu_forward(out, w_affine_relu, b_affine_relu, conv_param, 
-                                                    gamma, beta, bn_param)
-    else:
-        out, layer1_cache = conv_relu_forward(out, w_affine_relu, b_affine_relu, conv_param)
-    cache_conv_single_layer = layer1_cache
-
-    ############################################################################
-    # 3. Forward pass for M affline layers.
-    ############################################################################
-    for index in range(self.m_affine_layer):
-        w_b_layer = str(index + 1)
-        # print w_b_layer
-        w_affine_relu = self.params["W3-" + w_b_layer]
-        b_affine_relu = self.params["b3-" + w_b_layer]
-        if self.use_batchnorm:
-            gamma = self.params["gamma3-" + w_b_layer]
-            beta = self.params["beta3-" + w_b_layer]
-            bn_param_affine = self.bn_params_affine[index]
-            af_out, cache = affine_backprop_forward(out, w_affine_relu, b_affine_relu, 
-                                                         gamma, beta, bn_param_affine)
+    for index in range(len(layers)):
+        if checkpoint:
+            if index % checkpoint == 0:
+                checkpoints.append(out)
+            out, _ = self.layer_forward(index, out)
+            layer_caches.append(None)
         else:
-            af_out, cache = affine_forward(out, w_affine_relu, b_affine_relu)
-
-        cache_cache_affine[w_b_layer] = cache
-        out = af_out
+            out, cache = self.layer_forward(index, out)
+            layer_caches.append(cache)
 
     scores = out
     ############################################################################
@@ -287,107 +270,141 @@ class DeepLayerConvNets(object):
     loss, grads = 0, {}
     loss, dout = softmax_loss(scores, y)
     reg_loss = 0.0
-
-
-    # start from the last layer.
-    ############################################################################
-    # 1. backward pass for M affline layers.
-    ############################################################################
     reg = self.reg
-
-    # # get regularized loss.
-    # for index in reversed(range(self.m_affine_layer)):
-    #     w_b_layer = str(index + 1)
-    #     w = self.params["W3-" + w_b_layer]
-    #     reg_loss += (np.sum(w * w))
-
-
-    # run the backpropogation in reverse order for M layers.
-    for index in reversed(range(self.m_affine_layer)):
-        w_b_layer = str(index + 1)
-        cache_cache_all = cache_cache_affine[w_b_layer]
+    bn_params = self.bn_params + self.bn_params_affine
+
+    # run the backpropogation in reverse order over all layers.
+    for index in reversed(range(len(layers))):
+        if layer_caches[index] is None:
+            # recompute the segment ending at this layer from its checkpoint,
+            # on copies of the bn_params so the running averages are only
+            # updated once.
+            segment = index / checkpoint
+            a = checkpoints.pop(segment)
+            for j in range(segment * checkpoint, index + 1):
+                bn_param = copy.deepcopy(bn_params[j]) if self.use_batchnorm else None
+                a, layer_caches[j] = self.layer_forward(j, a, bn_param)
+
+        dout, dW, db, dgamma, dbeta = self.layer_backward(index, dout, layer_caches.pop())
+        w_b_layer = layers[index]
         if self.use_batchnorm:
-            dout, dWH, dBH, dgamma3, dbeta3 = affine_backprop_backward(dout, cache_cache_all)
-            grads["gamma3-" + str(w_b_layer)] = dgamma3
-            grads["beta3-" + str(w_b_layer)] = dbeta3
-        else:
-            dout, dWH, dBH = affine_backward(dout, cache_cache_all)
+            grads["gamma" + w_b_layer] = dgamma
+            grads["beta" + w_b_layer] = dbeta
         # get regulaized loss, update gradients
-        weight_index_str = "W3-" + str(w_b_layer)
-        bias_index_str = "b3-" + str(w_b_layer)
-        w = self.params[weight_index_str]
-        dWH += reg * w  
+        w = self.params["W" + w_b_layer]
         reg_loss += (np.sum(w * w))
-        grads[weight_index_str] = dWH
-        grads[bias_index_str] = dBH
+        dW += reg * w
+        grads["W" + w_b_layer] = dW
+        grads["b" + w_b_layer] = db
+
+    loss += 0.5*reg * reg_loss
 
     ############################################################################
-    # 2. backward pass for Nth Conv batch norm Relu Layer.
+    #                             END OF YOUR CODE                             #
     ############################################################################
-    if self.use_batchnorm:
-        dout, dW2, db2, dgamma2, dbeta2 = conv_batch_relu_backward(dout, cache_conv_single_layer)
-        grads["gamma2"] = dgamma2
-        grads["beta2"] = dbeta2
-    else:
-        dout, dW2, db2 = conv_relu_backward(dout, cache_conv_single_layer)
+    
+    return loss, grads
 
-    w = self.params["W2"]  
-    reg_loss += (np.sum(w * w))
-    dW2 += reg * w
-    grads["W2"] = dW2
-    grads["b2"] = db2
 
+  def layer_names(self):
+    """
+    Suffixes of the parameter names of the layers in forward order: "1-1" to
+    "1-(N-1)" for the conv-relu-pool layers, "2" for the single conv-relu layer
+    and "3-1" to "3-M" for the affine layers.
+    """
+    return (["1-" + str(i + 1) for i in range(self.n_cnn_layer)] + ["2"] +
+            ["3-" + str(i + 1) for i in range(self.m_affine_layer)])
 
-    ############################################################################
-    # 3. backward pass for (N-1) Conv batch norm relu max pool Layer.
-    ############################################################################
-    for index in reversed(range(self.n_cnn_layer)):
-        w_b_layer = str(index + 1)
-        layer1_cache = cache_cache[w_b_layer]     
+
+  def layer_forward(self, index, x, bn_param=None):
+    """
+    Run the layer with the given index in layer_names() forward. bn_param
+    overrides the layer's own entry of self.bn_params / self.bn_params_affine.
+
+    Returns a tuple of:
+    - out: Output from the layer
+    - cache: Object to give to layer_backward
+    """
+    w_b_layer = self.layer_names()[index]
+    w = self.params["W" + w_b_layer]
+    b = self.params["b" + w_b_layer]
+    if self.use_batchnorm:
+        gamma = self.params["gamma" + w_b_layer]
+        beta = self.params["beta" + w_b_layer]
+        if bn_param is None:
+            bn_param = (self.bn_params + self.bn_params_affine)[index]
+
+    if index > self.n_cnn_layer:
         if self.use_batchnorm:
-            dout, dW1, db1, dgamma1, dbeta1 = conv_backprop_relu_pool_backward(dout, layer1_cache)
-            grads["gamma1-" + w_b_layer] = dgamma1
-            grads["beta1-" + w_b_layer] = dbeta1
-        else:
-            dout, dW1, db1 = conv_relu_pool_backward(dout, layer1_cache)
+            return affine_backprop_forward(x, w, b, gamma, beta, bn_param)
+        return affine_forward(x, w, b)
+
+    # pass conv_param to the forward pass for the convolutional layer
+    # this change depening upon the filter size to keep image size preserved. (F-1)/2
+    filter_size = w.shape[2]
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) / 2,
+                  'layout': self.layout,
+                  'groups': self.conv_layers_groups[index]}
+    if index < self.n_cnn_layer:
+        if self.use_batchnorm:
+            return conv_backprop_relu_pool_forward(x, w, b, conv_param, self.pool_param,
+                                                   gamma, beta, bn_param)
+        return conv_relu_pool_forward(x, w, b, conv_param, self.pool_param)
+    if self.use_batchnorm:
+        return conv_batch_relu_forward(x, w, b, conv_param, gamma, beta, bn_param)
+    return conv_relu_forward(x, w, b, conv_param)
 
-        weight_index_str = "W1-" + str(w_b_layer)
-        bias_index_str = "b1-" + str(w_b_layer)
-        w = self.params[weight_index_str]
-        reg_loss += (np.sum(w * w))
-        dW1 += reg * w
-        grads[weight_index_str] = dW1
-        grads[bias_index_str] = db1
-        
 
+  def layer_backward(self, index, dout, cache):
+    """
+    Backward pass for layer_forward. Returns a tuple of
+    (dx, dW, db, dgamma, dbeta); dgamma and dbeta are None without batchnorm.
+    """
+    if index > self.n_cnn_layer:
+        if self.use_batchnorm:
+            return affine_backprop_backward(dout, cache)
+        return affine_backward(dout, cache) + (None, None)
+    if index < self.n_cnn_layer:
+        if self.use_batchnorm:
+            return conv_backprop_relu_pool_backward(dout, cache)
+        return conv_relu_pool_backward(dout, cache) + (None, None)
+    if self.use_batchnorm:
+        return conv_batch_relu_backward(dout, cache)
+    return conv_relu_backward(dout, cache) + (None, None)
 
-    loss += 0.5*reg * reg_loss
 
-    ############################################################################
-    #                             END OF YOUR CODE                             #
-    ############################################################################
-    
-    return loss, grads
+  def freeze(self):
+    """
+    Return an inference-only copy of the network with every batch
+    normalization folded into the conv or affine layer before it using the
+    running statistics (see batchnorm_fold). The copy runs
+    [conv - relu - 2x2 max pool] * (N - 1) - [conv - relu] - [affine] * M and
+    its loss(X) gives the same scores as test mode here. The copy shares no
+    arrays with this network.
+    """
+    model = copy.copy(self)
+    model.params = {}
+    bn_params = self.bn_params + self.bn_params_affine
+    for index, layer in enumerate(self.layer_names()):
+      w, b = self.params["W" + layer], self.params["b" + layer]
+      if self.use_batchnorm:
+        w, b = batchnorm_fold(w, b, self.params["gamma" + layer],
+                              self.params["beta" + layer], bn_params[index])
+      model.params["W" + layer] = w.copy()
+      model.params["b" + layer] = b.copy()
+    model.use_batchnorm = False
+    model.bn_params = []
+    model.bn_params_affine = []
+    return model
   
 
 def conv_backprop_relu_pool_forward(x, W, b, conv_param, pool_param, gamma, beta, bn_param):
-  conv_a, conv_cache = conv_forward_fast(x, W, b, conv_param)
-  # pdb.set_trace()
-  out, spatial_cache = spatial_batchnorm_forward(conv_a, gamma, beta, bn_param)
-  s, relu_cache = relu_forward(out)
-  out, pool_cache = max_pool_forward_fast(s, pool_param)
-  cache = (conv_cache, spatial_cache, relu_cache, pool_cache)
-  return out, cache
-
+  return conv_bn_relu_pool_forward(x, W, b, gamma, beta, conv_param, bn_param,
+                                   pool_param)
 
 
 def conv_backprop_relu_pool_backward(dout, cache):
-  conv_cache, spatial_cache, relu_cache, pool_cache = cache
-  ds = max_pool_backward_fast(dout, pool_cache)
-  da = relu_backward(ds, relu_cache)
-  dsb, dgamma, dbeta = spatial_batchnorm_backward(da, spatial_cache)
-  dx, dw, db = conv_backward_fast(dsb, conv_cache)
-  return dx, dw, db, dgamma, dbeta
+  return conv_bn_relu_pool_backward(dout, cache)
 
 
   
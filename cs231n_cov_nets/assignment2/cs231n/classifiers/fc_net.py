@@ -1,7 +1,10 @@
+import copy
+
 import numpy as np
 
 from cs231n.layers import *
 from cs231n.layer_utils import *
+from cs231n.mixed_precision import *
 
 
 class TwoLayerNet(object):
@@ -149,7 +152,8 @@ class FullyConnectedNet(object):
 
   def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                dropout=0, use_batchnorm=False, reg=0.0,
-               weight_scale=1e-2, dtype=np.float32, seed=None):
+               weight_scale=1e-2, dtype=np.float32, seed=None,
+               mixed_precision=False):
     """
     Initialize a new FullyConnectedNet.
     
@@ -169,8 +173,15 @@ class FullyConnectedNet(object):
     - seed: If not None, then pass this random seed to the dropout layers. This
       will make the dropout layers deteriminstic so we can gradient check the
       model.
+    - mixed_precision: If True, activations, caches and the gradients passed
+      between layers are stored in float16 while every layer computes in
+      float32 (see cs231n/mixed_precision.py). The params stay in dtype,
+      which should then be float32. The upstream gradient is multiplied by
+      self.loss_scale and the parameter gradients are divided by it again.
     """
     self.use_batchnorm = use_batchnorm
+    self.mixed_precision = mixed_precision
+    self.loss_scale = 1.0
     self.use_dropout = dropout > 0
     self.reg = reg
     self.num_layers = 1 + len(hidden_dims)
@@ -239,7 +250,8 @@ class FullyConnectedNet(object):
 
     Input / output: Same as TwoLayerNet above.
     """
-    X = X.astype(self.dtype)
+    X = X.astype(np.float16 if self.mixed_precision else self.dtype)
+    forward, backward = layer_runners(self.mixed_precision)
     mode = 'test' if y is None else 'train'
 
     # Set train/test mode for batchnorm params and dropout param since they
@@ -248,7 +260,7 @@ class FullyConnectedNet(object):
       self.dropout_param['mode'] = mode   
     if self.use_batchnorm:
       for bn_param in self.bn_params:
-        bn_param[mode] = mode
+        bn_param['mode'] = mode
 
     scores = None
     ############################################################################
@@ -278,14 +290,14 @@ class FullyConnectedNet(object):
             gamma = self.params["gamma" + w_b_layer]
             beta = self.params["beta" + w_b_layer]
             bn_param = self.bn_params[index]
-            af_out, cache = affine_backprop_relu_forward(out, w_affine_relu, b_affine_relu, 
-                                                         gamma, beta, bn_param)
+            af_out, cache = forward(affine_backprop_relu_forward, out, w_affine_relu, b_affine_relu, 
+                                    gamma, beta, bn_param)
         else:
-            af_out, cache = affine_relu_forward(out, w_affine_relu, b_affine_relu)
+            af_out, cache = forward(affine_relu_forward, out, w_affine_relu, b_affine_relu)
 
 
         if self.use_dropout:
-            af_out, dpout_cache = dropout_forward(af_out, self.dropout_param)
+            af_out, dpout_cache = forward(dropout_forward, af_out, self.dropout_param)
             cache = (cache, dpout_cache)
 
         cache_cache[w_b_layer] = cache
@@ -293,7 +305,6 @@ class FullyConnectedNet(object):
 
     w_affine = self.params["W" + str(self.num_layers)]
     b_affine = self.params["b" + str(self.num_layers)]
-    scores, affine_cache = affine_forward(out, w_affine, b_affine)
 
     ############################################################################
     #                             END OF YOUR CODE                             #
@@ -301,7 +312,8 @@ class FullyConnectedNet(object):
 
     # If test mode return early
     if mode == 'test':
-      return scores
+      scores, _ = forward(affine_forward, out, w_affine, b_affine)
+      return to_float(scores)
 
     loss, grads = 0.0, {}
     ############################################################################
@@ -317,7 +329,9 @@ class FullyConnectedNet(object):
     # automated tests, make sure that your L2 regularization includes a factor #
     # of 0.5 to simplify the expression for the gradient.                      #
     ############################################################################
-    loss, dx = softmax_loss(scores, y)
+    # the last affine layer is fused with the loss, so the scores are only
+    # ever built a block of rows at a time.
+    loss, dout, dW2, dB2 = affine_softmax_loss(out, w_affine, b_affine, y)
     reg_loss = 0.0
     # start from the last layer.
     for index in reversed(range(self.num_layers)):
@@ -326,14 +340,10 @@ class FullyConnectedNet(object):
 
     loss += 0.5*reg * reg_loss
 
-    # initially, update the weight for the last affine layer.
-    dout, dW2, dB2 = affine_backward(dx, affine_cache)
-    weight_bias_index = self.num_layers 
-    weight_index_str = "W" + str(weight_bias_index)
-    bias_index_str = "b" + str(weight_bias_index)
-    dW2 += reg * self.params[weight_index_str]  
-    grads[weight_index_str] = dW2
-    grads[bias_index_str] = dB2
+    # in mixed precision the float16 gradients are scaled up so they do not
+    # underflow; the parameter gradients are scaled back down below.
+    if self.mixed_precision:
+        dout = to_half(dout * self.loss_scale)
 
     affline_relu_dout = dout
     # run the backpropogation in reverse order for n - 1 layers.
@@ -347,23 +357,38 @@ class FullyConnectedNet(object):
         if self.use_dropout:
             dp_caches = cache_cache[w_b_layer]
             dropout_cache_index = len(dp_caches) - 1
-            affline_relu_dout = dropout_backward(affline_relu_dout, dp_caches[dropout_cache_index])
+            affline_relu_dout = backward(dropout_backward, affline_relu_dout, dp_caches[dropout_cache_index])
             cache_cache_all = dp_caches[0:dropout_cache_index][0]
 
         if self.use_batchnorm:
-            doutH, dWH, dBH, dgamma, dbeta = affine_back_prop_relu_backward(affline_relu_dout, cache_cache_all)
+            doutH, dWH, dBH, dgamma, dbeta = backward(affine_back_prop_relu_backward, affline_relu_dout, cache_cache_all)
             grads["gamma" + str(w_b_layer)] = dgamma
             grads["beta" + str(w_b_layer)] = dbeta
         else:
             # import pdb
             # pdb.set_trace()
 
-            doutH, dWH, dBH = affine_relu_backward(affline_relu_dout, cache_cache_all)
+            doutH, dWH, dBH = backward(affine_relu_backward, affline_relu_dout, cache_cache_all)
         affline_relu_dout = doutH
-        dWH += reg * self.params[weight_index_str]  
         grads[weight_index_str] = dWH
         grads[bias_index_str] = dBH
 
+    if self.mixed_precision:
+        for k in grads:
+            grads[k] /= self.loss_scale
+
+    # the last affine layer's gradients came from the unscaled loss.
+    weight_bias_index = self.num_layers 
+    weight_index_str = "W" + str(weight_bias_index)
+    bias_index_str = "b" + str(weight_bias_index)
+    grads[weight_index_str] = dW2
+    grads[bias_index_str] = dB2
+
+    # add regularization
+    for index in range(self.num_layers):
+        weight_index_str = "W" + str(index + 1)
+        grads[weight_index_str] += reg * self.params[weight_index_str]
+
 
     ############################################################################
     #                             END OF YOUR CODE                             #
@@ -372,10 +397,37 @@ class FullyConnectedNet(object):
     return loss, grads
 
 
+  def freeze(self):
+    """
+    Return an inference-only copy of the network. Each batch normalization is
+    folded into the affine layer before it using the running statistics (see
+    batchnorm_fold) and dropout is dropped, so the copy runs
+    {affine - relu} x (L - 1) - affine and its loss(X) gives the same scores
+    as test mode here. The copy shares no arrays with this network.
+    """
+    model = copy.copy(self)
+    model.params = {}
+    for index in range(self.num_layers):
+      layer = str(index + 1)
+      w, b = self.params["W" + layer], self.params["b" + layer]
+      if self.use_batchnorm and index != self.num_layers - 1:
+        w, b = batchnorm_fold(w, b, self.params["gamma" + layer],
+                              self.params["beta" + layer], self.bn_params[index])
+      model.params["W" + layer] = w.copy()
+      model.params["b" + layer] = b.copy()
+    model.use_batchnorm = False
+    model.use_dropout = False
+    model.dropout_param = {}
+    model.bn_params = []
+    return model
+
+
 def affine_backprop_relu_forward(x, W, b, gamma, beta, bn_param):
   """
   Convenience layer that perorms an affine transform followed by a backprop and ReLU
 
+  The three are fused; see affine_bn_relu_forward.
+
   Inputs:
   - x: Input to the affine layer
   - w, b: Weights for the affine layer
@@ -384,23 +436,14 @@ def affine_backprop_relu_forward(x, W, b, gamma, beta, bn_param):
   - out: Output from the ReLU
   - cache: Object to give to the backward pass
   """
-  a, fc_cache = affine_forward(x, W, b)
-  bn_out, bn_cache = batchnorm_forward(a, gamma, beta, bn_param)
-  relu_out, relu_cache = relu_forward(bn_out)
-
-  cache = (fc_cache, bn_cache, relu_cache)
-  return relu_out, cache
+  return affine_bn_relu_forward(x, W, b, gamma, beta, bn_param)
 
 
 def affine_back_prop_relu_backward(dout, cache):
   """
     Convenience layer that perorms an affine transform followed by a backprop and ReLU
   """
-  (fc_cache, bn_cache, relu_cache) = cache
-  dout_relu = relu_backward(dout, relu_cache)
-  bn_out, dgamma, dbeta = batchnorm_backward(dout_relu, bn_cache)
-  dx, dw, db =  affine_backward(bn_out, fc_cache)
-  return dx, dw, db, dgamma, dbeta
+  return affine_bn_relu_backward(dout, cache)
 
 
 
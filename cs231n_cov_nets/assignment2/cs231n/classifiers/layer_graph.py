@@ -0,0 +1,671 @@
+import numpy as np
+
+from cs231n.layers import *
+from cs231n.fast_layers import *
+from cs231n.layer_utils import *
+from cs231n.mixed_precision import *
+
+
+# The layer types a LayerGraph can be built from. Each maps to the forward and
+# backward functions of the layer, the names of its parameters in the order
+# the functions take and return them, and the names of its configuration
+# dictionaries in the order the forward function takes them.
+layer_types = {}
+
+
+def register_layer_type(name, forward, backward, params=(), configs=()):
+  """
+  Make a layer type available to LayerGraph. forward is called as
+  forward(x, *(params + configs)) and returns (out, cache); backward is
+  called as backward(dout, cache) and returns dx followed by the gradients of
+  the params, or dx alone if the layer has no params.
+
+  A layer with a 'conv_param' config is a convolution and one with a 'W'
+  param but no 'conv_param' is an affine layer; a 'pool_param' config pools
+  the output. LayerGraph infers the shapes of the parameters and outputs
+  from these.
+  """
+  layer_types[name] = (forward, backward, tuple(params), tuple(configs))
+
+
+register_layer_type('affine', affine_forward, affine_backward, ('W', 'b'))
+register_layer_type('affine_relu', affine_relu_forward, affine_relu_backward,
+                    ('W', 'b'))
+register_layer_type('affine_bn_relu', affine_bn_relu_forward,
+                    affine_bn_relu_backward, ('W', 'b', 'gamma', 'beta'),
+                    ('bn_param',))
+register_layer_type('batchnorm', batchnorm_forward, batchnorm_backward,
+                    ('gamma', 'beta'), ('bn_param',))
+register_layer_type('spatial_batchnorm', spatial_batchnorm_forward,
+                    spatial_batchnorm_backward, ('gamma', 'beta'),
+                    ('bn_param',))
+register_layer_type('relu', relu_forward, relu_backward)
+register_layer_type('dropout', dropout_forward, dropout_backward, (),
+                    ('dropout_param',))
+register_layer_type('max_pool', max_pool_forward_fast, max_pool_backward_fast,
+                    (), ('pool_param',))
+register_layer_type('conv', conv_forward_fast, conv_backward_fast, ('W', 'b'),
+                    ('conv_param',))
+register_layer_type('conv_relu', conv_relu_forward, conv_relu_backward,
+                    ('W', 'b'), ('conv_param',))
+register_layer_type('conv_relu_pool', conv_relu_pool_forward,
+                    conv_relu_pool_backward, ('W', 'b'),
+                    ('conv_param', 'pool_param'))
+register_layer_type('conv_bn_relu', conv_bn_relu_forward, conv_bn_relu_backward,
+                    ('W', 'b', 'gamma', 'beta'), ('conv_param', 'bn_param'))
+register_layer_type('conv_bn_relu_pool', conv_bn_relu_pool_forward,
+                    conv_bn_relu_pool_backward, ('W', 'b', 'gamma', 'beta'),
+                    ('conv_param', 'bn_param', 'pool_param'))
+
+
+# Layer types that a trace runs with its own kernels writing into
+# preallocated buffers.
+REPLAY_TYPES = ('affine', 'affine_relu', 'relu')
+
+
+class LayerGraph(object):
+  """
+  A network declared as a list of layers, each of which runs one of the
+  layer functions registered in layer_types, followed by a softmax or SVM
+  loss. For example
+
+  model = LayerGraph([
+      {'type': 'conv_bn_relu_pool', 'num_filters': 32, 'filter_size': 3},
+      {'type': 'affine_bn_relu', 'hidden_dim': 100},
+      {'type': 'dropout', 'dropout_param': {'p': 0.5}},
+      {'type': 'affine', 'hidden_dim': 10},
+    ], input_dim=(3, 32, 32), reg=1e-3)
+
+  is conv - spatial batchnorm - relu - 2x2 max pool - affine - batchnorm -
+  relu - dropout - affine - softmax.
+
+  The output shape of every layer and the shapes of its parameters are
+  inferred once, from input_dim. The parameters of the ith layer (counting
+  from 1) are stored in self.params as 'W<i>', 'b<i>', 'gamma<i>' and
+  'beta<i>', and the model has the params / loss(X, y) interface the Solver
+  expects.
+
+  loss runs a program, a list of steps (the forward pass of each layer, the
+  loss and the backward pass of each layer) built once for training and
+  once for testing. A liveness analysis of each program finds the step that
+  last uses each activation, cache and gradient; the program releases them
+  right after that step, so the memory of a layer's cache is reused as soon
+  as its backward pass has run rather than when loss returns. memory_plan
+  reports how many bytes stay alive at each step.
+
+  If the last layer is 'affine' the training program fuses it with the loss
+  (see affine_softmax_loss), so the full matrix of scores is never built.
+
+  With replay=True the first call to loss for a given mode and input shape
+  traces the program into a list of steps with everything they need bound
+  to them, and later calls with the same shape replay the trace; see
+  build_trace.
+  """
+
+  def __init__(self, layers, input_dim=(3, 32, 32), loss='softmax',
+               weight_scale=1e-3, reg=0.0, dtype=np.float32,
+               mixed_precision=False, replay=False):
+    """
+    Initialize a new network.
+
+    Inputs:
+    - layers: List of dictionaries, one per layer, each with a 'type' key
+      naming a registered layer type and the following as needed:
+      - 'num_filters', 'filter_size': Number and size of the filters of a
+        convolution. The filters are square.
+      - 'hidden_dim': Number of outputs of an affine layer.
+      - 'conv_param', 'pool_param', 'bn_param', 'dropout_param': Entries that
+        override the defaults of the layer's configuration dictionaries: a
+        stride of 1 and padding that preserves the size for convolutions,
+        2x2 pooling with stride 2 and p = 0.5 for dropout.
+    - input_dim: Tuple giving the shape of one input, such as (C, H, W) for
+      images or (D,) for vectors.
+    - loss: 'softmax' or 'svm'.
+    - weight_scale: Scalar giving standard deviation for random initialization
+      of weights.
+    - reg: Scalar giving L2 regularization strength.
+    - dtype: numpy datatype to use for computation.
+    - mixed_precision: If True, the activations, caches and gradients passed
+      between layers are stored in float16 (see cs231n/mixed_precision.py).
+    - replay: If True, trace loss once per mode and input shape and replay
+      the trace on later calls. The scores and gradients loss returns then
+      live in buffers that the next call with the same shape overwrites.
+      Ignored in mixed precision.
+    """
+    if loss not in ('softmax', 'svm'):
+      raise ValueError('Invalid loss "%s"' % loss)
+    self.loss_function = softmax_loss if loss == 'softmax' else svm_loss
+    self.affine_loss_function = (affine_softmax_loss if loss == 'softmax'
+                                 else affine_svm_loss)
+    self.reg = reg
+    self.dtype = dtype
+    self.mixed_precision = mixed_precision
+    self.loss_scale = 1.0
+    self.replay = replay
+    self.traces = {}
+
+    self.params = {}
+    self.layers = []
+    # shapes[i] is the shape of one input to layer i; shapes[-1] is the shape
+    # of the scores of one input.
+    self.shapes = [tuple(input_dim)]
+    for index, spec in enumerate(layers):
+      layer, shape = self.init_layer(index, spec, self.shapes[-1],
+                                     weight_scale)
+      self.layers.append(layer)
+      self.shapes.append(shape)
+
+    # The configuration dictionaries whose 'mode' loss sets on every call.
+    self.mode_params = [config for layer in self.layers
+                        for config in layer['configs']
+                        if 'mode' in config]
+
+    self.programs = {
+      'train': self.build_program('train'),
+      'test': self.build_program('test'),
+    }
+
+    for k, v in self.params.iteritems():
+      self.params[k] = v.astype(dtype)
+
+
+  def init_layer(self, index, spec, in_shape, weight_scale):
+    """
+    Set up layer index from its spec, given the shape of one of its inputs:
+    build its configuration dictionaries and initialize its parameters.
+
+    Returns a tuple of:
+    - layer: Dictionary with the layer's type, forward and backward functions,
+      parameter names and configuration dictionaries
+    - shape: Shape of one output of the layer
+    """
+    kind = spec['type']
+    if kind not in layer_types:
+      raise ValueError('Unrecognized layer type "%s"' % kind)
+    forward, backward, param_keys, config_keys = layer_types[kind]
+
+    shape = in_shape
+    configs = {}
+    if 'conv_param' in config_keys:
+      if len(in_shape) != 3:
+        raise ValueError('Layer %d (%s) needs inputs of shape (C, H, W), got %s'
+                         % (index + 1, kind, in_shape))
+      C, H, W = in_shape
+      F, k = spec['num_filters'], spec['filter_size']
+      conv_param = {'stride': 1, 'pad': (k - 1) / 2}
+      conv_param.update(spec.get('conv_param', {}))
+      groups = conv_groups(conv_param)
+      if C % groups != 0 or F % groups != 0:
+        raise ValueError('Layer %d (%s): %d groups do not divide %d inputs and '
+                         '%d filters' % (index + 1, kind, groups, C, F))
+      stride, pad = conv_param['stride'], conv_param['pad']
+      w_shape = (F, C / groups, k, k)
+      shape = (F, (H + 2 * pad - k) / stride + 1, (W + 2 * pad - k) / stride + 1)
+      configs['conv_param'] = conv_param
+    elif 'W' in param_keys:
+      w_shape = (int(np.prod(in_shape)), spec['hidden_dim'])
+      shape = (spec['hidden_dim'],)
+
+    if 'pool_param' in config_keys:
+      if len(shape) != 3:
+        raise ValueError('Layer %d (%s) needs inputs of shape (C, H, W), got %s'
+                         % (index + 1, kind, shape))
+      pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+      pool_param.update(spec.get('pool_param', {}))
+      C, H, W = shape
+      pad = pool_param.get('pad', 0)
+      stride = pool_param['stride']
+      shape = (C, (H + 2 * pad - pool_param['pool_height']) / stride + 1,
+               (W + 2 * pad - pool_param['pool_width']) / stride + 1)
+      configs['pool_param'] = pool_param
+    if 'bn_param' in config_keys:
+      configs['bn_param'] = dict({'mode': 'train'}, **spec.get('bn_param', {}))
+    if 'dropout_param' in config_keys:
+      configs['dropout_param'] = dict({'mode': 'train', 'p': 0.5},
+                                      **spec.get('dropout_param', {}))
+
+    # the batchnorm scale and shift, like the bias, have one entry per
+    # channel; pooling does not change the number of channels.
+    names = []
+    for key in param_keys:
+      name = key + str(index + 1)
+      if key == 'W':
+        self.params[name] = weight_scale * np.random.randn(*w_shape)
+      elif key == 'gamma':
+        self.params[name] = np.ones(shape[0])
+      else:
+        self.params[name] = np.zeros(shape[0])
+      names.append(name)
+
+    layer = {
+      'type': kind,
+      'forward': forward,
+      'backward': backward,
+      'params': names,
+      'configs': [configs[k] for k in config_keys],
+    }
+    return layer, shape
+
+
+  def build_program(self, mode):
+    """
+    Build the program loss runs in the given mode. Activations, caches and
+    gradients are named ('a', i), ('c', i) and ('g', i): the input to layer
+    i, the cache of layer i and the gradient with respect to ('a', i).
+
+    Returns a list of steps (op, index, release), where op is 'forward',
+    'backward', 'loss' (the loss of the scores ('a', index)) or
+    'affine_loss' (layer index fused with the loss), and release lists the
+    tensors that are dead after the step.
+    """
+    L = len(self.layers)
+    fused = mode == 'train' and self.layers[-1]['type'] == 'affine'
+    num_forward = L - 1 if fused else L
+
+    # (op, index, tensors read, tensors written)
+    steps = []
+    for i in xrange(num_forward):
+      writes = [('a', i + 1)]
+      if mode == 'train':
+        writes.append(('c', i))
+      steps.append(('forward', i, [('a', i)], writes))
+    if mode == 'train':
+      if fused:
+        steps.append(('affine_loss', L - 1, [('a', L - 1)], [('g', L - 1)]))
+      else:
+        steps.append(('loss', L, [('a', L)], [('g', L)]))
+      for i in reversed(xrange(num_forward)):
+        steps.append(('backward', i, [('g', i + 1), ('c', i)], [('g', i)]))
+
+    # Liveness: a tensor dies after the last step that touches it. A tensor
+    # that is written and never read, such as the gradient with respect to
+    # the input, dies right away; the scores returned in test mode never do.
+    last_use = {}
+    for s, (_, _, reads, writes) in enumerate(steps):
+      for t in reads + writes:
+        last_use[t] = s
+    if mode == 'test':
+      del last_use[('a', L)]
+    releases = [[] for _ in steps]
+    for t, s in last_use.iteritems():
+      releases[s].append(t)
+    return [(op, i, release)
+            for (op, i, _, _), release in zip(steps, releases)]
+
+
+  def live_ranges(self, mode):
+    """
+    Return a dictionary mapping each tensor of the program for mode to a
+    list [first, last] of the steps during which its memory is in use. A
+    cache keeps the input of its layer in use.
+    """
+    program = self.programs[mode]
+    ranges = {('a', 0): [0, 0]}
+    for s, (op, i, release) in enumerate(program):
+      if op == 'forward':
+        ranges[('a', i + 1)] = [s, s]
+        if mode == 'train':
+          ranges[('c', i)] = [s, s]
+      else:
+        ranges[('g', i)] = [s, s]
+      for t in release:
+        ranges[t][1] = s
+    if mode == 'test':
+      ranges[('a', len(self.layers))][1] = len(program) - 1
+    for (kind, i), (_, last) in ranges.items():
+      if kind == 'c':
+        ranges[('a', i)][1] = max(ranges[('a', i)][1], last)
+    return ranges
+
+
+  def memory_plan(self, batch_size, mode='train'):
+    """
+    Estimate the memory the activations, caches and gradients of one call to
+    loss take for a minibatch of batch_size inputs, following the liveness
+    of the program. A cache is counted as holding the input of its layer and
+    one more array of the size of its output; fused layers keep their inner
+    activations differently, so this is an estimate.
+
+    Returns a tuple of:
+    - live: List giving the number of bytes alive during each step
+    - peak: Maximum of live
+    """
+    dtype = np.float16 if self.mixed_precision else self.dtype
+    itemsize = np.dtype(dtype).itemsize
+    sizes = [batch_size * int(np.prod(s)) * itemsize for s in self.shapes]
+
+    live = [0] * len(self.programs[mode])
+    for (kind, i), (first, last) in self.live_ranges(mode).iteritems():
+      size = sizes[i + 1] if kind == 'c' else sizes[i]
+      for s in xrange(first, last + 1):
+        live[s] += size
+    return live, max(live)
+
+
+  def build_trace(self, mode, x_shape):
+    """
+    Trace the program for mode on inputs of shape x_shape into a list of
+    steps, each a function of (env, params, y, grads) with its layer
+    functions, slots and buffers bound to it, so that replaying the trace
+    does none of the lookups and dispatch of loss.
+
+    The affine, affine_relu and relu layers and the fused affine loss run
+    replay kernels that compute in the model dtype and write their outputs
+    and gradients into buffers allocated here, once. A tensor whose live
+    range (see live_ranges) has ended hands its buffer on to the next tensor
+    of the same shape, so for instance the gradients passed down a stack of
+    equal affine layers alternate between two buffers. The backward pass of
+    a replayed first layer skips the gradient with respect to the input,
+    which nothing reads. The other layers run their layer functions as
+    loss does.
+
+    Returns a tuple (steps, env, grads, x_buffer, loss_slot, out_slot), where
+    steps is a list of (step, slots released after it).
+    """
+    N = x_shape[0]
+    L = len(self.layers)
+    program = self.programs[mode]
+    ranges = self.live_ranges(mode)
+    # the cache of a replayed layer also refers to the layer's output
+    for (kind, i), (_, last) in ranges.items():
+      if kind == 'c':
+        ranges[('a', i + 1)][1] = max(ranges[('a', i + 1)][1], last)
+    # A layer function may hand back its input as its output (dropout does
+    # in test mode), so across a layer that is not replayed the input stays
+    # in use as long as the output does, and likewise for the gradients.
+    def extend(t, u):
+      if t in ranges and u in ranges:
+        ranges[t][1] = max(ranges[t][1], ranges[u][1])
+    for i in reversed(xrange(L)):
+      if self.layers[i]['type'] not in REPLAY_TYPES:
+        extend(('a', i), ('a', i + 1))
+    for i in xrange(L):
+      if self.layers[i]['type'] not in REPLAY_TYPES:
+        extend(('g', i + 1), ('g', i))
+    # ('a', 0) sorts first, so the input is always in slot 0
+    slots = dict((t, k) for k, t in enumerate(sorted(ranges)))
+    loss_slot = len(slots)
+    env = [None] * (loss_slot + 1)
+
+    free = {}
+    dying = [[] for _ in program]
+    def buffer(t):
+      shape = (N,) + self.shapes[t[1]]
+      pool = free.get(shape)
+      b = pool.pop() if pool else np.empty(shape, dtype=self.dtype)
+      dying[ranges[t][1]].append(b)
+      return b
+
+    x_buffer = buffer(('a', 0))
+    grads = {}
+    outputs = {}
+    steps = []
+    for s, (op, i, release) in enumerate(program):
+      replayed = op != 'loss' and self.layers[i]['type'] in REPLAY_TYPES
+      if op == 'forward':
+        out = buffer(('a', i + 1)) if replayed else None
+        outputs[i] = out
+        step = self.trace_forward(i, slots, out)
+      elif op == 'backward':
+        dx = None
+        if replayed and i > 0:
+          dx = buffer(('g', i))
+        step = self.trace_backward(i, slots, outputs[i], dx, grads,
+                                   replayed and i == 0)
+      elif op == 'loss':
+        step = self.trace_loss(i, slots, loss_slot)
+      else:
+        dx = buffer(('g', i))
+        step = self.trace_affine_loss(i, slots, loss_slot, dx, grads)
+      steps.append((step, [slots[t] for t in release]))
+      for b in dying[s]:
+        free.setdefault(b.shape, []).append(b)
+
+    return (steps, env, grads, x_buffer, loss_slot,
+            slots.get(('a', L)))
+
+
+  def trace_forward(self, i, slots, out):
+    """
+    Return the traced forward step of layer i; out is the buffer of its
+    output if it is replayed and None otherwise.
+    """
+    layer = self.layers[i]
+    names, configs = layer['params'], layer['configs']
+    x_slot, out_slot = slots[('a', i)], slots[('a', i + 1)]
+    c_slot = slots.get(('c', i))
+    dtype = self.dtype
+
+    if out is None:
+      forward = layer['forward']
+      def step(env, params, y, grads):
+        args = [params[k] for k in names] + configs
+        env[out_slot], cache = forward(env[x_slot], *args)
+        if c_slot is not None:
+          env[c_slot] = cache
+      return step
+
+    if layer['type'] == 'relu':
+      def step(env, params, y, grads):
+        np.maximum(env[x_slot], 0, out=out)
+        env[out_slot] = out
+        if c_slot is not None:
+          env[c_slot] = out
+      return step
+
+    w_name, b_name = names
+    relu = layer['type'] == 'affine_relu'
+    def step(env, params, y, grads):
+      x = env[x_slot].astype(dtype, copy=False)
+      np.dot(x.reshape(out.shape[0], -1), params[w_name], out=out)
+      np.add(out, params[b_name], out=out)
+      if relu:
+        np.maximum(out, 0, out=out)
+      env[out_slot] = out
+      if c_slot is not None:
+        env[c_slot] = x
+    return step
+
+
+  def trace_backward(self, i, slots, out, dx, grads, skip_dx):
+    """
+    Return the traced backward step of layer i. out is the buffer of the
+    layer's output and dx the buffer of the gradient with respect to its
+    input, or None if the layer is not replayed; skip_dx is True if the
+    layer is replayed and nothing reads that gradient.
+    """
+    layer = self.layers[i]
+    names = layer['params']
+    dout_slot, c_slot = slots[('g', i + 1)], slots[('c', i)]
+    dx_slot = slots[('g', i)]
+    dtype = self.dtype
+
+    if out is None and not skip_dx:
+      backward = layer['backward']
+      def step(env, params, y, grads):
+        layer_grads = backward(env[dout_slot], env[c_slot])
+        if names:
+          for k, g in zip(names, layer_grads[1:]):
+            grads[k] = g
+          layer_grads = layer_grads[0]
+        env[dx_slot] = layer_grads
+      return step
+
+    relu = layer['type'] != 'affine'
+    if relu:
+      mask = np.empty(out.shape, dtype=np.bool_)
+      da = np.empty(out.shape, dtype=dtype)
+
+    if layer['type'] == 'relu':
+      def step(env, params, y, grads):
+        if skip_dx:
+          return
+        np.greater(out, 0, out=mask)
+        np.multiply(env[dout_slot], mask, out=dx)
+        env[dx_slot] = dx
+      return step
+
+    w_name, b_name = names
+    dw = grads[w_name] = np.empty(self.params[w_name].shape, dtype=dtype)
+    db = grads[b_name] = np.empty(self.params[b_name].shape, dtype=dtype)
+    def step(env, params, y, grads):
+      x = env[c_slot]
+      d = env[dout_slot].astype(dtype, copy=False)
+      if relu:
+        np.greater(out, 0, out=mask)
+        np.multiply(d, mask, out=da)
+        d = da
+      np.dot(x.reshape(d.shape[0], -1).T, d, out=dw)
+      np.sum(d, axis=0, out=db)
+      grads[w_name] = dw
+      grads[b_name] = db
+      if not skip_dx:
+        np.dot(d, params[w_name].T, out=dx.reshape(d.shape[0], -1))
+        env[dx_slot] = dx
+    return step
+
+
+  def trace_loss(self, i, slots, loss_slot):
+    """
+    Return the traced step computing the loss of the scores ('a', i).
+    """
+    scores_slot, dx_slot = slots[('a', i)], slots[('g', i)]
+    loss_function = self.loss_function
+    def step(env, params, y, grads):
+      env[loss_slot], env[dx_slot] = loss_function(env[scores_slot], y)
+    return step
+
+
+  def trace_affine_loss(self, i, slots, loss_slot, dx, grads):
+    """
+    Return the traced step running layer i fused with the loss, writing the
+    gradient with respect to its input into dx.
+    """
+    x_slot, dx_slot = slots[('a', i)], slots[('g', i)]
+    w_name, b_name = self.layers[i]['params']
+    dw = grads[w_name] = np.empty(self.params[w_name].shape, dtype=self.dtype)
+    db = grads[b_name] = np.empty(self.params[b_name].shape, dtype=self.dtype)
+    out = (dx, dw, db)
+    affine_loss_function = self.affine_loss_function
+    dtype = self.dtype
+    def step(env, params, y, grads):
+      x = env[x_slot].astype(dtype, copy=False)
+      env[loss_slot] = affine_loss_function(x, params[w_name], params[b_name],
+                                            y, out=out)[0]
+      env[dx_slot] = dx
+      grads[w_name] = dw
+      grads[b_name] = db
+    return step
+
+
+  def run_trace(self, trace, X, y):
+    """
+    Replay a trace from build_trace. The scores and gradients it returns
+    live in the trace's buffers and are overwritten by the next call with
+    the same mode and input shape.
+    """
+    steps, env, grads, x_buffer, loss_slot, out_slot = trace
+    np.copyto(x_buffer, X)
+    env[0] = x_buffer
+    params = self.params
+    for step, release in steps:
+      step(env, params, y, grads)
+      for k in release:
+        env[k] = None
+    if y is None:
+      scores = env[out_slot]
+      env[out_slot] = None
+      return scores
+
+    loss = env[loss_slot]
+    reg = self.reg
+    if reg != 0:
+      reg_loss = 0.0
+      for layer in self.layers:
+        for name in layer['params']:
+          if name[0] == 'W':
+            w = params[name]
+            reg_loss += np.vdot(w, w)
+            grads[name] += reg * w
+      loss += 0.5 * reg * reg_loss
+    return loss, dict(grads)
+
+
+  def loss(self, X, y=None):
+    """
+    Evaluate loss and gradient for the network.
+
+    Input / output: Same API as FullyConnectedNet in fc_net.py.
+    """
+    mode = 'test' if y is None else 'train'
+    for config in self.mode_params:
+      config['mode'] = mode
+    if self.replay and not self.mixed_precision:
+      key = (mode, X.shape)
+      trace = self.traces.get(key)
+      if trace is None:
+        trace = self.traces[key] = self.build_trace(mode, X.shape)
+      return self.run_trace(trace, X, y)
+
+    X = X.astype(np.float16 if self.mixed_precision else self.dtype)
+    forward, backward = layer_runners(self.mixed_precision)
+
+    loss, grads, loss_grads = 0.0, {}, {}
+    env = {('a', 0): X}
+    for op, i, release in self.programs[mode]:
+      if op == 'forward':
+        layer = self.layers[i]
+        args = [self.params[k] for k in layer['params']] + layer['configs']
+        out, cache = forward(layer['forward'], env[('a', i)], *args)
+        env[('a', i + 1)] = out
+        if mode == 'train':
+          env[('c', i)] = cache
+      elif op == 'backward':
+        layer = self.layers[i]
+        layer_grads = backward(layer['backward'], env[('g', i + 1)],
+                               env[('c', i)])
+        if layer['params']:
+          grads.update(zip(layer['params'], layer_grads[1:]))
+          layer_grads = layer_grads[0]
+        env[('g', i)] = layer_grads
+      elif op == 'loss':
+        loss, dx = self.loss_function(to_float(env[('a', i)]), y)
+        env[('g', i)] = self.scale_gradient(dx)
+      else:
+        w_name, b_name = self.layers[i]['params']
+        loss, dx, dw, db = self.affine_loss_function(
+            env[('a', i)], self.params[w_name], self.params[b_name], y)
+        loss_grads = {w_name: dw, b_name: db}
+        env[('g', i)] = self.scale_gradient(dx)
+      for t in release:
+        del env[t]
+
+    if mode == 'test':
+      return to_float(env[('a', len(self.layers))])
+
+    if self.mixed_precision:
+      for k in grads:
+        grads[k] /= self.loss_scale
+    # the fused layer's gradients came from the unscaled loss
+    grads.update(loss_grads)
+
+    reg_loss = 0.0
+    for layer in self.layers:
+      for name in layer['params']:
+        if name.startswith('W'):
+          w = self.params[name]
+          reg_loss += np.sum(w * w)
+          grads[name] += self.reg * w
+    loss += 0.5 * self.reg * reg_loss
+
+    return loss, grads
+
+
+  def scale_gradient(self, dx):
+    """
+    In mixed precision the float16 gradients are scaled up so they do not
+    underflow; the parameter gradients are scaled back down in loss.
+    """
+    if self.mixed_precision:
+      return to_half(dx * self.loss_scale)
+    return dx
@@ -1,13 +1,22 @@
+import cPickle as pickle
 import numpy as np
+from collections import OrderedDict
+from time import time
 try:
   from cs231n.im2col_cython import col2im_cython, im2col_cython
   from cs231n.im2col_cython import col2im_6d_cython
+  im2col_backend = 'cython'
 except ImportError:
-  print 'run the following from the cs231n directory and try again:'
-  print 'python setup.py build_ext --inplace'
-  print 'You may also need to restart your iPython kernel'
+  # The Cython extension has not been built (python setup.py build_ext
+  # --inplace from the cs231n directory); use the vectorized numpy kernels,
+  # which have the same signatures and output layout.
+  from cs231n.im2col_numpy import im2col_numpy as im2col_cython
+  from cs231n.im2col_numpy import col2im_numpy as col2im_cython
+  from cs231n.im2col_numpy import col2im_6d_numpy as col2im_6d_cython
+  im2col_backend = 'numpy'
 
 from cs231n.im2col import *
+from cs231n.workspace import workspace
 
 
 def conv_forward_im2col(x, w, b, conv_param):
@@ -49,9 +58,8 @@ def conv_forward_strides(x, w, b, conv_param):
   assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
 
   # Pad the input
-  p = pad
-  x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-  
+  x_padded = workspace.pad(x, pad)
+
   # Figure out output dimensions
   H += 2 * pad
   W += 2 * pad
@@ -64,20 +72,29 @@ def conv_forward_strides(x, w, b, conv_param):
   strides = x.itemsize * np.array(strides)
   x_stride = np.lib.stride_tricks.as_strided(x_padded,
                 shape=shape, strides=strides)
-  x_cols = np.ascontiguousarray(x_stride)
-  x_cols.shape = (C * HH * WW, N * out_h * out_w)
+  # Always copy: for some shapes (1x1 filters, stride 1, no padding) the
+  # strided view is already contiguous, and a view of x_padded would be
+  # overwritten once x_padded goes back to the workspace. x_cols is drawn
+  # from the workspace but never given back, since the cache owns it; it
+  # usually reuses the dx_cols buffer of the previous backward pass.
+  x_cols = workspace.get((C * HH * WW, N * out_h * out_w), x.dtype)
+  x_cols.reshape(shape)[...] = x_stride
+  workspace.put(x_padded)
 
   # Now all our convolutions are a big matrix multiply
-  res = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
+  w_cols = w.reshape(F, -1)
+  res = workspace.get((F, N * out_h * out_w), np.result_type(w, x_cols))
+  np.dot(w_cols, x_cols, out=res)
+  res += b.reshape(-1, 1)
 
   # Reshape the output
-  res.shape = (F, N, out_h, out_w)
-  out = res.transpose(1, 0, 2, 3)
+  out = res.reshape(F, N, out_h, out_w).transpose(1, 0, 2, 3)
 
-  # Be nice and return a contiguous array
-  # The old version of conv_forward_fast doesn't do this, so for a fair
-  # comparison we won't either
-  out = np.ascontiguousarray(out)
+  # Be nice and return a contiguous array. This must be a copy: with a single
+  # filter the transpose is already contiguous, and res goes back to the
+  # workspace.
+  out = out.copy()
+  workspace.put(res)
 
   cache = (x, w, b, conv_param, x_cols)
   return out, cache
@@ -93,12 +110,18 @@ def conv_backward_strides(dout, cache):
 
   db = np.sum(dout, axis=(0, 2, 3))
 
-  dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
+  dout_reshaped = workspace.get((F, N * out_h * out_w), dout.dtype)
+  dout_reshaped.reshape(F, N, out_h, out_w)[...] = dout.transpose(1, 0, 2, 3)
   dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
-  dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
-  dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-  dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+  w_cols = w.reshape(F, -1)
+  dx_cols = workspace.get((C * HH * WW, N * out_h * out_w),
+                          np.result_type(w, dout_reshaped))
+  np.dot(w_cols.T, dout_reshaped, out=dx_cols)
+  workspace.put(dout_reshaped)
+  dx = col2im_6d_cython(dx_cols.reshape(C, HH, WW, N, out_h, out_w),
+                        N, C, H, W, HH, WW, pad, stride)
+  workspace.put(dx_cols)
 
   return dx, dw, db
 
@@ -125,31 +148,800 @@ def conv_backward_im2col(dout, cache):
   return dx, dw, db
 
 
-conv_forward_fast = conv_forward_strides
-conv_backward_fast = conv_backward_strides
+# Transforms for Winograd minimal filtering F(2x2, 3x3): each 2x2 output tile
+# is At [(G g G^T) * (Bt d Bt^T)] At^T for a 4x4 input tile d and 3x3 filter
+# g. The elementwise product needs 16 multiplies per tile and input channel
+# where direct convolution needs 36, so the GEMMs do 2.25x fewer flops.
+winograd_Bt = np.array([[1, 0, -1, 0],
+                        [0, 1, 1, 0],
+                        [0, -1, 1, 0],
+                        [0, 1, 0, -1]], dtype=np.float64)
+winograd_G = np.array([[1, 0, 0],
+                       [0.5, 0.5, 0.5],
+                       [0.5, -0.5, 0.5],
+                       [0, 0, 1]], dtype=np.float64)
+winograd_At = np.array([[1, 1, 1, 0],
+                        [0, 1, -1, -1]], dtype=np.float64)
+
+
+def winograd_combine(a, t_row, out=None):
+  """
+  Compute sum_j t_row[j] * a[j], skipping the zero coefficients. The Winograd
+  matrices are mostly zeros and ones, so this is a handful of adds.
+  """
+  for t, a_j in zip(t_row, a):
+    t = float(t)
+    if t == 0:
+      continue
+    if out is None:
+      out = a_j * t
+    elif t == 1:
+      out += a_j
+    elif t == -1:
+      out -= a_j
+    else:
+      out += a_j * t
+  return out
+
+
+def winograd_transform(a, T):
+  """
+  Compute T d T^T for every tile d of a, where the two leading axes of a are
+  the tile axes. Returns an array of shape (m, m) + a.shape[2:] where m is the
+  number of rows of T.
+  """
+  m = T.shape[0]
+  out = np.zeros((m, m) + a.shape[2:], dtype=a.dtype)
+  for i in xrange(m):
+    row = winograd_combine(a, T[i])
+    for l in xrange(m):
+      winograd_combine(row, T[l], out=out[i, l])
+  return out
+
+
+def winograd_supports(x_shape, w_shape, conv_param):
+  """
+  Winograd F(2x2, 3x3) only handles 3x3 filters with stride 1.
+  """
+  return w_shape[2] == w_shape[3] == 3 and conv_param['stride'] == 1
+
+
+def conv_forward_winograd(x, w, b, conv_param):
+  """
+  Forward pass for a 3x3, stride 1 convolutional layer using Winograd minimal
+  filtering F(2x2, 3x3).
+
+  The padded input is cut into overlapping 4x4 tiles with stride 2; each tile
+  and each filter is moved into the Winograd domain, where the convolution
+  becomes 16 independent (F, C) x (C, tiles) matrix multiplies, and the
+  products are transformed back into 2x2 output tiles.
+
+  Inputs / outputs: Same as conv_forward_naive.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  assert HH == WW == 3 and stride == 1, 'Winograd needs 3x3 filters, stride 1'
+
+  out_h = H + 2 * pad - 2
+  out_w = W + 2 * pad - 2
+  tiles_h = (out_h + 1) / 2
+  tiles_w = (out_w + 1) / 2
+  P = N * tiles_h * tiles_w
+
+  # Pad so that the tiles cover the input exactly; the extra zeros on the
+  # bottom and right only feed outputs that are cropped away.
+  x_padded = np.zeros((N, C, 2 * tiles_h + 2, 2 * tiles_w + 2), dtype=x.dtype)
+  x_padded[:, :, pad:pad + H, pad:pad + W] = x
+  _, _, H_p, W_p = x_padded.shape
+
+  # View the tiles as (4, 4, C, N, tiles_h, tiles_w) so that the transformed
+  # tiles come out in the layout the matrix multiplies want.
+  shape = (4, 4, C, N, tiles_h, tiles_w)
+  strides = (W_p, 1, H_p * W_p, C * H_p * W_p, 2 * W_p, 2)
+  strides = x_padded.itemsize * np.array(strides)
+  x_tiles = np.lib.stride_tricks.as_strided(x_padded, shape=shape,
+                                            strides=strides)
+
+  # V[k] is (C, P) and U[k] is (F, C) for each of the 16 Winograd positions k
+  V = winograd_transform(x_tiles, winograd_Bt).reshape(16, C, P)
+  U = winograd_transform(w.transpose(2, 3, 0, 1), winograd_G)
+  U = U.reshape(16, F, C)
+
+  M = np.empty((16, F, P), dtype=V.dtype)
+  for k in xrange(16):
+    np.dot(U[k], V[k], out=M[k])
+
+  Y = winograd_transform(M.reshape(4, 4, F, N, tiles_h, tiles_w), winograd_At)
+  Y = Y.transpose(3, 2, 4, 0, 5, 1).reshape(N, F, 2 * tiles_h, 2 * tiles_w)
+  out = Y[:, :, :out_h, :out_w] + b.reshape(1, -1, 1, 1)
+
+  cache = (x.shape, w, b, conv_param, U, V)
+  return out, cache
+
+
+def conv_backward_winograd(dout, cache):
+  """
+  Backward pass for conv_forward_winograd. Every step of the forward pass is
+  linear, so the gradients run the same transforms transposed.
+
+  Inputs / outputs: Same as conv_backward_naive.
+  """
+  x_shape, w, b, conv_param, U, V = cache
+  N, C, H, W = x_shape
+  F = w.shape[0]
+  pad = conv_param['pad']
+  _, _, out_h, out_w = dout.shape
+  tiles_h = (out_h + 1) / 2
+  tiles_w = (out_w + 1) / 2
+  P = N * tiles_h * tiles_w
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  dY = np.zeros((N, F, 2 * tiles_h, 2 * tiles_w), dtype=dout.dtype)
+  dY[:, :, :out_h, :out_w] = dout
+  dY = dY.reshape(N, F, tiles_h, 2, tiles_w, 2).transpose(3, 5, 1, 0, 2, 4)
+  dM = winograd_transform(dY, winograd_At.T).reshape(16, F, P)
+
+  dU = np.empty((16, F, C), dtype=dM.dtype)
+  dV = np.empty((16, C, P), dtype=dM.dtype)
+  for k in xrange(16):
+    np.dot(dM[k], V[k].T, out=dU[k])
+    np.dot(U[k].T, dM[k], out=dV[k])
+
+  dw = winograd_transform(dU.reshape(4, 4, F, C), winograd_G.T)
+  dw = np.ascontiguousarray(dw.transpose(2, 3, 0, 1))
+
+  dV = dV.reshape(4, 4, C, N, tiles_h, tiles_w)
+  dx_tiles = winograd_transform(dV, winograd_Bt.T)
+
+  # Scatter the overlapping 4x4 tiles back, one tile offset at a time
+  dx_padded = np.zeros((N, C, 2 * tiles_h + 2, 2 * tiles_w + 2),
+                       dtype=dout.dtype)
+  for i in xrange(4):
+    for j in xrange(4):
+      dx_padded[:, :, i:i + 2 * tiles_h:2, j:j + 2 * tiles_w:2] += \
+          dx_tiles[i, j].transpose(1, 0, 2, 3)
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+  return dx, dw, db
+
+
+# Filter spectra computed by conv_forward_fft, so that a layer whose weights
+# have not changed since the last call (for example at test time, or while
+# extracting features) does not transform its filters again. Maps
+# (id(w), stride, fft shape) to (copy of w, spectrum); the copy is compared
+# against the current weights, so in-place updates by the solver invalidate
+# the entry.
+fft_filter_cache = OrderedDict()
+fft_filter_cache_size = 32
+
+
+def fft_polyphase(x, stride):
+  """
+  Split the rows and columns of x of shape (N, C, H, W) into their stride
+  phases and stack the phases along the channel axis. H and W must be
+  multiples of stride. A stride s convolution of x with w is the stride 1
+  convolution of fft_polyphase(x, s) with fft_polyphase(w, s).
+
+  Returns an array of shape (N, C * stride * stride, H / stride, W / stride).
+  """
+  N, C, H, W = x.shape
+  s = stride
+  x = x.reshape(N, C, H / s, s, W / s, s).transpose(0, 1, 3, 5, 2, 4)
+  return x.reshape(N, C * s * s, H / s, W / s)
+
+
+def fft_polyphase_inverse(x, stride):
+  """
+  Inverse of fft_polyphase.
+  """
+  N, C_s, H_s, W_s = x.shape
+  s = stride
+  C = C_s / (s * s)
+  x = x.reshape(N, C, s, s, H_s, W_s).transpose(0, 1, 4, 2, 5, 3)
+  return x.reshape(N, C, H_s * s, W_s * s)
+
+
+def fft_filter_spectrum(w, stride, fft_shape):
+  """
+  Return the 2D real FFT of the polyphase filters of w, zero-padded to
+  fft_shape, as an array of shape (K, C * stride * stride, F) holding one
+  matrix per frequency.
+  """
+  key = (id(w), stride, fft_shape)
+  entry = fft_filter_cache.get(key)
+  if entry is not None and entry[0].shape == w.shape and \
+      np.array_equal(entry[0], w):
+    fft_filter_cache[key] = fft_filter_cache.pop(key)
+    return entry[1]
+
+  F, C, HH, WW = w.shape
+  s = stride
+  w_padded = np.zeros((F, C, -(-HH // s) * s, -(-WW // s) * s), dtype=w.dtype)
+  w_padded[:, :, :HH, :WW] = w
+  w_poly = fft_polyphase(w_padded, s)
+  w_hat = np.fft.rfft2(w_poly, s=fft_shape).reshape(F, C * s * s, -1)
+  w_hat = np.ascontiguousarray(w_hat.transpose(2, 1, 0))
+  w_hat = w_hat.astype(np.result_type(w.dtype, np.complex64), copy=False)
+
+  fft_filter_cache[key] = (w.copy(), w_hat)
+  while len(fft_filter_cache) > fft_filter_cache_size:
+    fft_filter_cache.popitem(last=False)
+  return w_hat
+
+
+def fft_supports(x_shape, w_shape, conv_param):
+  """
+  The FFT path only pays for itself on large filters.
+  """
+  return w_shape[2] >= 5 and w_shape[3] >= 5
+
+
+def conv_forward_fft(x, w, b, conv_param):
+  """
+  Forward pass for a convolutional layer computed in the frequency domain.
+
+  The padded input and the filters are transformed with a 2D real FFT; the
+  convolution over channels then becomes one (N, C) x (C, F) complex matrix
+  multiply per frequency. Unlike im2col this never builds a buffer HH * WW
+  times larger than the input, which is where the savings come from on 5x5
+  and 7x7 filters. Strided convolutions are turned into stride 1 ones by
+  folding the stride phases of the input and filters into the channels (see
+  fft_polyphase), so no work is spent on outputs that would be dropped.
+
+  Inputs / outputs: Same as conv_forward_naive.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+  H_s = -(-(H + 2 * pad) // stride)
+  W_s = -(-(W + 2 * pad) // stride)
+  fft_shape = (H_s, W_s)
+
+  x_padded = np.zeros((N, C, H_s * stride, W_s * stride), dtype=x.dtype)
+  x_padded[:, :, pad:pad + H, pad:pad + W] = x
+  x_poly = fft_polyphase(x_padded, stride)
+  x_hat = np.fft.rfft2(x_poly).reshape(N, x_poly.shape[1], -1)
+  x_hat = x_hat.transpose(2, 0, 1)
+  x_hat = x_hat.astype(np.result_type(x.dtype, np.complex64), copy=False)
+  w_hat = fft_filter_spectrum(w, stride, fft_shape)
+
+  # Correlation is multiplication by the conjugate filter spectrum
+  out_hat = np.matmul(x_hat, w_hat.conj())
+  out_hat = out_hat.transpose(1, 2, 0).reshape(N, F, H_s, -1)
+  out = np.fft.irfft2(out_hat, s=fft_shape)[:, :, :out_h, :out_w]
+  out = (out + b.reshape(1, -1, 1, 1)).astype(x.dtype)
+
+  cache = (x.shape, w, b, conv_param, x_hat, w_hat)
+  return out, cache
+
+
+def conv_backward_fft(dout, cache):
+  """
+  Backward pass for conv_forward_fft. The input gradient is a full
+  convolution of dout with the filters and the weight gradient a correlation
+  of the input with dout; both reuse the spectra saved by the forward pass.
+
+  Inputs / outputs: Same as conv_backward_naive.
+  """
+  x_shape, w, b, conv_param, x_hat, w_hat = cache
+  N, C, H, W = x_shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  _, _, out_h, out_w = dout.shape
+  H_s = -(-(H + 2 * pad) // stride)
+  W_s = -(-(W + 2 * pad) // stride)
+  fft_shape = (H_s, W_s)
+  C_s = C * stride * stride
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  dout_hat = np.fft.rfft2(dout, s=fft_shape).reshape(N, F, -1)
+  dout_hat = dout_hat.transpose(2, 0, 1).astype(x_hat.dtype, copy=False)
+
+  dx_hat = np.matmul(dout_hat, w_hat.transpose(0, 2, 1))
+  dx_hat = dx_hat.transpose(1, 2, 0).reshape(N, C_s, H_s, -1)
+  dx_poly = np.fft.irfft2(dx_hat, s=fft_shape)
+  dx = fft_polyphase_inverse(dx_poly, stride)[:, :, pad:pad + H, pad:pad + W]
+
+  dw_hat = np.matmul(dout_hat.conj().transpose(0, 2, 1), x_hat)
+  dw_hat = dw_hat.transpose(1, 2, 0).reshape(F, C_s, H_s, -1)
+  dw_poly = np.fft.irfft2(dw_hat, s=fft_shape)
+  dw_poly = dw_poly[:, :, :-(-HH // stride), :-(-WW // stride)]
+  dw = fft_polyphase_inverse(dw_poly, stride)[:, :, :HH, :WW]
+
+  dx = dx.astype(dout.dtype)
+  dw = dw.astype(w.dtype)
+  return dx, dw, db
+
+
+def conv_forward_nhwc(x, w, b, conv_param):
+  """
+  Forward pass for a convolutional layer on channels-last (NHWC) data. The
+  im2col matrix has one row per output pixel, so the GEMM writes the output
+  directly in NHWC order and no transpose is needed afterwards.
+
+  Inputs:
+  - x: Input data of shape (N, H, W, C)
+  - w: Filter weights of shape (F, C, HH, WW), the same as for the NCHW layers
+  - b: Biases, of shape (F,)
+  - conv_param: As for conv_forward_naive
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, H', W', F)
+  - cache: (x, w, b, conv_param, x_cols)
+  """
+  N, H, W, C = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  H_p, W_p = H + 2 * pad, W + 2 * pad
+  out_h = (H_p - HH) / stride + 1
+  out_w = (W_p - WW) / stride + 1
+  x_padded = workspace.zeros((N, H_p, W_p, C), x.dtype)
+  x_padded[:, pad:pad + H, pad:pad + W, :] = x
+
+  # Rows are ordered by (n, y, x) and columns by (hh, ww, c)
+  shape = (N, out_h, out_w, HH, WW, C)
+  strides = (H_p * W_p * C, stride * W_p * C, stride * C, W_p * C, C, 1)
+  strides = x.itemsize * np.array(strides)
+  x_stride = np.lib.stride_tricks.as_strided(x_padded, shape=shape,
+                                             strides=strides)
+  x_cols = workspace.get((N * out_h * out_w, HH * WW * C), x.dtype)
+  x_cols.reshape(shape)[...] = x_stride
+  workspace.put(x_padded)
+
+  w_cols = w.transpose(2, 3, 1, 0).reshape(HH * WW * C, F)
+  out = x_cols.dot(w_cols)
+  out += b
+  out.shape = (N, out_h, out_w, F)
+
+  cache = (x, w, b, conv_param, x_cols)
+  return out, cache
+
+
+def conv_backward_nhwc(dout, cache):
+  """
+  Backward pass for conv_forward_nhwc.
+
+  Inputs:
+  - dout: Upstream derivatives, of shape (N, H', W', F)
+  - cache: As returned by conv_forward_nhwc
+
+  Returns a tuple of:
+  - dx: Gradient with respect to x, of shape (N, H, W, C)
+  - dw: Gradient with respect to w, of shape (F, C, HH, WW)
+  - db: Gradient with respect to b
+  """
+  x, w, b, conv_param, x_cols = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+  N, H, W, C = x.shape
+  F, _, HH, WW = w.shape
+  _, out_h, out_w, _ = dout.shape
+
+  dout_cols = dout.reshape(N * out_h * out_w, F)
+  db = np.sum(dout_cols, axis=0)
+  dw = x_cols.T.dot(dout_cols).reshape(HH, WW, C, F)
+  dw = np.ascontiguousarray(dw.transpose(3, 2, 0, 1))
+
+  w_cols = w.transpose(2, 3, 1, 0).reshape(HH * WW * C, F)
+  dx_cols = workspace.get((N * out_h * out_w, HH * WW * C),
+                          np.result_type(w, dout_cols))
+  np.dot(dout_cols, w_cols.T, out=dx_cols)
+  dx_cols_6d = dx_cols.reshape(N, out_h, out_w, HH, WW, C)
+
+  # Scatter each filter offset back with one strided slice-add
+  dx_padded = np.zeros((N, H + 2 * pad, W + 2 * pad, C), dtype=dx_cols.dtype)
+  for hh in xrange(HH):
+    h_end = hh + stride * out_h
+    for ww in xrange(WW):
+      w_end = ww + stride * out_w
+      dx_padded[:, hh:h_end:stride, ww:w_end:stride, :] += \
+          dx_cols_6d[:, :, :, hh, ww, :]
+  workspace.put(dx_cols)
+  dx = dx_padded[:, pad:pad + H, pad:pad + W, :]
+
+  return dx, dw, db
+
+
+def conv_forward_grouped(x, w, b, conv_param):
+  """
+  Forward pass for a grouped convolution. The C input channels and the F
+  filters are split into G = conv_param['groups'] groups, and the filters of
+  group g only see the input channels of group g, which divides the cost of
+  a dense convolution by G.
+
+  The im2col matrix is built once for all channels, as in
+  conv_forward_strides; its rows are ordered by channel, so reshaping it to
+  (G, C / G * HH * WW, N * H' * W') stacks the im2col matrices of the groups,
+  and one batched matmul convolves every group.
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W)
+  - w: Filter weights of shape (F, C / G, HH, WW); filters g * F / G to
+    (g + 1) * F / G - 1 belong to group g
+  - b: Biases, of shape (F,)
+  - conv_param: As for conv_forward_naive, plus 'groups'
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, F, H', W')
+  - cache: (x, w, b, conv_param, x_cols)
+  """
+  N, C, H, W = x.shape
+  F, C_g, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  G = conv_groups(conv_param)
+  assert C == G * C_g, 'input channels do not match groups'
+  assert F % G == 0, 'number of filters must be divisible by groups'
+
+  x_padded = workspace.pad(x, pad)
+  H += 2 * pad
+  W += 2 * pad
+  out_h = (H - HH) / stride + 1
+  out_w = (W - WW) / stride + 1
+
+  shape = (C, HH, WW, N, out_h, out_w)
+  strides = (H * W, W, 1, C * H * W, stride * W, stride)
+  strides = x.itemsize * np.array(strides)
+  x_stride = np.lib.stride_tricks.as_strided(x_padded,
+                shape=shape, strides=strides)
+  x_cols = workspace.get((G, C_g * HH * WW, N * out_h * out_w), x.dtype)
+  x_cols.reshape(shape)[...] = x_stride
+  workspace.put(x_padded)
+
+  w_cols = w.reshape(G, F / G, -1)
+  res = np.matmul(w_cols, x_cols)
+  res += b.reshape(G, F / G, 1)
+
+  out = res.reshape(F, N, out_h, out_w).transpose(1, 0, 2, 3)
+  out = np.ascontiguousarray(out)
+
+  cache = (x, w, b, conv_param, x_cols)
+  return out, cache
+
+
+def conv_backward_grouped(dout, cache):
+  """
+  Backward pass for conv_forward_grouped.
+  """
+  x, w, b, conv_param, x_cols = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+  N, C, H, W = x.shape
+  F, C_g, HH, WW = w.shape
+  _, _, out_h, out_w = dout.shape
+  G = conv_groups(conv_param)
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  dout_reshaped = workspace.get((F, N * out_h * out_w), dout.dtype)
+  dout_reshaped.reshape(F, N, out_h, out_w)[...] = dout.transpose(1, 0, 2, 3)
+  dout_reshaped.shape = (G, F / G, N * out_h * out_w)
+  dw = np.matmul(dout_reshaped, x_cols.transpose(0, 2, 1)).reshape(w.shape)
+
+  w_cols = w.reshape(G, F / G, -1)
+  dx_cols = workspace.get((G, C_g * HH * WW, N * out_h * out_w),
+                          np.result_type(w, dout_reshaped))
+  np.matmul(w_cols.transpose(0, 2, 1), dout_reshaped, out=dx_cols)
+  dout_reshaped.shape = (F, N * out_h * out_w)
+  workspace.put(dout_reshaped)
+  dx = col2im_6d_cython(dx_cols.reshape(C, HH, WW, N, out_h, out_w),
+                        N, C, H, W, HH, WW, pad, stride)
+  workspace.put(dx_cols)
+
+  return dx, dw, db
+
+
+def conv_forward_depthwise(x, w, b, conv_param):
+  """
+  Forward pass for a depthwise convolution: a grouped convolution with one
+  input channel per group, where each of the C channels is convolved with
+  its own M = F / C filters. Each filter has only HH * WW taps, too few for
+  a GEMM to pay off, so the output is accumulated directly: one
+  multiply-add over the whole batch per filter tap.
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W)
+  - w: Filter weights of shape (F, 1, HH, WW); filters c * M to
+    (c + 1) * M - 1 read channel c
+  - b: Biases, of shape (F,)
+  - conv_param: As for conv_forward_grouped, with 'groups' equal to C
+
+  Returns a tuple of:
+  - out: Output data, of shape (N, F, H', W')
+  - cache: (x_padded, w, b, conv_param, x_shape)
+  """
+  N, C, H, W = x.shape
+  F, C_g, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  assert C_g == 1 and conv_groups(conv_param) == C, 'not a depthwise conv'
+  assert F % C == 0, 'number of filters must be divisible by channels'
+  M = F / C
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+
+  # The padded input is kept in the cache, so it is not taken from the pool
+  x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad), dtype=x.dtype)
+  x_padded[:, :, pad:pad + H, pad:pad + W] = x
+  w_taps = w.reshape(C, M, 1, 1, HH, WW)
+  out = np.empty((N, C, M, out_h, out_w), dtype=np.result_type(x, w))
+  out[...] = b.reshape(C, M, 1, 1)
+  tmp = workspace.get(out.shape, out.dtype)
+  for hh in xrange(HH):
+    h_end = hh + stride * out_h
+    for ww in xrange(WW):
+      w_end = ww + stride * out_w
+      x_tap = x_padded[:, :, None, hh:h_end:stride, ww:w_end:stride]
+      np.multiply(x_tap, w_taps[..., hh, ww], out=tmp)
+      out += tmp
+  workspace.put(tmp)
+  out.shape = (N, F, out_h, out_w)
+
+  cache = (x_padded, w, b, conv_param, x.shape)
+  return out, cache
+
+
+def conv_backward_depthwise(dout, cache):
+  """
+  Backward pass for conv_forward_depthwise.
+  """
+  x_padded, w, b, conv_param, x_shape = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+  N, C, H, W = x_shape
+  F, _, HH, WW = w.shape
+  _, _, out_h, out_w = dout.shape
+  M = F / C
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  dout_taps = dout.reshape(N, C, M, out_h, out_w)
+  w_taps = w.reshape(C, M, HH, WW)
+  dw = np.empty((C, M, HH, WW), dtype=w.dtype)
+  dx_padded = np.zeros(x_padded.shape, dtype=np.result_type(dout, w))
+  for hh in xrange(HH):
+    h_end = hh + stride * out_h
+    for ww in xrange(WW):
+      w_end = ww + stride * out_w
+      x_tap = x_padded[:, :, hh:h_end:stride, ww:w_end:stride]
+      dw[:, :, hh, ww] = np.einsum('ncmyx,ncyx->cm', dout_taps, x_tap)
+      dx_padded[:, :, hh:h_end:stride, ww:w_end:stride] += \
+          np.einsum('ncmyx,cm->ncyx', dout_taps, w_taps[:, :, hh, ww])
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+  return dx, dw.reshape(w.shape), db
+
+
+def conv_layout(param):
+  """
+  The memory layout of the activations of a layer: 'NCHW' (the default) or
+  'NHWC', as given by the 'layout' key of its conv_param, pool_param or
+  bn_param.
+  """
+  layout = param.get('layout', 'NCHW')
+  if layout not in ('NCHW', 'NHWC'):
+    raise ValueError('Unrecognized layout "%s"' % layout)
+  return layout
+
+
+def conv_groups(conv_param):
+  """
+  The number of groups of a convolution, given by the 'groups' key of its
+  conv_param; 1 (the default) is a dense convolution.
+  """
+  groups = conv_param.get('groups', 1)
+  if groups < 1:
+    raise ValueError('groups must be positive, got %d' % groups)
+  return groups
+
+
+def conv_is_depthwise(x_shape, w_shape, conv_param):
+  """
+  Whether every group of the convolution has a single input channel, which
+  conv_forward_depthwise requires.
+  """
+  return w_shape[1] == 1
+
+
+def conv_output_tiles(x_shape, w_shape, conv_param):
+  """
+  Whether the filters tile the padded input exactly for the given stride,
+  which conv_forward_im2col requires.
+  """
+  H, W = x_shape[2:]
+  HH, WW = w_shape[2:]
+  stride, pad = conv_param['stride'], conv_param['pad']
+  return (H + 2 * pad - HH) % stride == 0 and (W + 2 * pad - WW) % stride == 0
+
+
+# The convolution algorithms that conv_forward_fast chooses between. Each name
+# maps to a (forward, backward, supports) triple, where supports is called as
+# supports(x_shape, w_shape, conv_param) and says whether the algorithm can
+# run that layer. Use register_conv_algorithm to add new algorithms.
+conv_algorithms = {}
+
+# Maps the name of each algorithm to the layout of the data it works on.
+conv_algorithm_layouts = {}
+
+# Maps the name of each algorithm to whether it runs grouped convolutions
+# (conv_param['groups'] > 1) rather than dense ones.
+conv_algorithm_grouped = {}
+
+# Maps a plan key (see conv_plan_key) to the name of the fastest algorithm.
+conv_plan_cache = {}
+
+
+def register_conv_algorithm(name, forward, backward, supports=None,
+                            layout='NCHW', grouped=False):
+  """
+  Make a convolution algorithm available to the autotuner.
+
+  Inputs:
+  - name: String used to refer to the algorithm in the plan cache
+  - forward: Function with the same API as conv_forward_naive
+  - backward: Function with the same API as conv_backward_naive, accepting
+    the cache returned by forward
+  - supports: Optional function supports(x_shape, w_shape, conv_param)
+    returning False for layers that the algorithm cannot handle
+  - layout: 'NCHW' or 'NHWC'; the algorithm is only considered for layers
+    whose conv_param asks for this layout
+  - grouped: If True the algorithm is only considered for grouped
+    convolutions, and if False only for dense ones
+  """
+  if supports is None:
+    supports = lambda x_shape, w_shape, conv_param: True
+  conv_algorithms[name] = (forward, backward, supports)
+  conv_algorithm_layouts[name] = layout
+  conv_algorithm_grouped[name] = grouped
+
+
+def conv_plan_key(x, w, conv_param):
+  """
+  The key under which the plan for a convolution is stored: the input and
+  filter shapes, the stride and padding, the dtype and the layout.
+  """
+  return (x.shape, w.shape, conv_param['stride'], conv_param['pad'],
+          x.dtype.str, conv_layout(conv_param))
+
+
+def autotune_conv(x, w, b, conv_param, num_repeats=2):
+  """
+  Time every registered algorithm that supports this convolution on a
+  forward and a backward pass, store the fastest one in conv_plan_cache and
+  return its name.
+  """
+  best_name, best_time = None, float('inf')
+  dout = None
+  layout = conv_layout(conv_param)
+  grouped = conv_groups(conv_param) > 1
+  for name in sorted(conv_algorithms):
+    forward, backward, supports = conv_algorithms[name]
+    if conv_algorithm_layouts[name] != layout:
+      continue
+    if conv_algorithm_grouped[name] != grouped:
+      continue
+    if not supports(x.shape, w.shape, conv_param):
+      continue
+    elapsed = float('inf')
+    for _ in xrange(num_repeats):
+      t0 = time()
+      out, cache = forward(x, w, b, conv_param)
+      if dout is None:
+        # Use a private random state so that tuning a new shape does not
+        # advance the global one
+        rng = np.random.RandomState(0)
+        dout = rng.randn(*out.shape).astype(out.dtype)
+      backward(dout, cache)
+      elapsed = min(elapsed, time() - t0)
+    if elapsed < best_time:
+      best_name, best_time = name, elapsed
+
+  if best_name is None:
+    raise ValueError('No convolution algorithm supports x %s, w %s, %s'
+                     % (x.shape, w.shape, conv_param))
+  conv_plan_cache[conv_plan_key(x, w, conv_param)] = best_name
+  return best_name
+
+
+def conv_forward_autotune(x, w, b, conv_param):
+  """
+  Forward pass for a convolutional layer that runs the fastest registered
+  algorithm for this layer's shape. The first call for a shape times the
+  candidates with autotune_conv; later calls are a single dictionary lookup.
+
+  Inputs / outputs: Same as conv_forward_naive, except that the cache also
+  records which algorithm was used. If conv_param['layout'] is 'NHWC' then x
+  and out are channels-last and only NHWC algorithms are considered.
+  """
+  name = conv_plan_cache.get(conv_plan_key(x, w, conv_param))
+  if name not in conv_algorithms:
+    name = autotune_conv(x, w, b, conv_param)
+  out, real_cache = conv_algorithms[name][0](x, w, b, conv_param)
+  cache = (name, real_cache)
+  return out, cache
+
+
+def conv_backward_autotune(dout, cache):
+  """
+  Backward pass for conv_forward_autotune, dispatching on the algorithm that
+  was used in the forward pass.
+  """
+  name, real_cache = cache
+  if name not in conv_algorithms:
+    raise ValueError('Unrecognized convolution algorithm "%s"' % name)
+  return conv_algorithms[name][1](dout, real_cache)
+
+
+def save_conv_plans(filename):
+  """
+  Save conv_plan_cache to disk so that a later run can skip autotuning.
+  """
+  with open(filename, 'wb') as f:
+    pickle.dump(conv_plan_cache, f, pickle.HIGHEST_PROTOCOL)
+
+
+def load_conv_plans(filename):
+  """
+  Merge plans saved with save_conv_plans into conv_plan_cache. Plans naming
+  an algorithm that is not registered are retuned on first use.
+  """
+  with open(filename, 'rb') as f:
+    conv_plan_cache.update(pickle.load(f))
+
+
+register_conv_algorithm('strides', conv_forward_strides, conv_backward_strides,
+                        conv_output_tiles)
+register_conv_algorithm('im2col', conv_forward_im2col, conv_backward_im2col,
+                        conv_output_tiles)
+register_conv_algorithm('winograd', conv_forward_winograd,
+                        conv_backward_winograd, winograd_supports)
+register_conv_algorithm('fft', conv_forward_fft, conv_backward_fft,
+                        fft_supports)
+register_conv_algorithm('nhwc', conv_forward_nhwc, conv_backward_nhwc,
+                        layout='NHWC')
+register_conv_algorithm('grouped', conv_forward_grouped, conv_backward_grouped,
+                        grouped=True)
+register_conv_algorithm('depthwise', conv_forward_depthwise,
+                        conv_backward_depthwise, conv_is_depthwise,
+                        grouped=True)
+
+conv_forward_fast = conv_forward_autotune
+conv_backward_fast = conv_backward_autotune
 
 
 def max_pool_forward_fast(x, pool_param):
   """
   A fast implementation of the forward pass for a max pooling layer.
 
-  This chooses between the reshape method and the im2col method. If the pooling
-  regions are square and tile the input image, then we can use the reshape
-  method which is very fast. Otherwise we fall back on the im2col method, which
-  is not much faster than the naive method.
+  This chooses between the reshape method and the strided method. If the
+  pooling regions are square and tile the input image, then we can use the
+  reshape method which is very fast. Otherwise we use the strided method,
+  which handles overlapping windows and pool_param['pad'].
+
+  If pool_param['layout'] is 'NHWC' then x has shape (N, H, W, C) and so does
+  the output.
   """
-  N, C, H, W = x.shape
+  nhwc = conv_layout(pool_param) == 'NHWC'
+  if nhwc:
+    N, H, W, C = x.shape
+  else:
+    N, C, H, W = x.shape
   pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
   stride = pool_param['stride']
 
   same_size = pool_height == pool_width == stride
   tiles = H % pool_height == 0 and W % pool_width == 0
-  if same_size and tiles:
+  unpadded = pool_param.get('pad', 0) == 0
+  if same_size and tiles and unpadded and nhwc:
+    out, reshape_cache = max_pool_forward_reshape_nhwc(x, pool_param)
+    cache = ('reshape_nhwc', reshape_cache)
+  elif same_size and tiles and unpadded:
     out, reshape_cache = max_pool_forward_reshape(x, pool_param)
     cache = ('reshape', reshape_cache)
   else:
-    out, im2col_cache = max_pool_forward_im2col(x, pool_param)
-    cache = ('im2col', im2col_cache)
+    out, strided_cache = max_pool_forward_strided(x, pool_param)
+    cache = ('strided', strided_cache)
   return out, cache
 
 
@@ -157,12 +949,16 @@ def max_pool_backward_fast(dout, cache):
   """
   A fast implementation of the backward pass for a max pooling layer.
 
-  This switches between the reshape method an the im2col method depending on
+  This switches between the reshape, strided and im2col methods depending on
   which method was used to generate the cache.
   """
   method, real_cache = cache
   if method == 'reshape':
     return max_pool_backward_reshape(dout, real_cache)
+  elif method == 'reshape_nhwc':
+    return max_pool_backward_reshape_nhwc(dout, real_cache)
+  elif method == 'strided':
+    return max_pool_backward_strided(dout, real_cache)
   elif method == 'im2col':
     return max_pool_backward_im2col(dout, real_cache)
   else:
@@ -211,12 +1007,55 @@ def max_pool_backward_reshape(dout, cache):
 
   dx_reshaped = np.zeros_like(x_reshaped)
   out_newaxis = out[:, :, :, np.newaxis, :, np.newaxis]
-  mask = (x_reshaped == out_newaxis)
+  mask = workspace.get(x_reshaped.shape, np.bool_)
+  np.equal(x_reshaped, out_newaxis, out=mask)
   dout_newaxis = dout[:, :, :, np.newaxis, :, np.newaxis]
   dout_broadcast, _ = np.broadcast_arrays(dout_newaxis, dx_reshaped)
   dx_reshaped[mask] = dout_broadcast[mask]
   dx_reshaped /= np.sum(mask, axis=(3, 5), keepdims=True)
   dx = dx_reshaped.reshape(x.shape)
+  workspace.put(mask)
+
+  return dx
+
+
+def max_pool_forward_reshape_nhwc(x, pool_param):
+  """
+  Channels-last version of max_pool_forward_reshape: x has shape
+  (N, H, W, C) and the output has shape (N, H / pool_height, W / pool_width,
+  C).
+  """
+  N, H, W, C = x.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  assert pool_height == pool_width == stride, 'Invalid pool params'
+  assert H % pool_height == 0
+  assert W % pool_width == 0
+  x_reshaped = x.reshape(N, H / pool_height, pool_height,
+                         W / pool_width, pool_width, C)
+  out = x_reshaped.max(axis=2).max(axis=3)
+
+  cache = (x, x_reshaped, out)
+  return out, cache
+
+
+def max_pool_backward_reshape_nhwc(dout, cache):
+  """
+  Backward pass for max_pool_forward_reshape_nhwc; see
+  max_pool_backward_reshape.
+  """
+  x, x_reshaped, out = cache
+
+  dx_reshaped = np.zeros_like(x_reshaped)
+  out_newaxis = out[:, :, np.newaxis, :, np.newaxis, :]
+  mask = workspace.get(x_reshaped.shape, np.bool_)
+  np.equal(x_reshaped, out_newaxis, out=mask)
+  dout_newaxis = dout[:, :, np.newaxis, :, np.newaxis, :]
+  dout_broadcast, _ = np.broadcast_arrays(dout_newaxis, dx_reshaped)
+  dx_reshaped[mask] = dout_broadcast[mask]
+  dx_reshaped /= np.sum(mask, axis=(2, 4), keepdims=True)
+  dx = dx_reshaped.reshape(x.shape)
+  workspace.put(mask)
 
   return dx
 
@@ -239,7 +1078,7 @@ def max_pool_forward_im2col(x, pool_param):
   out_width = (W - pool_width) / stride + 1
 
   x_split = x.reshape(N * C, 1, H, W)
-  x_cols = im2col(x_split, pool_height, pool_width, padding=0, stride=stride)
+  x_cols = im2col_cython(x_split, pool_height, pool_width, 0, stride)
   x_cols_argmax = np.argmax(x_cols, axis=0)
   x_cols_max = x_cols[x_cols_argmax, np.arange(x_cols.shape[1])]
   out = x_cols_max.reshape(out_height, out_width, N, C).transpose(2, 3, 0, 1)
@@ -261,10 +1100,290 @@ def max_pool_backward_im2col(dout, cache):
   stride = pool_param['stride']
 
   dout_reshaped = dout.transpose(2, 3, 0, 1).flatten()
-  dx_cols = np.zeros_like(x_cols)
+  dx_cols = workspace.zeros(x_cols.shape, x_cols.dtype)
   dx_cols[x_cols_argmax, np.arange(dx_cols.shape[1])] = dout_reshaped
   dx = col2im_indices(dx_cols, (N * C, 1, H, W), pool_height, pool_width,
               padding=0, stride=stride)
   dx = dx.reshape(x.shape)
+  workspace.put(dx_cols)
+
+  return dx
+
+
+def pool_window_offsets(pool_param, out_h, out_w, nhwc):
+  """
+  Yield (k, index) for every offset k = ii * pool_width + jj inside a pooling
+  window, where x[index] is the strided view holding element (ii, jj) of
+  every window; the view has the shape of the pooled output.
+  """
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  for ii in xrange(pool_height):
+    rows = slice(ii, ii + stride * (out_h - 1) + 1, stride)
+    for jj in xrange(pool_width):
+      cols = slice(jj, jj + stride * (out_w - 1) + 1, stride)
+      if nhwc:
+        index = (slice(None), rows, cols, slice(None))
+      else:
+        index = (slice(None), slice(None), rows, cols)
+      yield ii * pool_width + jj, index
+
+
+def max_pool_pad_buffer(x_shape, dtype, pad, nhwc):
+  """
+  Return a workspace array for an input of shape x_shape padded by pad on
+  each spatial side, with the border set to -inf so that it never wins a
+  max, together with a view of its interior.
+  """
+  if nhwc:
+    N, H, W, C = x_shape
+    x_padded = workspace.get((N, H + 2 * pad, W + 2 * pad, C), dtype)
+    interior = x_padded[:, pad:pad + H, pad:pad + W, :]
+  else:
+    N, C, H, W = x_shape
+    x_padded = workspace.get((N, C, H + 2 * pad, W + 2 * pad), dtype)
+    interior = x_padded[:, :, pad:pad + H, pad:pad + W]
+  if pad > 0:
+    x_padded.fill(-np.inf)
+  return x_padded, interior
+
+
+def max_pool_windows(x, pool_param, nhwc):
+  """
+  Max over every (possibly overlapping) pooling window of an already padded
+  input, computed as a running max over the pool_height * pool_width window
+  offsets.
+
+  Returns a tuple of:
+  - out: The pooled output
+  - argmax: Array of the same shape holding, for each window, the offset
+    ii * pool_width + jj of its maximum. Its dtype is the smallest unsigned
+    integer type that holds every offset: uint8 for windows of up to 256
+    elements, uint16 for up to 65536.
+  """
+  H, W = x.shape[1:3] if nhwc else x.shape[2:]
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  out_h = (H - pool_height) / stride + 1
+  out_w = (W - pool_width) / stride + 1
+  argmax_dtype = np.min_scalar_type(pool_height * pool_width - 1)
+  out, argmax, larger = None, None, None
+  for k, index in pool_window_offsets(pool_param, out_h, out_w, nhwc):
+    window = x[index]
+    if out is None:
+      out = window.copy()
+      argmax = np.zeros(out.shape, dtype=argmax_dtype)
+      larger = workspace.get(out.shape, np.bool_)
+      continue
+    np.greater(window, out, out=larger)
+    np.maximum(out, window, out=out)
+    np.copyto(argmax, k, where=larger)
+  workspace.put(larger)
+  return out, argmax
+
+
+def max_pool_scatter(dout, argmax, x_shape, pool_param, nhwc):
+  """
+  Route each upstream derivative to the input element that won its window.
+  The flat input index of every winner is computed from the argmax offsets
+  and the gradients are summed with a single bincount, so the cost is linear
+  in the size of the output (plus clearing dx) and overlapping windows are
+  handled correctly.
+
+  Inputs:
+  - dout: Upstream derivatives, of the shape of the pooled output
+  - argmax: Offsets returned by max_pool_windows
+  - x_shape: Shape of the (padded) input to max_pool_windows
+  - pool_param, nhwc: As passed to max_pool_windows
 
+  Returns:
+  - dx: Gradient with respect to the padded input, of shape x_shape
+  """
+  pool_width, stride = pool_param['pool_width'], pool_param['stride']
+  if nhwc:
+    N, H, W, C = x_shape
+    _, out_h, out_w, _ = dout.shape
+    rows = stride * np.arange(out_h).reshape(1, -1, 1, 1)
+    cols = stride * np.arange(out_w).reshape(1, 1, -1, 1)
+  else:
+    N, C, H, W = x_shape
+    out_h, out_w = dout.shape[2:]
+    rows = stride * np.arange(out_h).reshape(1, 1, -1, 1)
+    cols = stride * np.arange(out_w).reshape(1, 1, 1, -1)
+
+  ii, jj = np.divmod(argmax.astype(np.intp), pool_width)
+  ii += rows
+  jj += cols
+  if nhwc:
+    n = np.arange(N).reshape(-1, 1, 1, 1)
+    c = np.arange(C).reshape(1, 1, 1, -1)
+    index = ((n * H + ii) * W + jj) * C + c
+  else:
+    nc = np.arange(N * C).reshape(N, C, 1, 1)
+    index = (nc * H + ii) * W + jj
+
+  dx = np.bincount(index.ravel(), weights=dout.ravel(),
+                   minlength=N * C * H * W)
+  return dx.reshape(x_shape).astype(dout.dtype, copy=False)
+
+
+def max_pool_forward_strided(x, pool_param):
+  """
+  Max pooling for any window size and stride, including overlapping windows
+  such as 3x3 with stride 2, and optional padding given by pool_param['pad']
+  (default 0; padded positions never win). The cache holds only the input
+  shape and one argmax offset per output element, stored as uint8 when the
+  window has at most 256 elements (see max_pool_windows).
+
+  If pool_param['layout'] is 'NHWC' then x has shape (N, H, W, C) and so does
+  the output.
+  """
+  nhwc = conv_layout(pool_param) == 'NHWC'
+  pad = pool_param.get('pad', 0)
+  if pad > 0:
+    x_padded, interior = max_pool_pad_buffer(x.shape, x.dtype, pad, nhwc)
+    interior[...] = x
+    out, argmax = max_pool_windows(x_padded, pool_param, nhwc)
+    workspace.put(x_padded)
+  else:
+    out, argmax = max_pool_windows(x, pool_param, nhwc)
+  cache = (x.shape, argmax, pool_param)
+  return out, cache
+
+
+def max_pool_backward_strided(dout, cache):
+  """
+  Backward pass for max_pool_forward_strided.
+  """
+  x_shape, argmax, pool_param = cache
+  nhwc = conv_layout(pool_param) == 'NHWC'
+  pad = pool_param.get('pad', 0)
+  if nhwc:
+    N, H, W, C = x_shape
+    padded_shape = (N, H + 2 * pad, W + 2 * pad, C)
+  else:
+    N, C, H, W = x_shape
+    padded_shape = (N, C, H + 2 * pad, W + 2 * pad)
+  dx = max_pool_scatter(dout, argmax, padded_shape, pool_param, nhwc)
+  if pad > 0:
+    if nhwc:
+      dx = dx[:, pad:pad + H, pad:pad + W, :]
+    else:
+      dx = dx[:, :, pad:pad + H, pad:pad + W]
   return dx
+
+
+def spatial_batchnorm_relu_pool_forward(x, gamma, beta, bn_param,
+                                        pool_param=None):
+  """
+  Fused spatial batch normalization, ReLU and (optionally) max pooling.
+
+  Normalization is folded into one scale and shift per channel and applied
+  in a single pass; the pool then keeps a running max over the window
+  offsets, so apart from x itself only pooled-size arrays survive: the
+  output and the offset of each window's argmax. Pooling commutes with the
+  ReLU, so the ReLU is applied to the pooled output.
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W), or (N, H, W, C) if
+    bn_param['layout'] is 'NHWC'
+  - gamma, beta, bn_param: As for spatial_batchnorm_forward
+  - pool_param: As for max_pool_forward_fast, or None for no pooling
+
+  Returns a tuple of:
+  - out: Output data
+  - cache: Values needed for the backward pass
+  """
+  mode = bn_param['mode']
+  eps = bn_param.get('eps', 1e-5)
+  momentum = bn_param.get('momentum', 0.9)
+  nhwc = conv_layout(bn_param) == 'NHWC'
+  if nhwc:
+    N, H, W, C = x.shape
+    axes, bshape = (0, 1, 2), (1, 1, 1, C)
+  else:
+    N, C, H, W = x.shape
+    axes, bshape = (0, 2, 3), (1, C, 1, 1)
+  running_mean = bn_param.get('running_mean', np.zeros(C, dtype=x.dtype))
+  running_var = bn_param.get('running_var', np.zeros(C, dtype=x.dtype))
+
+  if mode == 'train':
+    mean = x.mean(axis=axes)
+    var = x.var(axis=axes)
+    bn_param['running_mean'] = momentum * running_mean + (1 - momentum) * mean
+    bn_param['running_var'] = momentum * running_var + (1 - momentum) * var
+  elif mode == 'test':
+    mean, var = running_mean, running_var
+    bn_param['running_mean'] = running_mean
+    bn_param['running_var'] = running_var
+  else:
+    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+  inv_std = 1.0 / np.sqrt(var + eps)
+  scale = (gamma * inv_std).astype(x.dtype)
+  shift = (beta - mean * gamma * inv_std).astype(x.dtype)
+
+  if pool_param is None:
+    out = x * scale.reshape(bshape)
+    out += shift.reshape(bshape)
+    np.maximum(out, 0, out=out)
+    argmax = None
+  else:
+    pad = pool_param.get('pad', 0)
+    y, y_interior = max_pool_pad_buffer(x.shape, x.dtype, pad, nhwc)
+    np.multiply(x, scale.reshape(bshape), out=y_interior)
+    y_interior += shift.reshape(bshape)
+    out, argmax = max_pool_windows(y, pool_param, nhwc)
+    workspace.put(y)
+    np.maximum(out, 0, out=out)
+
+  cache = (mode, x, gamma, mean, inv_std, out, argmax, nhwc, pool_param)
+  return out, cache
+
+
+def spatial_batchnorm_relu_pool_backward(dout, cache):
+  """
+  Backward pass for spatial_batchnorm_relu_pool_forward.
+
+  Returns a tuple of:
+  - dx: Gradient with respect to x
+  - dgamma: Gradient with respect to gamma, of shape (C,)
+  - dbeta: Gradient with respect to beta, of shape (C,)
+  """
+  mode, x, gamma, mean, inv_std, out, argmax, nhwc, pool_param = cache
+  if nhwc:
+    axes, bshape = (0, 1, 2), (1, 1, 1, x.shape[3])
+  else:
+    axes, bshape = (0, 2, 3), (1, x.shape[1], 1, 1)
+
+  # Gradient with respect to the normalized (pre-ReLU) activations
+  dout = dout * (out > 0)
+  if pool_param is None:
+    dy = dout
+  else:
+    pad = pool_param.get('pad', 0)
+    if nhwc:
+      N, H, W, C = x.shape
+      padded_shape = (N, H + 2 * pad, W + 2 * pad, C)
+    else:
+      N, C, H, W = x.shape
+      padded_shape = (N, C, H + 2 * pad, W + 2 * pad)
+    dy = max_pool_scatter(dout, argmax, padded_shape, pool_param, nhwc)
+    if pad > 0:
+      dy = dy[:, pad:pad + H, pad:pad + W, :] if nhwc else \
+           dy[:, :, pad:pad + H, pad:pad + W]
+
+  x_hat = x - mean.reshape(bshape)
+  x_hat *= inv_std.reshape(bshape)
+  dbeta = dy.sum(axis=axes)
+  dgamma = np.sum(dy * x_hat, axis=axes)
+  scale = (gamma * inv_std).reshape(bshape)
+  if mode == 'train':
+    M = x.size / x_hat.shape[3 if nhwc else 1]
+    dx = dy - (dbeta / M).reshape(bshape)
+    x_hat *= (dgamma / M).reshape(bshape)
+    dx -= x_hat
+    dx *= scale
+  else:
+    dx = dy * scale
+
+  return dx, dgamma, dbeta
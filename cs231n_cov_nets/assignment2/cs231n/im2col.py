@@ -1,11 +1,20 @@
 import numpy as np
 
 
+# Index arrays built by get_im2col_indices, keyed by the image shape (without
+# the batch size) and the field parameters; the arrays are read-only.
+im2col_indices_cache = {}
+
+
 def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
+  key = (tuple(x_shape[1:]), field_height, field_width, padding, stride)
+  if key in im2col_indices_cache:
+    return im2col_indices_cache[key]
+
   # First figure out what the size of the output should be
   N, C, H, W = x_shape
   assert (H + 2 * padding - field_height) % stride == 0
-  assert (W + 2 * padding - field_height) % stride == 0
+  assert (W + 2 * padding - field_width) % stride == 0
   out_height = (H + 2 * padding - field_height) / stride + 1
   out_width = (W + 2 * padding - field_width) / stride + 1
 
@@ -19,6 +28,9 @@ def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
 
   k = np.repeat(np.arange(C), field_height * field_width).reshape(-1, 1)
 
+  for a in (k, i, j):
+    a.flags.writeable = False
+  im2col_indices_cache[key] = (k, i, j)
   return (k, i, j)
 
 
@@ -39,15 +51,27 @@ def im2col_indices(x, field_height, field_width, padding=1, stride=1):
 
 def col2im_indices(cols, x_shape, field_height=3, field_width=3, padding=1,
                    stride=1):
-  """ An implementation of col2im based on fancy indexing and np.add.at """
+  """
+  An implementation of col2im based on strided slice-adds: for each of the
+  field_height * field_width offsets within a field, the matching rows of
+  cols are added into the input with one strided slice, which is much faster
+  than scattering every element through np.add.at.
+  """
   N, C, H, W = x_shape
   H_padded, W_padded = H + 2 * padding, W + 2 * padding
+  out_height = (H_padded - field_height) / stride + 1
+  out_width = (W_padded - field_width) / stride + 1
   x_padded = np.zeros((N, C, H_padded, W_padded), dtype=cols.dtype)
-  k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
-                               stride)
-  cols_reshaped = cols.reshape(C * field_height * field_width, -1, N)
-  cols_reshaped = cols_reshaped.transpose(2, 0, 1)
-  np.add.at(x_padded, (slice(None), k, i, j), cols_reshaped)
+
+  # Rows of cols are ordered by (c, ii, jj) and columns by (y, x, n)
+  cols_reshaped = cols.reshape(C, field_height, field_width,
+                               out_height, out_width, N)
+  cols_reshaped = cols_reshaped.transpose(1, 2, 5, 0, 3, 4)
+  for ii in xrange(field_height):
+    i_end = ii + stride * out_height
+    for jj in xrange(field_width):
+      j_end = jj + stride * out_width
+      x_padded[:, :, ii:i_end:stride, jj:j_end:stride] += cols_reshaped[ii, jj]
   if padding == 0:
     return x_padded
   return x_padded[:, :, padding:-padding, padding:-padding]
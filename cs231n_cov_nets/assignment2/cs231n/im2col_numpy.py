@@ -0,0 +1,115 @@
+"""
+Vectorized numpy versions of the kernels in im2col_cython.pyx. They take the
+same arguments and return arrays with the same layout as their Cython
+counterparts, so fast_layers.py can use them whenever the extension has not
+been built.
+
+im2col is done with a single strided view of the padded input followed by one
+contiguous copy. col2im loops over the HH * WW kernel offsets and scatters each
+offset with one strided slice-add, so the Python overhead is independent of the
+batch size and the image size.
+"""
+
+import numpy as np
+
+from cs231n.workspace import workspace
+
+
+def im2col_numpy(x, field_height, field_width, padding, stride):
+  """
+  Numpy replacement for im2col_cython.
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W)
+  - field_height, field_width: Size of the receptive field
+  - padding: Number of zeros to pad on each side of the image
+  - stride: Distance between adjacent receptive fields
+
+  Returns:
+  - cols: Array of shape (C * field_height * field_width, HH * WW * N) where
+    rows are ordered by (c, ii, jj) and columns by (yy, xx, n).
+  """
+  N, C, H, W = x.shape
+  HH = (H + 2 * padding - field_height) / stride + 1
+  WW = (W + 2 * padding - field_width) / stride + 1
+
+  if padding > 0:
+    x_padded = workspace.pad(x, padding)
+  else:
+    x_padded = np.ascontiguousarray(x)
+  _, _, H_p, W_p = x_padded.shape
+
+  shape = (C, field_height, field_width, HH, WW, N)
+  strides = (H_p * W_p, W_p, 1, stride * W_p, stride, C * H_p * W_p)
+  strides = x_padded.itemsize * np.array(strides)
+  x_stride = np.lib.stride_tricks.as_strided(x_padded, shape=shape,
+                                             strides=strides)
+  # Always copy, since a padded x_padded goes back to the workspace
+  cols = x_stride.copy()
+  cols.shape = (C * field_height * field_width, HH * WW * N)
+  if padding > 0:
+    workspace.put(x_padded)
+  return cols
+
+
+def col2im_numpy(cols, N, C, H, W, field_height, field_width, padding, stride):
+  """
+  Numpy replacement for col2im_cython; the inverse (adjoint) of im2col_numpy.
+
+  Inputs:
+  - cols: Array of shape (C * field_height * field_width, HH * WW * N)
+  - N, C, H, W: Shape of the image the columns were taken from
+  - field_height, field_width, padding, stride: As passed to im2col_numpy
+
+  Returns:
+  - x: Array of shape (N, C, H, W) where overlapping receptive fields have
+    been summed.
+  """
+  HH = (H + 2 * padding - field_height) / stride + 1
+  WW = (W + 2 * padding - field_width) / stride + 1
+  x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
+                      dtype=cols.dtype)
+
+  # (c, ii, jj, yy, xx, n) -> (ii, jj, n, c, yy, xx) so that each kernel offset
+  # is a single (N, C, HH, WW) block that lines up with a strided slice.
+  cols_6d = cols.reshape(C, field_height, field_width, HH, WW, N)
+  cols_6d = cols_6d.transpose(1, 2, 5, 0, 3, 4)
+  for ii in xrange(field_height):
+    i_end = ii + stride * HH
+    for jj in xrange(field_width):
+      j_end = jj + stride * WW
+      x_padded[:, :, ii:i_end:stride, jj:j_end:stride] += cols_6d[ii, jj]
+
+  if padding > 0:
+    return x_padded[:, :, padding:-padding, padding:-padding]
+  return x_padded
+
+
+def col2im_6d_numpy(cols, N, C, H, W, HH, WW, pad, stride):
+  """
+  Numpy replacement for col2im_6d_cython.
+
+  Inputs:
+  - cols: Array of shape (C, HH, WW, N, out_h, out_w), as produced by the
+    backward pass of conv_backward_strides.
+  - N, C, H, W: Shape of the input to the convolution
+  - HH, WW: Filter height and width
+  - pad, stride: Convolution parameters
+
+  Returns:
+  - x: Array of shape (N, C, H, W)
+  """
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+  x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad), dtype=cols.dtype)
+
+  cols_6d = cols.transpose(1, 2, 3, 0, 4, 5)
+  for hh in xrange(HH):
+    h_end = hh + stride * out_h
+    for ww in xrange(WW):
+      w_end = ww + stride * out_w
+      x_padded[:, :, hh:h_end:stride, ww:w_end:stride] += cols_6d[hh, ww]
+
+  if pad > 0:
+    return x_padded[:, :, pad:-pad, pad:-pad]
+  return x_padded
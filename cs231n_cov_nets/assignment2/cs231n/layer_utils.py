@@ -31,7 +31,86 @@ def affine_relu_backward(dout, cache):
   return dx, dw, db
 
 
-pass
+def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param):
+  """
+  Convenience layer that performs an affine transform, batch normalization
+  and a ReLU. The three are fused: the affine output is normalized in place,
+  and besides the layer input the cache keeps only the normalized values and
+  a boolean ReLU mask, instead of the affine output, the normalized values
+  and the batchnorm output.
+
+  Inputs:
+  - x: Input to the affine layer, of shape (N, d_1, ..., d_k)
+  - w, b: Arrays of shape (D, M) and (M,) giving the weight and bias for the
+    affine transform, where D = d_1 * ... * d_k
+  - gamma, beta: Arrays of shape (M,) giving scale and shift parameters for
+    batch normalization
+  - bn_param: Dictionary of parameters for batch normalization, as for
+    batchnorm_forward
+
+  Returns a tuple of:
+  - out: Output from the ReLU, of shape (N, M)
+  - cache: Object to give to the backward pass
+  """
+  mode = bn_param['mode']
+  eps = bn_param.get('eps', 1e-5)
+  momentum = bn_param.get('momentum', 0.9)
+
+  N = x.shape[0]
+  M = w.shape[1]
+  running_mean = bn_param.get('running_mean', np.zeros(M, dtype=x.dtype))
+  running_var = bn_param.get('running_var', np.zeros(M, dtype=x.dtype))
+
+  # x_hat starts out as the affine output and is normalized in place
+  x_hat = x.reshape(N, -1).dot(w)
+  x_hat += b
+  if mode == 'train':
+    mean = x_hat.mean(axis=0)
+    x_hat -= mean
+    var = np.einsum('nm,nm->m', x_hat, x_hat) / N
+    bn_param['running_mean'] = momentum * running_mean + (1 - momentum) * mean
+    bn_param['running_var'] = momentum * running_var + (1 - momentum) * var
+  elif mode == 'test':
+    x_hat -= running_mean
+    var = running_var
+  else:
+    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+  inv_std = 1.0 / np.sqrt(var + eps)
+  x_hat *= inv_std
+
+  out = x_hat * gamma
+  out += beta
+  mask = out > 0
+  np.maximum(out, 0, out=out)
+
+  cache = (mode, x, w, x_hat, gamma, inv_std, mask)
+  return out, cache
+
+
+def affine_bn_relu_backward(dout, cache):
+  """
+  Backward pass for the affine-batchnorm-relu convenience layer.
+  """
+  mode, x, w, x_hat, gamma, inv_std, mask = cache
+  N = x.shape[0]
+
+  dy = dout * mask
+  dbeta = dy.sum(axis=0)
+  dgamma = np.einsum('nm,nm->m', dy, x_hat)
+  if mode == 'train':
+    # The batchnorm backward pass in closed form:
+    # da = gamma * inv_std * (dy - mean(dy) - x_hat * mean(dy * x_hat))
+    da = x_hat * (dgamma / N)
+    np.subtract(dy, da, out=da)
+    da -= dbeta / N
+  else:
+    da = dy
+  da *= gamma * inv_std
+
+  db = da.sum(axis=0)
+  dw = x.reshape(N, -1).T.dot(da)
+  dx = da.dot(w.T).reshape(x.shape)
+  return dx, dw, db, dgamma, dbeta
 
 
 def conv_relu_forward(x, w, b, conv_param):
@@ -62,6 +141,43 @@ def conv_relu_backward(dout, cache):
   return dx, dw, db
 
 
+def separable_conv_relu_forward(x, w_dw, b_dw, w_pw, b_pw, conv_param):
+  """
+  Convenience layer that performs a depthwise-separable convolution (a
+  depthwise convolution followed by a 1x1 pointwise convolution) and a ReLU.
+  This costs C * M * (HH * WW + F) multiplies per output pixel where a dense
+  convolution with the same input and output channels costs C * F * HH * WW.
+
+  Inputs:
+  - x: Input data of shape (N, C, H, W)
+  - w_dw, b_dw: Depthwise filters of shape (C * M, 1, HH, WW) and biases
+  - w_pw, b_pw: Pointwise filters of shape (F, C * M, 1, 1) and biases
+  - conv_param: 'stride' and 'pad' of the depthwise convolution
+
+  Returns a tuple of:
+  - out: Output from the ReLU, of shape (N, F, H', W')
+  - cache: Object to give to the backward pass
+  """
+  dw_param = dict(conv_param, groups=x.shape[1])
+  pw_param = {'stride': 1, 'pad': 0}
+  a, dw_cache = conv_forward_fast(x, w_dw, b_dw, dw_param)
+  s, pw_cache = conv_forward_fast(a, w_pw, b_pw, pw_param)
+  out, relu_cache = relu_forward(s)
+  cache = (dw_cache, pw_cache, relu_cache)
+  return out, cache
+
+
+def separable_conv_relu_backward(dout, cache):
+  """
+  Backward pass for the separable-conv-relu convenience layer.
+  """
+  dw_cache, pw_cache, relu_cache = cache
+  ds = relu_backward(dout, relu_cache)
+  da, dw_pw, db_pw = conv_backward_fast(ds, pw_cache)
+  dx, dw_dw, db_dw = conv_backward_fast(da, dw_cache)
+  return dx, dw_dw, db_dw, dw_pw, db_pw
+
+
 def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
   """
   Convenience layer that performs a convolution, a ReLU, and a pool.
@@ -92,3 +208,59 @@ def conv_relu_pool_backward(dout, cache):
   dx, dw, db = conv_backward_fast(da, conv_cache)
   return dx, dw, db
 
+
+def conv_bn_relu_forward(x, w, b, gamma, beta, conv_param, bn_param):
+  """
+  Convenience layer that performs a convolution, spatial batch normalization
+  and a ReLU. The batchnorm and ReLU are fused; see
+  spatial_batchnorm_relu_pool_forward.
+  """
+  a, conv_cache = conv_forward_fast(x, w, b, conv_param)
+  out, bn_cache = spatial_batchnorm_relu_pool_forward(a, gamma, beta, bn_param)
+  cache = (conv_cache, bn_cache)
+  return out, cache
+
+
+def conv_bn_relu_backward(dout, cache):
+  """
+  Backward pass for the conv-batchnorm-relu convenience layer.
+  """
+  conv_cache, bn_cache = cache
+  da, dgamma, dbeta = spatial_batchnorm_relu_pool_backward(dout, bn_cache)
+  dx, dw, db = conv_backward_fast(da, conv_cache)
+  return dx, dw, db, dgamma, dbeta
+
+
+def conv_bn_relu_pool_forward(x, w, b, gamma, beta, conv_param, bn_param,
+                              pool_param):
+  """
+  Convenience layer that performs a convolution, spatial batch normalization,
+  a ReLU and a max pool. The last three are fused into one pass that keeps
+  only the conv output, the per-channel statistics and the pooled output and
+  argmax in the cache.
+
+  Inputs:
+  - x: Input to the convolutional layer
+  - w, b, conv_param: Weights and parameters for the convolutional layer
+  - gamma, beta, bn_param: Parameters for spatial batch normalization
+  - pool_param: Parameters for the pooling layer
+
+  Returns a tuple of:
+  - out: Output from the pooling layer
+  - cache: Object to give to the backward pass
+  """
+  a, conv_cache = conv_forward_fast(x, w, b, conv_param)
+  out, bn_cache = spatial_batchnorm_relu_pool_forward(a, gamma, beta, bn_param,
+                                                      pool_param)
+  cache = (conv_cache, bn_cache)
+  return out, cache
+
+
+def conv_bn_relu_pool_backward(dout, cache):
+  """
+  Backward pass for the conv-batchnorm-relu-pool convenience layer.
+  """
+  conv_cache, bn_cache = cache
+  da, dgamma, dbeta = spatial_batchnorm_relu_pool_backward(dout, bn_cache)
+  dx, dw, db = conv_backward_fast(da, conv_cache)
+  return dx, dw, db, dgamma, dbeta
@@ -458,8 +458,10 @@ def dropout_forward(x, dropout_param):
 
   Outputs:
   - out: Array of the same shape as x.
-  - cache: A tuple (dropout_param, mask). In training mode, mask is the dropout
-    mask that was used to multiply the input; in test mode, mask is None.
+  - cache: A tuple (dropout_param, mask). In training mode, mask holds the
+    kept / dropped flags of the dropout mask packed eight to a byte with
+    np.packbits, which is 64x smaller than the float64 mask; in test mode,
+    mask is None.
   """
   p, mode = dropout_param['p'], dropout_param['mode']
   if 'seed' in dropout_param:
@@ -473,9 +475,12 @@ def dropout_forward(x, dropout_param):
     # TODO: Implement the training phase forward pass for inverted dropout.   #
     # Store the dropout mask in the mask variable.                            #
     ###########################################################################
-    mask = (np.random.rand(*x.shape) < (1-p) )/(1-p)
-    # element wise mulitiplication
-    out = x * mask
+    keep = np.random.rand(*x.shape) < (1-p)
+    # element wise mulitiplication, in float64 like a float64 mask of
+    # 1 / (1 - p) and 0 would be
+    out = np.multiply(x, keep, dtype=np.result_type(x, np.float64))
+    out *= 1.0 / (1-p)
+    mask = np.packbits(keep)
     ###########################################################################
     #                            END OF YOUR CODE                             #
     ###########################################################################
@@ -510,7 +515,10 @@ def dropout_backward(dout, cache):
     ###########################################################################
     # TODO: Implement the training phase backward pass for inverted dropout.  #
     ###########################################################################
-    dx = dout * mask
+    p = dropout_param['p']
+    keep = np.unpackbits(mask)[:dout.size].reshape(dout.shape).view(np.bool_)
+    dx = np.multiply(dout, keep, dtype=np.result_type(dout, np.float64))
+    dx *= 1.0 / (1-p)
     ###########################################################################
     #                            END OF YOUR CODE                             #
     ###########################################################################
@@ -527,6 +535,11 @@ def conv_forward_naive(x, w, b, conv_param):
   W. We convolve each input with F different filters, where each filter spans
   all C channels and has height HH and width HH.
 
+  This is the reference the fast layers are checked against, so it does not
+  use im2col: it loops over the HH * WW filter offsets, and for each offset
+  multiplies the matching strided slice of the padded input, for all images
+  and output positions at once, by that offset's (F, C) slice of the filters.
+
   Input:
   - x: Input data of shape (N, C, H, W)
   - w: Filter weights of shape (F, C, HH, WW)
@@ -543,61 +556,32 @@ def conv_forward_naive(x, w, b, conv_param):
   - cache: (x, w, b, conv_param)
   """
   out = None
-  import pdb
   #############################################################################
   # TODO: Implement the convolutional forward pass.                           #
   # Hint: you can use the function np.pad for padding.                        #
   #############################################################################
-  wkd = w
-  bkd = b
-  # init some parameters
-  N, C, H, W  = x.shape[0], x.shape[1], x.shape[2], x.shape[3]
-  F, C1, HH, WW = w.shape[0], w.shape[1], w.shape[2], w.shape[3]
-  bshape = b.shape[0]
+  N, C, H, W = x.shape
+  F, C1, HH, WW = w.shape
   assert C == C1
-  assert bshape == F
+  assert b.shape[0] == F
   pad = conv_param.get("pad")
   stride = conv_param.get("stride")
   h_filter_size = 1 + (H + 2 * pad - HH) / stride
   w_filter_size = 1 + (W + 2 * pad - WW) / stride
 
-  #############################################################################
-  #     pad the image first
-  #############################################################################
-  x_padded = []
-  for n_index in range(N):
-    image_x = x[n_index]
-    pad_array = []
-    pad_array.append((0,0))
-    for channel_index in range(1, C):
-      pad_array.append((pad, pad))
-    image_x_pad = np.pad(image_x, pad_array, 'constant', constant_values=0)
-    x_padded.append(image_x_pad)
-
-  out = []
-  for n_index in range(N):
-    x_image = x_padded[n_index]
-    rows, cols  = x_image.shape[1], x_image.shape[2]
-    # print rows, cols
-    for filter_index in range(F):
-      w_filter = w[filter_index]
-      b_filter = b[filter_index]
-      filter_conv = []
-      for row_index in xrange(0, rows - HH + 1, stride):
-        for col_index in xrange(0, cols - WW + 1, stride):
-          conv_image = x_image[:, row_index: HH + row_index, col_index: WW + col_index]
-          # print "filter_index:%d, row_index:%d, col_index:%d" % (filter_index, row_index, col_index)
-          # print "n_index:%d, w_filter.shape:%s, conv_image.shape:%s" % (n_index, w_filter.shape, conv_image.shape)
-          shape_1 = np.prod(w_filter.shape)
-          shape_2 = np.prod(conv_image.shape)
-          assert shape_2 == shape_1
-          ff = w_filter.reshape(shape_1)
-          cc = conv_image.reshape(shape_1)  
-          conv_dot = cc.dot(ff) + b_filter
-          out.append(conv_dot)
-  out = np.array(out).reshape((N, F, h_filter_size, w_filter_size))
-  
-
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant')
+
+  # out is accumulated as (F, N, H', W'), the layout tensordot returns
+  out = np.zeros((F, N, h_filter_size, w_filter_size),
+                 dtype=np.result_type(x, w, b))
+  for hh in xrange(HH):
+    h_end = hh + stride * h_filter_size
+    for ww in xrange(WW):
+      w_end = ww + stride * w_filter_size
+      x_tap = x_padded[:, :, hh:h_end:stride, ww:w_end:stride]
+      out += np.tensordot(w[:, :, hh, ww], x_tap, axes=([1], [1]))
+  out = np.ascontiguousarray(out.transpose(1, 0, 2, 3))
+  out += b.reshape(1, F, 1, 1)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -607,7 +591,8 @@ def conv_forward_naive(x, w, b, conv_param):
 
 def conv_backward_naive(dout, cache):
   """
-  A naive implementation of the backward pass for a convolutional layer.
+  A naive implementation of the backward pass for a convolutional layer. Like
+  the forward pass it loops over the filter offsets only.
 
   Inputs:
   - dout: Upstream derivatives.
@@ -617,73 +602,51 @@ def conv_backward_naive(dout, cache):
   - dx: Gradient with respect to x
   - dw: Gradient with respect to w
   - db: Gradient with respect to b
-  # """
-  # dx, dw, db = None, None, None
-  # #############################################################################
-  # # TODO: Implement the convolutional backward pass.                          #
-  # #############################################################################
+  """
+  dx, dw, db = None, None, None
+  #############################################################################
+  # TODO: Implement the convolutional backward pass.                          #
+  #############################################################################
   x, w, b, conv_param = cache
-
-  N, C, H, W  = x.shape[0], x.shape[1], x.shape[2], x.shape[3]
-  F, C1, HH, WW = w.shape[0], w.shape[1], w.shape[2], w.shape[3]
-  bshape = b.shape[0]
+  N, C, H, W = x.shape
+  F, C1, HH, WW = w.shape
   assert C == C1
-  assert bshape == F
+  assert b.shape[0] == F
   pad = conv_param.get("pad")
   stride = conv_param.get("stride")
-  h_filter_size = 1 + (H + 2 * pad - HH) / stride
-  w_filter_size = 1 + (W + 2 * pad - WW) / stride
-
-  # #############################################################################
-  # #     pad the image first and dout so that they are are easy to process.
-  # #############################################################################
-  x_padded = []
-  for n_index in range(N):
-    image_x = x[n_index]
-    pad_array = []
-    pad_array.append((0,0))
-    for channel_index in range(1, C):
-      pad_array.append((pad, pad))
-    image_x_pad = np.pad(image_x, pad_array, 'constant', constant_values=0)
-    x_padded.append(image_x_pad)
-
-  x_padded = np.array(x_padded)
-  #############################################################################
-  #     compute the error loss.
-  #############################################################################
-
-  import pdb
-  dx = np.array(len(x_padded) * [np.zeros(x_padded[0].shape)])
-  dw = np.zeros((w.shape))
-  db = np.zeros((b.shape))
-  # Alternatively can use.
-    # dx = np.zeros_like(x)
-    # dw = np.zeros_like(w)
-    # db = np.zeros_like(b)
-
-  for n_index in range(N):
-    rows, cols  = x_padded[0].shape[1], x_padded[0].shape[2]
-    for filter_index in range(F):
-      w_filter = w[filter_index]
-      for row_index in xrange(0, rows - HH + 1, stride):
-        for col_index in xrange(0, cols - WW + 1, stride):
-
-          x_conv_image = x_padded[n_index, :, row_index: HH + row_index, col_index: WW + col_index]
-          dout_padded_oj = dout[n_index, filter_index, row_index/stride, col_index/stride]
-          dx[n_index, :, row_index: HH + row_index, col_index: WW + col_index] += w_filter * dout_padded_oj
-
-          dw[filter_index] += x_conv_image * dout_padded_oj
-          db[filter_index] += dout_padded_oj
+  _, _, h_filter_size, w_filter_size = dout.shape
+
+  # The gradients are computed in float64
+  x_padded = np.pad(x.astype(np.float64),
+                    ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant')
+  dout = dout.astype(np.float64)
+  w = w.astype(np.float64)
+  dx_padded = np.zeros(x_padded.shape)
+  dw = np.zeros(w.shape)
+  db = np.sum(dout, axis=(0, 2, 3))
+  for hh in xrange(HH):
+    h_end = hh + stride * h_filter_size
+    for ww in xrange(WW):
+      w_end = ww + stride * w_filter_size
+      x_tap = x_padded[:, :, hh:h_end:stride, ww:w_end:stride]
+      dw[:, :, hh, ww] = np.tensordot(dout, x_tap, axes=([0, 2, 3], [0, 2, 3]))
+      dx_tap = np.tensordot(dout, w[:, :, hh, ww], axes=([1], [0]))
+      dx_padded[:, :, hh:h_end:stride, ww:w_end:stride] += \
+          dx_tap.transpose(0, 3, 1, 2)
 
   # unpad
-  dx = dx[:, :, pad:-pad, pad:-pad]
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+  #############################################################################
+  #                             END OF YOUR CODE                              #
+  #############################################################################
+  return dx, dw, db
 
-  
-  return dx, dw, db  
 
 def max_pool_forward_naive(x, pool_param):
   """
-  A naive implementation of the forward pass for a max pooling layer.
+  A naive implementation of the forward pass for a max pooling layer. It
+  loops over the pool_height * pool_width offsets within a pooling region,
+  keeping a running max over the strided slices of x at those offsets.
 
   Inputs:
   - x: Input data, of shape (N, C, H, W)
@@ -694,39 +657,32 @@ def max_pool_forward_naive(x, pool_param):
 
   Returns a tuple of:
   - out: Output data
-  - cache: (x, pool_param)
+  - cache: (x, pool_param, out_argmax), where out_argmax holds for every
+    pooling region the offset i * pool_width + j of its (first) maximum
   """
   out = None
   #############################################################################
   # TODO: Implement the max pooling forward pass                              #
   #############################################################################
-
-  # init variables
-  N, C, H, W = x.shape[0], x.shape[1], x.shape[2], x.shape[3]
+  N, C, H, W = x.shape
   height = pool_param.get("pool_height")
   width = pool_param.get("pool_width")
   stride = pool_param.get("stride")
-
-  # for n in xrange(N):
-  #   for c in xrange(C):
-  #     for w in xrange(0, width):
-  #       for h in xrange(height):
-
   h2 = (H - height)/stride + 1
   w2 = (W - width)/stride + 1
 
   out = np.zeros((N, C, h2, w2))
-  out_argmax = np.zeros((N, C, h2, w2))
-  # print out.shape
-  for n in xrange(N):
-    for c in xrange(C):
-      for row_index in xrange(0, H - height + 1, stride):
-        for col_index in xrange(0, W - width + 1, stride):
-          pool_image = x[n, c, row_index : row_index + height, col_index : col_index + width]
-          out[n, c, row_index/stride, col_index/stride] = np.max(pool_image)
-          out_argmax[n, c, row_index/stride, col_index/stride] = np.argmax(pool_image)
-
-
+  out_argmax = np.zeros((N, C, h2, w2), dtype=np.intp)
+  for i in xrange(height):
+    for j in xrange(width):
+      window = x[:, :, i:i + stride * h2:stride, j:j + stride * w2:stride]
+      if i == 0 and j == 0:
+        out[...] = window
+        continue
+      # Strictly greater, so that ties keep the first maximum like np.argmax
+      larger = window > out
+      out[larger] = window[larger]
+      out_argmax[larger] = i * width + j
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -740,7 +696,7 @@ def max_pool_backward_naive(dout, cache):
 
   Inputs:
   - dout: Upstream derivatives
-  - cache: A tuple of (x, pool_param) as in the forward pass.
+  - cache: A tuple of (x, pool_param, out_argmax) as in the forward pass.
 
   Returns:
   - dx: Gradient with respect to x
@@ -749,25 +705,18 @@ def max_pool_backward_naive(dout, cache):
   # TODO: Implement the max pooling backward pass                             #
   #############################################################################
   x, pool_param, out_argmax = cache
-  N, C, H, W = x.shape[0], x.shape[1], x.shape[2], x.shape[3]
   height = pool_param.get("pool_height")
   width = pool_param.get("pool_width")
   stride = pool_param.get("stride")
+  _, _, h2, w2 = dout.shape
 
+  # Each offset sends the upstream gradient of the regions whose maximum it
+  # holds back to its strided slice of dx
   dx = np.zeros_like(x)
-  for n in xrange(N):
-    for c in xrange(C):
-      for row_index in xrange(0, H - height + 1, stride):
-        for col_index in xrange(0, W - width + 1, stride):
-          argmax_location = out_argmax[n, c, row_index/stride, col_index/stride]
-          dout_i = dout[n, c, row_index/stride, col_index/stride]
-          index = 0
-          for i in range(0, height):
-            for j in range(0, width):
-              if (index == argmax_location):
-                dx[n, c, row_index : row_index + height, col_index : col_index + width][i,j] +=  dout_i
-              index += 1
-
+  for i in xrange(height):
+    for j in xrange(width):
+      dx[:, :, i:i + stride * h2:stride, j:j + stride * w2:stride] += \
+          dout * (out_argmax == i * width + j)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -875,6 +824,8 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
       default of momentum=0.9 should work well in most situations.
     - running_mean: Array of shape (D,) giving running mean of features
     - running_var Array of shape (D,) giving running variance of features
+    - layout: 'NCHW' (default) or 'NHWC'. With 'NHWC' x has shape
+      (N, H, W, C) and so does out.
     
   Returns a tuple of:
   - out: Output data, of shape (N, C, H, W)
@@ -888,16 +839,50 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
   # version of batch normalization defined above. Your implementation should  #
   # be very short; ours is less than five lines.                              #
   #############################################################################
+  # The statistics are reduced directly over every axis but the channel one,
+  # so x is never transposed into an (N*H*W, C) copy. Mean and variance come
+  # from a single pass that accumulates the sum and the sum of squares in
+  # float64, and the normalization is folded into one per-channel scale and
+  # shift, so the only full-size array allocated is out.
   mode = bn_param['mode']
   eps = bn_param.get('eps', 1e-5)
   momentum = bn_param.get('momentum', 0.9)
+  layout = bn_param.get('layout', 'NCHW')
+  if layout == 'NHWC':
+    C = x.shape[3]
+    axes, bshape = (0, 1, 2), (1, 1, 1, C)
+  elif layout == 'NCHW':
+    C = x.shape[1]
+    axes, bshape = (0, 2, 3), (1, C, 1, 1)
+  else:
+    raise ValueError('Unrecognized layout "%s"' % layout)
+  M = x.size / C
 
-  N, C, H, W = x.shape
+  running_mean = bn_param.get('running_mean', np.zeros(C, dtype=x.dtype))
+  running_var = bn_param.get('running_var', np.zeros(C, dtype=x.dtype))
 
-  total_features = np.prod((N, H, W))
-  flat_x = swap_and_reshape_axis(x, *x.shape)
-  out_temp, cache = batchnorm_forward(flat_x, gamma, beta, bn_param)
-  out = reshape_and_swap_axis(out_temp, *x.shape)
+  if mode == 'train':
+    spec = 'nhwc,nhwc->c' if layout == 'NHWC' else 'nchw,nchw->c'
+    mean = x.sum(axis=axes, dtype=np.float64) / M
+    sq_mean = np.einsum(spec, x, x, dtype=np.float64) / M
+    var = np.maximum(sq_mean - mean * mean, 0)
+    running_mean = momentum * running_mean + (1 - momentum) * mean
+    running_var = momentum * running_var + (1 - momentum) * var
+  elif mode == 'test':
+    mean, var = running_mean, running_var
+  else:
+    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+  bn_param['running_mean'] = running_mean
+  bn_param['running_var'] = running_var
+
+  inv_std = 1.0 / np.sqrt(var + eps)
+  scale = (gamma * inv_std).astype(x.dtype)
+  shift = (beta - mean * gamma * inv_std).astype(x.dtype)
+  out = x * scale.reshape(bshape)
+  out += shift.reshape(bshape)
+
+  cache = (layout, x, gamma, mean, inv_std)
 
   #############################################################################
   #                             END OF YOUR CODE                              #
@@ -941,19 +926,175 @@ def spatial_batchnorm_backward(dout, cache):
   #############################################################################
   # import pdb
   # pdb.set_trace()
-  dout_temp = swap_and_reshape_axis(dout, *dout.shape)
-  # import pdb
-  # pdb.set_trace()
-  dx_temp, dgamma, dbeta = batchnorm_backward(dout_temp, cache)
-  dx = reshape_and_swap_axis(dx_temp, *dout.shape)
+  # With x_hat = (x - mean) * inv_std the gradient is
+  #   dx = gamma * inv_std * (dout - mean(dout) - x_hat * mean(dout * x_hat))
+  # which is a per-channel affine function of dout and x. dgamma is computed
+  # from x itself, so x_hat is never materialized.
+  layout, x, gamma, mean, inv_std = cache
+  if layout == 'NHWC':
+    C = x.shape[3]
+    axes, bshape, spec = (0, 1, 2), (1, 1, 1, C), 'nhwc,nhwc->c'
+  else:
+    C = x.shape[1]
+    axes, bshape, spec = (0, 2, 3), (1, C, 1, 1), 'nchw,nchw->c'
+  M = x.size / C
+
+  dbeta = dout.sum(axis=axes)
+  dgamma = (np.einsum(spec, dout, x) - mean * dbeta) * inv_std
+
+  scale = gamma * inv_std
+  x_coef = -scale * inv_std * dgamma / M
+  const = scale * (inv_std * dgamma * mean - dbeta) / M
+  dx = dout * scale.astype(dout.dtype).reshape(bshape)
+  dx += x * x_coef.astype(x.dtype).reshape(bshape)
+  dx += const.astype(dx.dtype).reshape(bshape)
+  # mean and inv_std are float64; return dgamma in the dtype of dout
+  dgamma = dgamma.astype(dout.dtype)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
 
   return dx, dgamma, dbeta
-  
 
-def svm_loss(x, y):
+
+def batchnorm_fold(w, b, gamma, beta, bn_param):
+  """
+  Folds a test-mode batch normalization into the affine or convolutional
+  layer that feeds it. At test time batchnorm is a fixed per-feature scale
+  and shift,
+
+  out = gamma * (x.dot(w) + b - running_mean) / sqrt(running_var + eps) + beta
+
+  so it can be applied to the weights once instead of to every activation.
+
+  Inputs:
+  - w: Weights of the preceding layer; either of shape (D, M) for an affine
+    layer or of shape (M, C, HH, WW) for a convolutional layer.
+  - b: Biases, of shape (M,)
+  - gamma, beta: Scale and shift parameters, of shape (M,)
+  - bn_param: Dictionary holding running_mean and running_var, and
+    optionally eps, as left by batchnorm_forward or
+    spatial_batchnorm_forward.
+
+  Returns a tuple of:
+  - w_folded: Weights of the same shape as w
+  - b_folded: Biases of shape (M,)
+  """
+  if 'running_mean' not in bn_param:
+    raise ValueError('bn_param has no running statistics to fold')
+  eps = bn_param.get('eps', 1e-5)
+  scale = gamma / np.sqrt(bn_param['running_var'] + eps)
+  if w.ndim == 2:
+    w_folded = w * scale
+  else:
+    w_folded = w * scale.reshape(-1, *([1] * (w.ndim - 1)))
+  b_folded = (b - bn_param['running_mean']) * scale + beta
+  return w_folded.astype(w.dtype), b_folded.astype(b.dtype)
+
+
+# Number of rows of scores the loss functions below work on at a time. Their
+# temporaries are at most LOSS_BLOCK_SIZE x C, however large the minibatch.
+LOSS_BLOCK_SIZE = 1024
+
+
+def svm_loss_block(scores, y):
+  """
+  Multiclass SVM loss of a block of scores. The scores are overwritten with
+  the gradient of the summed loss with respect to them.
+
+  Inputs:
+  - scores: Array of shape (n, C), overwritten
+  - y: Vector of labels, of shape (n,)
+
+  Returns the loss summed over the n rows.
+  """
+  rows = np.arange(scores.shape[0])
+  correct_class_scores = scores[rows, y]
+  scores -= correct_class_scores[:, np.newaxis]
+  scores += 1.0
+  np.maximum(scores, 0, out=scores)
+  scores[rows, y] = 0
+  loss = np.sum(scores)
+  # The margins are non-negative, so their sign is the indicator margin > 0
+  np.sign(scores, out=scores)
+  scores[rows, y] = -np.sum(scores, axis=1)
+  return loss
+
+
+def softmax_loss_block(scores, y):
+  """
+  Softmax loss of a block of scores. The scores are overwritten with the
+  gradient of the summed loss with respect to them, the class
+  probabilities minus the one-hot labels.
+
+  Inputs:
+  - scores: Array of shape (n, C), overwritten
+  - y: Vector of labels, of shape (n,)
+
+  Returns the loss summed over the n rows.
+  """
+  rows = np.arange(scores.shape[0])
+  scores -= np.max(scores, axis=1, keepdims=True)
+  correct_class_scores = scores[rows, y]
+  np.exp(scores, out=scores)
+  sums = np.sum(scores, axis=1)
+  # -log(p_y) = log(sum_j exp(s_j)) - s_y, which stays finite when p_y
+  # underflows to zero
+  loss = np.sum(np.log(sums) - correct_class_scores)
+  scores /= sums[:, np.newaxis]
+  scores[rows, y] -= 1
+  return loss
+
+
+def blocked_loss(loss_block, x, y, block_size):
+  """
+  Run loss_block over x in blocks of rows, building the gradient in place
+  in dx. Returns the mean loss and dx.
+  """
+  N = x.shape[0]
+  dx = np.empty_like(x)
+  loss = 0.0
+  for i in xrange(0, N, block_size):
+    block = dx[i:i + block_size]
+    block[...] = x[i:i + block_size]
+    loss += loss_block(block, y[i:i + block_size])
+  dx /= N
+  return loss / N, dx
+
+
+def blocked_affine_loss(loss_block, x, w, b, y, block_size, out=None):
+  """
+  Run an affine layer and loss_block over x in blocks of rows. The scores
+  of one block are computed, turned into their gradient and backpropagated
+  through the affine layer before the next block is scored, so the full
+  (N, M) score matrix is never built. If out is given, the gradients are
+  written into its arrays (dx, dw, db).
+  """
+  N = x.shape[0]
+  x2 = x.reshape(N, -1)
+  if out is None:
+    dx = np.empty(x2.shape, dtype=np.result_type(x, w))
+    dw = np.zeros_like(w)
+    db = np.zeros_like(b)
+  else:
+    dx, dw, db = out
+    dx = dx.reshape(x2.shape)
+    dw.fill(0)
+    db.fill(0)
+  loss = 0.0
+  for i in xrange(0, N, block_size):
+    x_block = x2[i:i + block_size]
+    dscores = x_block.dot(w)
+    dscores += b
+    loss += loss_block(dscores, y[i:i + block_size])
+    dscores /= N
+    dw += x_block.T.dot(dscores)
+    db += np.sum(dscores, axis=0)
+    np.dot(dscores, w.T, out=dx[i:i + block_size])
+  return loss / N, dx.reshape(x.shape), dw, db
+
+
+def svm_loss(x, y, block_size=None):
   """
   Computes the loss and gradient using for multiclass SVM classification.
 
@@ -962,25 +1103,17 @@ def svm_loss(x, y):
     for the ith input.
   - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
     0 <= y[i] < C
+  - block_size: Number of rows worked on at a time; defaults to
+    LOSS_BLOCK_SIZE
 
   Returns a tuple of:
   - loss: Scalar giving the loss
   - dx: Gradient of the loss with respect to x
   """
-  N = x.shape[0]
-  correct_class_scores = x[np.arange(N), y]
-  margins = np.maximum(0, x - correct_class_scores[:, np.newaxis] + 1.0)
-  margins[np.arange(N), y] = 0
-  loss = np.sum(margins) / N
-  num_pos = np.sum(margins > 0, axis=1)
-  dx = np.zeros_like(x)
-  dx[margins > 0] = 1
-  dx[np.arange(N), y] -= num_pos
-  dx /= N
-  return loss, dx
+  return blocked_loss(svm_loss_block, x, y, block_size or LOSS_BLOCK_SIZE)
 
 
-def softmax_loss(x, y):
+def softmax_loss(x, y, block_size=None):
   """
   Computes the loss and gradient for softmax classification.
 
@@ -989,16 +1122,57 @@ def softmax_loss(x, y):
     for the ith input.
   - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
     0 <= y[i] < C
+  - block_size: Number of rows worked on at a time; defaults to
+    LOSS_BLOCK_SIZE
 
   Returns a tuple of:
   - loss: Scalar giving the loss
   - dx: Gradient of the loss with respect to x
   """
-  probs = np.exp(x - np.max(x, axis=1, keepdims=True))
-  probs /= np.sum(probs, axis=1, keepdims=True)
-  N = x.shape[0]
-  loss = -np.sum(np.log(probs[np.arange(N), y])) / N
-  dx = probs.copy()
-  dx[np.arange(N), y] -= 1
-  dx /= N
-  return loss, dx
+  return blocked_loss(softmax_loss_block, x, y, block_size or LOSS_BLOCK_SIZE)
+
+
+def affine_svm_loss(x, w, b, y, block_size=None, out=None):
+  """
+  Computes the multiclass SVM loss of the scores of an affine layer, and the
+  gradients with respect to the layer input and parameters, without holding
+  more than block_size rows of scores at a time.
+
+  Inputs:
+  - x: Input to the affine layer, of shape (N, d_1, ..., d_k)
+  - w, b: Weights of shape (D, C) and biases of shape (C,)
+  - y: Vector of labels, of shape (N,)
+  - block_size: Number of rows worked on at a time; defaults to
+    LOSS_BLOCK_SIZE
+  - out: If not None, a tuple of arrays (dx, dw, db) of the shapes and dtype
+    of the gradients, which are written into them
+
+  Returns a tuple of:
+  - loss: Scalar giving the loss
+  - dx, dw, db: Gradients with respect to x, w and b
+  """
+  return blocked_affine_loss(svm_loss_block, x, w, b, y,
+                             block_size or LOSS_BLOCK_SIZE, out)
+
+
+def affine_softmax_loss(x, w, b, y, block_size=None, out=None):
+  """
+  Computes the softmax loss of the scores of an affine layer, and the
+  gradients with respect to the layer input and parameters, without holding
+  more than block_size rows of scores or probabilities at a time.
+
+  Inputs:
+  - x: Input to the affine layer, of shape (N, d_1, ..., d_k)
+  - w, b: Weights of shape (D, C) and biases of shape (C,)
+  - y: Vector of labels, of shape (N,)
+  - block_size: Number of rows worked on at a time; defaults to
+    LOSS_BLOCK_SIZE
+  - out: If not None, a tuple of arrays (dx, dw, db) of the shapes and dtype
+    of the gradients, which are written into them
+
+  Returns a tuple of:
+  - loss: Scalar giving the loss
+  - dx, dw, db: Gradients with respect to x, w and b
+  """
+  return blocked_affine_loss(softmax_loss_block, x, w, b, y,
+                             block_size or LOSS_BLOCK_SIZE, out)
@@ -1,5 +1,7 @@
 import numpy as np
 
+from cs231n.workspace import workspace
+
 """
 This file implements various first-order update rules that are commonly used for
 training neural networks. Each update rule accepts current weights and the
@@ -30,6 +32,45 @@ setting next_w equal to w.
 """
 
 
+class FlatParams(object):
+  """
+  Packs a dictionary of named parameter arrays into one contiguous flat
+  buffer, self.w, along with a flat gradient buffer self.dw. self.params and
+  self.grads map each name to a view of its slice of self.w and self.dw with
+  the original shape. An update rule called once on (self.w, self.dw)
+  updates every parameter in a single vectorized pass, and the state it
+  keeps in its config (velocity, caches, moments) is one flat array as well.
+  """
+
+  def __init__(self, params, dtype=None):
+    names = sorted(params)
+    if dtype is None:
+      dtype = np.result_type(*[params[k] for k in names])
+    size = sum(params[k].size for k in names)
+    self.w = np.empty(size, dtype=dtype)
+    self.dw = np.zeros(size, dtype=dtype)
+    self.params = {}
+    self.grads = {}
+    offset = 0
+    for k in names:
+      v = params[k]
+      self.params[k] = self.w[offset:offset + v.size].reshape(v.shape)
+      self.grads[k] = self.dw[offset:offset + v.size].reshape(v.shape)
+      self.params[k][...] = v
+      offset += v.size
+
+
+  def pack_grads(self, grads):
+    """
+    Copy the dictionary of gradients grads into the flat gradient buffer and
+    return the buffer.
+    """
+    for k, g in self.grads.iteritems():
+      if grads[k] is not g:
+        g[...] = grads[k]
+    return self.dw
+
+
 def sgd(w, dw, config=None):
   """
   Performs vanilla stochastic gradient descent.
@@ -175,6 +216,103 @@ def adam(x, dx, config=None):
 
   return next_x, config
 
+
+def sgd_momentum_inplace(w, dw, config=None):
+  """
+  Performs the same update as sgd_momentum, but in place: the velocity is
+  updated with out= ufuncs, and the only temporary is one scratch array
+  borrowed from the workspace, so no full-size arrays are allocated after
+  the first step.
+
+  config format: as for sgd_momentum.
+  """
+  if config is None: config = {}
+  config.setdefault('learning_rate', 1e-2)
+  config.setdefault('momentum', 0.9)
+  if 'velocity' not in config:
+    config['velocity'] = np.zeros_like(w)
+  v = config['velocity']
+
+  s = workspace.get(w.shape, w.dtype)
+  np.multiply(dw, config['learning_rate'], out=s)
+  v *= config['momentum']
+  v -= s
+  w += v
+  workspace.put(s)
+  return w, config
+
+
+def rmsprop_inplace(x, dx, config=None):
+  """
+  Performs the same update as rmsprop, but in place, with one scratch array
+  borrowed from the workspace as the only temporary.
+
+  config format: as for rmsprop.
+  """
+  if config is None: config = {}
+  config.setdefault('learning_rate', 1e-2)
+  config.setdefault('decay_rate', 0.99)
+  config.setdefault('epsilon', 1e-8)
+  if 'cache' not in config:
+    config['cache'] = np.zeros_like(x)
+  cache, decay_rate = config['cache'], config['decay_rate']
+
+  s = workspace.get(x.shape, x.dtype)
+  np.multiply(dx, dx, out=s)
+  s *= 1 - decay_rate
+  cache *= decay_rate
+  cache += s
+  np.sqrt(cache, out=s)
+  s += config['epsilon']
+  np.divide(dx, s, out=s)
+  s *= config['learning_rate']
+  x -= s
+  workspace.put(s)
+  return x, config
+
+
+def adam_inplace(x, dx, config=None):
+  """
+  Performs the same update as adam, but in place, with one scratch array
+  borrowed from the workspace as the only temporary. The bias correction of
+  the two moments is folded into the scalar step size and into epsilon, so
+  the corrected moments are never formed.
+
+  config format: as for adam.
+  """
+  if config is None: config = {}
+  config.setdefault('learning_rate', 1e-3)
+  config.setdefault('beta1', 0.9)
+  config.setdefault('beta2', 0.999)
+  config.setdefault('epsilon', 1e-8)
+  config.setdefault('t', 0)
+  if 'm' not in config:
+    config['m'] = np.zeros_like(x)
+  if 'v' not in config:
+    config['v'] = np.zeros_like(x)
+  beta1, beta2 = config['beta1'], config['beta2']
+  m, v = config['m'], config['v']
+  config['t'] += 1
+  t = config['t']
+
+  s = workspace.get(x.shape, x.dtype)
+  np.multiply(dx, 1 - beta1, out=s)
+  m *= beta1
+  m += s
+  np.multiply(dx, dx, out=s)
+  s *= 1 - beta2
+  v *= beta2
+  v += s
+
+  alpha = config['learning_rate'] * np.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
+  np.sqrt(v, out=s)
+  s += config['epsilon'] * np.sqrt(1 - beta2 ** t)
+  np.divide(m, s, out=s)
+  s *= alpha
+  x -= s
+  workspace.put(s)
+  return x, config
+
   
   
   
@@ -0,0 +1,135 @@
+"""
+Minibatch sampling for the Solver. random_batches draws every minibatch
+independently with replacement, so some examples are never seen in an
+epoch; epoch_batches walks through a fresh permutation of the training set
+each epoch, so every example is seen exactly once per epoch. Both are
+infinite generators of index arrays that draw from their own RandomState;
+this keeps them deterministic when they run in a background thread next to
+a model that uses the global one.
+
+BatchPrefetcher runs one of these generators in a background thread and
+gathers the next minibatches into a ring of preallocated buffers while the
+model computes the loss on the current one.
+"""
+
+import Queue
+import threading
+
+import numpy as np
+
+
+def random_batches(num_train, batch_size, rng):
+  """
+  Yield arrays of batch_size indices drawn uniformly with replacement from
+  range(num_train).
+  """
+  while True:
+    yield rng.choice(num_train, batch_size)
+
+
+def epoch_batches(y, batch_size, rng, stratify=False):
+  """
+  Yield arrays of batch_size indices into y that go through a new random
+  permutation of range(len(y)) each epoch. The permutations are chained, so
+  when batch_size does not divide len(y) the last batch of an epoch is
+  filled from the start of the next one and every batch has the same size.
+
+  If stratify is True, each permutation interleaves the classes so that
+  every window of consecutive indices, and so every batch, holds the
+  classes in about the same proportions as y: the examples of class c are
+  shuffled and spread evenly over the permutation with a random offset,
+  and the classes are merged by position.
+  """
+  num_train = y.shape[0]
+  if stratify:
+    classes = [np.flatnonzero(y == c) for c in np.unique(y)]
+    keys = np.empty(num_train)
+
+  perm = np.empty(0, dtype=np.intp)
+  while True:
+    if stratify:
+      for idx in classes:
+        n = idx.size
+        keys[rng.permutation(idx)] = (np.arange(n) + rng.rand()) / n
+      next_perm = np.argsort(keys, kind='mergesort')
+    else:
+      next_perm = rng.permutation(num_train)
+    perm = np.concatenate((perm, next_perm))
+    while perm.size >= batch_size:
+      yield perm[:batch_size]
+      perm = perm[batch_size:]
+
+
+class BatchPrefetcher(object):
+  """
+  Gathers minibatches in a background thread. The thread takes index arrays
+  from batches and copies the selected rows of X and y with np.take into a
+  ring of preallocated buffers, up to prefetch batches ahead of the
+  consumer. numpy releases the GIL while it copies, so the gather overlaps
+  with the forward and backward pass.
+
+  The arrays returned by next() are reused: they stay valid until the
+  following call to next(), and after that are overwritten with a later
+  batch.
+  """
+
+  def __init__(self, X, y, batches, batch_size, prefetch=2):
+    # One buffer for the batch the consumer holds and prefetch for the
+    # batches gathered ahead of it
+    num_buffers = prefetch + 1
+    self.X_buffers = [np.empty((batch_size,) + X.shape[1:], dtype=X.dtype)
+                      for _ in xrange(num_buffers)]
+    self.y_buffers = [np.empty(batch_size, dtype=y.dtype)
+                      for _ in xrange(num_buffers)]
+    self.X = X
+    self.y = y
+    self.batches = batches
+
+    # Buffers are passed around by slot number: the free queue holds the
+    # slots the thread may fill and the full queue those ready to be used.
+    # The consumer holds one slot until its next call to next().
+    self.free = Queue.Queue()
+    self.full = Queue.Queue()
+    for slot in xrange(num_buffers):
+      self.free.put(slot)
+    self.current = None
+
+    self.thread = threading.Thread(target=self._fill)
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def _fill(self):
+    try:
+      while True:
+        slot = self.free.get()
+        if slot is None:
+          return
+        idx = next(self.batches)
+        np.take(self.X, idx, axis=0, out=self.X_buffers[slot])
+        np.take(self.y, idx, out=self.y_buffers[slot])
+        self.full.put(slot)
+    except Exception as e:
+      self.full.put(e)
+
+
+  def next(self):
+    """
+    Return the next minibatch as a tuple (X_batch, y_batch).
+    """
+    if self.current is not None:
+      self.free.put(self.current)
+      self.current = None
+    slot = self.full.get()
+    if isinstance(slot, Exception):
+      raise slot
+    self.current = slot
+    return self.X_buffers[slot], self.y_buffers[slot]
+
+
+  def close(self):
+    """
+    Stop the background thread.
+    """
+    self.free.put(None)
+    self.thread.join()
@@ -1,6 +1,8 @@
 import numpy as np
 
 from cs231n import optim
+from cs231n.mixed_precision import LossScaler
+from cs231n.sampler import BatchPrefetcher, epoch_batches, random_batches
 
 
 class Solver(object):
@@ -99,6 +101,26 @@ class Solver(object):
       iterations.
     - verbose: Boolean; if set to false then no output will be printed during
       training.
+    - mixed_precision: Boolean; if true, train the model in mixed precision.
+      The model must support it (it has a loss_scale attribute). Its params
+      are cast to float32 and serve as the master weights, while it keeps its
+      activations in float16. The loss is scaled dynamically; steps whose
+      gradients overflow are skipped.
+    - loss_scale: Initial loss scale for mixed precision. Default is 2 ** 15.
+    - flat_params: Boolean; if true, pack the model params into one contiguous
+      flat buffer (see optim.FlatParams) and replace them with views of it.
+      Each step then copies the gradients into a matching flat buffer and
+      calls the update rule once for the whole model, with a single config
+      whose optimizer state is flat as well.
+    - sampling: How minibatches are drawn from the training data (see
+      sampler.py). 'random' (the default) draws each minibatch independently
+      with replacement; 'epoch' goes through a new permutation of the
+      training data each epoch, so every example is seen once per epoch;
+      'stratified' does the same but keeps the class proportions of every
+      minibatch close to those of y_train.
+    - prefetch: Integer; if positive, gather up to this many minibatches
+      ahead in a background thread into reused buffers while the model
+      computes the loss. Default is 0.
     """
     self.model = model
     self.X_train = data['X_train']
@@ -115,6 +137,11 @@ class Solver(object):
 
     self.print_every = kwargs.pop('print_every', 10)
     self.verbose = kwargs.pop('verbose', True)
+    self.mixed_precision = kwargs.pop('mixed_precision', False)
+    self.loss_scale = kwargs.pop('loss_scale', 2.0 ** 15)
+    self.flat_params = kwargs.pop('flat_params', False)
+    self.sampling = kwargs.pop('sampling', 'random')
+    self.prefetch = kwargs.pop('prefetch', 0)
 
     # Throw an error if there are extra keyword arguments
     if len(kwargs) > 0:
@@ -127,6 +154,14 @@ class Solver(object):
       raise ValueError('Invalid update_rule "%s"' % self.update_rule)
     self.update_rule = getattr(optim, self.update_rule)
 
+    if self.sampling not in ('random', 'epoch', 'stratified'):
+      raise ValueError('Invalid sampling "%s"' % self.sampling)
+
+    if self.mixed_precision:
+      if not hasattr(self.model, 'loss_scale'):
+        raise ValueError('The model does not support mixed precision')
+      self.model.mixed_precision = True
+
     self._reset()
 
 
@@ -143,11 +178,36 @@ class Solver(object):
     self.train_acc_history = []
     self.val_acc_history = []
 
-    # Make a deep copy of the optim_config for each parameter
+    # Unless minibatches are drawn at random on the fly, they come from a
+    # generator of index arrays with its own random state
+    self.batches = None
+    self.prefetcher = None
+    if self.sampling != 'random' or self.prefetch > 0:
+      num_train = self.X_train.shape[0]
+      rng = np.random.RandomState(np.random.randint(2 ** 31 - 1))
+      if self.sampling == 'random':
+        self.batches = random_batches(num_train, self.batch_size, rng)
+      else:
+        self.batches = epoch_batches(self.y_train, self.batch_size, rng,
+                                     stratify=self.sampling == 'stratified')
+
+    # In mixed precision the model params are the float32 master weights
+    if self.mixed_precision:
+      for k, v in self.model.params.iteritems():
+        self.model.params[k] = v.astype(np.float32)
+      self.loss_scaler = LossScaler(self.loss_scale)
+
+    # Make a deep copy of the optim_config for each parameter, or a single
+    # one for the flat buffer that holds them all
     self.optim_configs = {}
-    for p in self.model.params:
-      d = {k: v for k, v in self.optim_config.iteritems()}
-      self.optim_configs[p] = d
+    if self.flat_params:
+      self.flat = optim.FlatParams(self.model.params)
+      self.model.params.update(self.flat.params)
+      self.optim_configs['flat'] = dict(self.optim_config)
+    else:
+      for p in self.model.params:
+        d = {k: v for k, v in self.optim_config.iteritems()}
+        self.optim_configs[p] = d
 
 
   def _step(self):
@@ -156,16 +216,35 @@ class Solver(object):
     be called manually.
     """
     # Make a minibatch of training data
-    num_train = self.X_train.shape[0]
-    batch_mask = np.random.choice(num_train, self.batch_size)
-    X_batch = self.X_train[batch_mask]
-    y_batch = self.y_train[batch_mask]
+    if self.prefetcher is not None:
+      X_batch, y_batch = self.prefetcher.next()
+    else:
+      if self.batches is not None:
+        batch_mask = next(self.batches)
+      else:
+        num_train = self.X_train.shape[0]
+        batch_mask = np.random.choice(num_train, self.batch_size)
+      X_batch = self.X_train[batch_mask]
+      y_batch = self.y_train[batch_mask]
 
     # Compute loss and gradient
+    if self.mixed_precision:
+      self.model.loss_scale = self.loss_scaler.scale
     loss, grads = self.model.loss(X_batch, y_batch)
     self.loss_history.append(loss)
 
+    # Skip the update if the scaled float16 gradients overflowed
+    if self.mixed_precision and not self.loss_scaler.update(grads):
+      return
+
     # Perform a parameter update
+    if self.flat_params:
+      w, dw = self.flat.w, self.flat.pack_grads(grads)
+      config = self.optim_configs['flat']
+      next_w, self.optim_configs['flat'] = self.update_rule(w, dw, config)
+      if next_w is not w:
+        w[...] = next_w
+      return
     for p, w in self.model.params.iteritems():
       dw = grads[p]
       config = self.optim_configs[p]
@@ -227,44 +306,60 @@ class Solver(object):
     iterations_per_epoch = max(num_train / self.batch_size, 1)
     num_iterations = self.num_epochs * iterations_per_epoch
 
-    for t in xrange(num_iterations):
-      self._step()
-
-      # Maybe print training loss
-      if self.verbose and t % self.print_every == 0:
-        print '(Iteration %d / %d) loss: %f' % (
-               t + 1, num_iterations, self.loss_history[-1])
-
-      # At the end of every epoch, increment the epoch counter and decay the
-      # learning rate.
-      epoch_end = (t + 1) % iterations_per_epoch == 0
-      if epoch_end:
-        self.epoch += 1
-        for k in self.optim_configs:
-          self.optim_configs[k]['learning_rate'] *= self.lr_decay
-
-      # Check train and val accuracy on the first iteration, the last
-      # iteration, and at the end of each epoch.
-      first_it = (t == 0)
-      last_it = (t == num_iterations + 1)
-      if first_it or last_it or epoch_end:
-        train_acc = self.check_accuracy(self.X_train, self.y_train,
-                                        num_samples=1000)
-        val_acc = self.check_accuracy(self.X_val, self.y_val)
-        self.train_acc_history.append(train_acc)
-        self.val_acc_history.append(val_acc)
-
-        if self.verbose:
-          print '(Epoch %d / %d) train acc: %f; val_acc: %f' % (
-                 self.epoch, self.num_epochs, train_acc, val_acc)
-
-        # Keep track of the best model
-        if val_acc > self.best_val_acc:
-          self.best_val_acc = val_acc
-          self.best_params = {}
-          for k, v in self.model.params.iteritems():
-            self.best_params[k] = v.copy()
-
-    # At the end of training swap the best params into the model
-    self.model.params = self.best_params
+    # Gather minibatches in the background while training
+    if self.prefetch > 0:
+      self.prefetcher = BatchPrefetcher(self.X_train, self.y_train,
+                                        self.batches, self.batch_size,
+                                        self.prefetch)
+    try:
+      for t in xrange(num_iterations):
+        self._step()
+
+        # Maybe print training loss
+        if self.verbose and t % self.print_every == 0:
+          print '(Iteration %d / %d) loss: %f' % (
+                 t + 1, num_iterations, self.loss_history[-1])
+
+        # At the end of every epoch, increment the epoch counter and decay the
+        # learning rate.
+        epoch_end = (t + 1) % iterations_per_epoch == 0
+        if epoch_end:
+          self.epoch += 1
+          for k in self.optim_configs:
+            self.optim_configs[k]['learning_rate'] *= self.lr_decay
+
+        # Check train and val accuracy on the first iteration, the last
+        # iteration, and at the end of each epoch.
+        first_it = (t == 0)
+        last_it = (t == num_iterations + 1)
+        if first_it or last_it or epoch_end:
+          train_acc = self.check_accuracy(self.X_train, self.y_train,
+                                          num_samples=1000)
+          val_acc = self.check_accuracy(self.X_val, self.y_val)
+          self.train_acc_history.append(train_acc)
+          self.val_acc_history.append(val_acc)
+
+          if self.verbose:
+            print '(Epoch %d / %d) train acc: %f; val_acc: %f' % (
+                   self.epoch, self.num_epochs, train_acc, val_acc)
+
+          # Keep track of the best model
+          if val_acc > self.best_val_acc:
+            self.best_val_acc = val_acc
+            self.best_params = {}
+            for k, v in self.model.params.iteritems():
+              self.best_params[k] = v.copy()
+    finally:
+      if self.prefetcher is not None:
+        self.prefetcher.close()
+        self.prefetcher = None
+
+    # At the end of training swap the best params into the model. With flat
+    # params they are copied into the flat buffer instead, so that the model
+    # params stay views of it and later steps keep updating them.
+    if self.flat_params:
+      for k, v in self.best_params.iteritems():
+        self.flat.params[k][...] = v
+    else:
+      self.model.params = self.best_params
 
@@ -0,0 +1,268 @@
+"""
+Timing comparisons for the fast layers. Each benchmark prints its timings and
+returns them in a dictionary so that they can also be used from a notebook:
+
+from cs231n.benchmark import benchmark_im2col_backends
+benchmark_im2col_backends()
+
+Run all of them with python -m cs231n.benchmark from the assignment directory.
+"""
+
+import resource
+import numpy as np
+from time import time
+
+
+def time_function(f, num_repeats=5):
+  """
+  Return the best wall-clock time in seconds of num_repeats calls to f.
+  """
+  best = float('inf')
+  for _ in xrange(num_repeats):
+    t0 = time()
+    f()
+    best = min(best, time() - t0)
+  return best
+
+
+def benchmark_im2col_backends(x_shape=(100, 3, 31, 31), w_shape=(25, 3, 3, 3),
+                              conv_param=None, num_repeats=5):
+  """
+  Compare the numpy im2col / col2im kernels against the Cython extension
+  (when it has been built) on conv_forward_fast / conv_backward_fast and on
+  the im2col-based convolution.
+
+  Returns a dictionary mapping backend name to a dictionary of timings.
+  """
+  from cs231n import fast_layers
+  from cs231n import im2col_numpy
+
+  if conv_param is None:
+    conv_param = {'stride': 2, 'pad': 1}
+  x = np.random.randn(*x_shape)
+  w = np.random.randn(*w_shape)
+  b = np.random.randn(w_shape[0])
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  pad, stride = conv_param['pad'], conv_param['stride']
+
+  backends = {
+    'numpy': (im2col_numpy.im2col_numpy, im2col_numpy.col2im_numpy,
+              im2col_numpy.col2im_6d_numpy),
+  }
+  try:
+    from cs231n import im2col_cython
+    backends['cython'] = (im2col_cython.im2col_cython,
+                          im2col_cython.col2im_cython,
+                          im2col_cython.col2im_6d_cython)
+  except ImportError:
+    pass
+
+  out, cache = fast_layers.conv_forward_strides(x, w, b, conv_param)
+  dout = np.random.randn(*out.shape)
+  x_cols = cache[-1]
+  dx_cols = w.reshape(F, -1).T.dot(
+      dout.transpose(1, 0, 2, 3).reshape(F, -1))
+  dx_cols.shape = (C, HH, WW) + (N,) + out.shape[2:]
+  dx_cols_2d = np.random.randn(*x_cols.shape)
+
+  results = {}
+  for name, (im2col, col2im, col2im_6d) in sorted(backends.items()):
+    timings = {}
+    timings['im2col'] = time_function(
+        lambda: im2col(x, HH, WW, pad, stride), num_repeats)
+    timings['col2im'] = time_function(
+        lambda: col2im(dx_cols_2d, N, C, H, W, HH, WW, pad, stride),
+        num_repeats)
+    timings['col2im_6d'] = time_function(
+        lambda: col2im_6d(dx_cols, N, C, H, W, HH, WW, pad, stride),
+        num_repeats)
+    results[name] = timings
+
+  print 'im2col backends on x %s, w %s, %s' % (x_shape, w_shape, conv_param)
+  for name in sorted(results):
+    for op in ('im2col', 'col2im', 'col2im_6d'):
+      line = '%-8s %-10s %fs' % (name, op, results[name][op])
+      if name != 'cython' and 'cython' in results:
+        line += ' (%.2fx cython)' % (results[name][op] /
+                                     results['cython'][op])
+      print line
+  return results
+
+
+def benchmark_im2col_threads(x_shape=(64, 32, 32, 32), w_shape=(32, 32, 3, 3),
+                             conv_param=None, thread_counts=(1, 2, 4, 8),
+                             num_repeats=3):
+  """
+  Time the Cython im2col / col2im kernels with different numbers of threads.
+
+  Returns a dictionary mapping thread count to a dictionary of timings, or
+  None if the Cython extension has not been built.
+  """
+  try:
+    from cs231n import im2col_cython
+  except ImportError:
+    print 'The Cython extension has not been built'
+    return None
+
+  if conv_param is None:
+    conv_param = {'stride': 1, 'pad': 1}
+  x = np.random.randn(*x_shape)
+  N, C, H, W = x.shape
+  F, _, HH, WW = w_shape
+  pad, stride = conv_param['pad'], conv_param['stride']
+  cols = im2col_cython.im2col_cython(x, HH, WW, pad, stride)
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+  cols_6d = np.random.randn(C, HH, WW, N, out_h, out_w)
+
+  old_num_threads = im2col_cython.get_num_threads()
+  results = {}
+  try:
+    for num_threads in thread_counts:
+      im2col_cython.set_num_threads(num_threads)
+      timings = {}
+      timings['im2col'] = time_function(
+          lambda: im2col_cython.im2col_cython(x, HH, WW, pad, stride),
+          num_repeats)
+      timings['col2im'] = time_function(
+          lambda: im2col_cython.col2im_cython(cols, N, C, H, W, HH, WW, pad,
+                                              stride), num_repeats)
+      timings['col2im_6d'] = time_function(
+          lambda: im2col_cython.col2im_6d_cython(cols_6d, N, C, H, W, HH, WW,
+                                                 pad, stride), num_repeats)
+      results[num_threads] = timings
+  finally:
+    im2col_cython.set_num_threads(old_num_threads)
+
+  print 'im2col threads on x %s, w %s, %s' % (x_shape, w_shape, conv_param)
+  base = results[thread_counts[0]]
+  for num_threads in thread_counts:
+    for op in ('im2col', 'col2im', 'col2im_6d'):
+      print '%2d threads %-10s %fs (%.2fx)' % (
+          num_threads, op, results[num_threads][op],
+          base[op] / results[num_threads][op])
+  return results
+
+
+def benchmark_conv_algorithms(x_shape=(50, 32, 32, 32), w_shape=(32, 32, 3, 3),
+                              conv_param=None, num_repeats=3):
+  """
+  Time the forward and backward pass of every convolution algorithm
+  registered in fast_layers.conv_algorithms on a single layer, and report
+  which one the autotuner picks.
+
+  x_shape is given in NCHW order. Algorithms that work on NHWC data are
+  timed on the transposed input and upstream gradient, and only algorithms
+  that match whether the layer is grouped are timed, as in autotune_conv.
+
+  Returns a dictionary mapping algorithm name to (forward, backward) seconds.
+  """
+  from cs231n import fast_layers
+
+  if conv_param is None:
+    conv_param = {'stride': 1, 'pad': 1}
+  stride, pad = conv_param['stride'], conv_param['pad']
+  N, C, H, W = x_shape
+  F, _, HH, WW = w_shape
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+  x = np.random.randn(*x_shape)
+  w = np.random.randn(*w_shape)
+  b = np.random.randn(F)
+  dout = np.random.randn(N, F, out_h, out_w)
+  inputs = {
+    'NCHW': (x, dout),
+    'NHWC': (x.transpose(0, 2, 3, 1).copy(), dout.transpose(0, 2, 3, 1).copy()),
+  }
+  grouped = fast_layers.conv_groups(conv_param) > 1
+
+  results = {}
+  for name in sorted(fast_layers.conv_algorithms):
+    forward, backward, supports = fast_layers.conv_algorithms[name]
+    if fast_layers.conv_algorithm_grouped[name] != grouped:
+      continue
+    layout = fast_layers.conv_algorithm_layouts[name]
+    param = dict(conv_param, layout=layout)
+    x_l, dout_l = inputs[layout]
+    if not supports(x_l.shape, w.shape, param):
+      continue
+    _, cache = forward(x_l, w, b, param)
+    t_forward = time_function(lambda: forward(x_l, w, b, param), num_repeats)
+    t_backward = time_function(lambda: backward(dout_l, cache), num_repeats)
+    results[name] = (t_forward, t_backward)
+
+  print 'conv algorithms on x %s, w %s, %s' % (x_shape, w_shape, conv_param)
+  for name in sorted(results):
+    print '%-10s forward %fs backward %fs' % ((name,) + results[name])
+  x_l = inputs[fast_layers.conv_layout(conv_param)][0]
+  print 'autotuner picks: %s' % fast_layers.autotune_conv(x_l, w, b, conv_param)
+  return results
+
+
+def benchmark_workspace(x_shape=(50, 16, 32, 32), w_shape=(16, 16, 3, 3),
+                        conv_param=None, num_iterations=10):
+  """
+  Run forward and backward passes of conv_forward_strides with the workspace
+  enabled and disabled, and report the time per iteration, the hit rate of
+  the workspace and the number of page faults per iteration. Every page of a
+  fresh large allocation faults the first time it is written, so the page
+  faults count the memory that was newly allocated; the timings are noisy
+  when the allocator caches freed memory itself.
+
+  Returns a dictionary mapping 'pooled' and 'unpooled' to seconds per
+  iteration, 'pooled_faults' and 'unpooled_faults' to page faults per
+  iteration, and 'stats' to the workspace counters.
+  """
+  from cs231n import fast_layers
+  from cs231n.workspace import workspace
+
+  if conv_param is None:
+    conv_param = {'stride': 1, 'pad': 1}
+  x = np.random.randn(*x_shape)
+  w = np.random.randn(*w_shape)
+  b = np.random.randn(w_shape[0])
+  out, _ = fast_layers.conv_forward_strides(x, w, b, conv_param)
+  dout = np.random.randn(*out.shape)
+
+  def step():
+    _, cache = fast_layers.conv_forward_strides(x, w, b, conv_param)
+    fast_layers.conv_backward_strides(dout, cache)
+
+  def page_faults():
+    step()
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    for _ in xrange(num_iterations):
+      step()
+    end = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    return float(end - start) / num_iterations
+
+  max_bytes = workspace.max_bytes
+  results = {}
+  try:
+    workspace.max_bytes = 0
+    workspace.clear()
+    results['unpooled'] = time_function(step, num_iterations)
+    results['unpooled_faults'] = page_faults()
+    workspace.max_bytes = max_bytes
+    step()
+    workspace.reset_stats()
+    results['pooled'] = time_function(step, num_iterations)
+    results['stats'] = workspace.stats()
+    results['pooled_faults'] = page_faults()
+  finally:
+    workspace.max_bytes = max_bytes
+
+  print 'workspace on x %s, w %s, %s' % (x_shape, w_shape, conv_param)
+  print 'unpooled %fs pooled %fs hit rate %.2f' % (
+      results['unpooled'], results['pooled'], results['stats']['hit_rate'])
+  print 'page faults per iteration: unpooled %.0f pooled %.0f' % (
+      results['unpooled_faults'], results['pooled_faults'])
+  return results
+
+
+if __name__ == '__main__':
+  benchmark_im2col_backends()
+  benchmark_im2col_threads()
+  benchmark_conv_algorithms()
+  benchmark_workspace()
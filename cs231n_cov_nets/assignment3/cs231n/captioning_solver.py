@@ -1,6 +1,7 @@
 import numpy as np
 
 from cs231n import optim
+from cs231n.mixed_precision import LossScaler
 from cs231n.coco_utils import sample_coco_minibatch
 
 
@@ -85,6 +86,17 @@ class CaptioningSolver(object):
       iterations.
     - verbose: Boolean; if set to false then no output will be printed during
       training.
+    - mixed_precision: Boolean; if true, train the model in mixed precision.
+      The model must support it (it has a loss_scale attribute). Its params
+      are cast to float32 and serve as the master weights, while it keeps its
+      activations in float16. The loss is scaled dynamically; steps whose
+      gradients overflow are skipped.
+    - loss_scale: Initial loss scale for mixed precision. Default is 2 ** 15.
+    - flat_params: Boolean; if true, pack the model params into one contiguous
+      flat buffer (see optim.FlatParams) and replace them with views of it.
+      Each step then copies the gradients into a matching flat buffer and
+      calls the update rule once for the whole model, with a single config
+      whose optimizer state is flat as well.
     """
     self.model = model
     self.data = data
@@ -98,6 +110,9 @@ class CaptioningSolver(object):
 
     self.print_every = kwargs.pop('print_every', 10)
     self.verbose = kwargs.pop('verbose', True)
+    self.mixed_precision = kwargs.pop('mixed_precision', False)
+    self.loss_scale = kwargs.pop('loss_scale', 2.0 ** 15)
+    self.flat_params = kwargs.pop('flat_params', False)
 
     # Throw an error if there are extra keyword arguments
     if len(kwargs) > 0:
@@ -110,6 +125,11 @@ class CaptioningSolver(object):
       raise ValueError('Invalid update_rule "%s"' % self.update_rule)
     self.update_rule = getattr(optim, self.update_rule)
 
+    if self.mixed_precision:
+      if not hasattr(self.model, 'loss_scale'):
+        raise ValueError('The model does not support mixed precision')
+      self.model.mixed_precision = True
+
     self._reset()
 
 
@@ -126,11 +146,23 @@ class CaptioningSolver(object):
     self.train_acc_history = []
     self.val_acc_history = []
 
-    # Make a deep copy of the optim_config for each parameter
+    # In mixed precision the model params are the float32 master weights
+    if self.mixed_precision:
+      for k, v in self.model.params.iteritems():
+        self.model.params[k] = v.astype(np.float32)
+      self.loss_scaler = LossScaler(self.loss_scale)
+
+    # Make a deep copy of the optim_config for each parameter, or a single
+    # one for the flat buffer that holds them all
     self.optim_configs = {}
-    for p in self.model.params:
-      d = {k: v for k, v in self.optim_config.iteritems()}
-      self.optim_configs[p] = d
+    if self.flat_params:
+      self.flat = optim.FlatParams(self.model.params)
+      self.model.params.update(self.flat.params)
+      self.optim_configs['flat'] = dict(self.optim_config)
+    else:
+      for p in self.model.params:
+        d = {k: v for k, v in self.optim_config.iteritems()}
+        self.optim_configs[p] = d
 
 
   def _step(self):
@@ -145,10 +177,23 @@ class CaptioningSolver(object):
     captions, features, urls = minibatch
 
     # Compute loss and gradient
+    if self.mixed_precision:
+      self.model.loss_scale = self.loss_scaler.scale
     loss, grads = self.model.loss(features, captions)
     self.loss_history.append(loss)
 
+    # Skip the update if the scaled float16 gradients overflowed
+    if self.mixed_precision and not self.loss_scaler.update(grads):
+      return
+
     # Perform a parameter update
+    if self.flat_params:
+      w, dw = self.flat.w, self.flat.pack_grads(grads)
+      config = self.optim_configs['flat']
+      next_w, self.optim_configs['flat'] = self.update_rule(w, dw, config)
+      if next_w is not w:
+        w[...] = next_w
+      return
     for p, w in self.model.params.iteritems():
       dw = grads[p]
       config = self.optim_configs[p]
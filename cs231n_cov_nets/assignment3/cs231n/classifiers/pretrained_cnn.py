@@ -1,17 +1,36 @@
+import copy
+
 import numpy as np
 import h5py
 
 from cs231n.layers import *
 from cs231n.fast_layers import *
 from cs231n.layer_utils import *
+from cs231n.quantization import *
 
 
 class PretrainedCNN(object):
-  def __init__(self, dtype=np.float32, num_classes=100, input_size=64, h5_file=None):
+  def __init__(self, dtype=np.float32, num_classes=100, input_size=64, h5_file=None,
+               checkpoint_every=None):
+    """
+    Inputs:
+    - dtype: numpy datatype to use for computation.
+    - num_classes: Number of scores to produce from the final affine layer.
+    - input_size: Height and width of the input images.
+    - h5_file: If not None, path to an HDF5 file of pretrained weights.
+    - checkpoint_every: If not None, forward keeps only the input of every
+      checkpoint_every-th layer instead of the caches of all layers, and
+      backward recomputes each segment of layers from its stored input just
+      before running it backward. This trades roughly one extra forward pass
+      for memory; with checkpoint_every around sqrt(11) only a few layers'
+      caches are alive at once. Can also be changed after construction.
+    """
     self.dtype = dtype
+    self.checkpoint_every = checkpoint_every
     self.conv_params = []
     self.input_size = input_size
     self.num_classes = num_classes
+    self.use_batchnorm = True
     
     # TODO: In the future it would be nice if the architecture could be loaded from
     # the HDF5 file rather than being hardcoded. For now this will have to do.
@@ -117,6 +136,9 @@ class PretrainedCNN(object):
     [affine - batchnorm - relu] (There is one of these)
     [affine] (There is one of these)
 
+    In a model returned by freeze() the batchnorms are folded away and the
+    first two kinds of layer are [conv - relu] and [affine - relu].
+
     Inputs:
     - X: The input to the starting layer. If start=0, then this should be an
       array of shape (N, C, 64, 64).
@@ -130,47 +152,71 @@ class PretrainedCNN(object):
     Returns:
     - out: Output from the end layer.
     - cache: A cache object that can be passed to the backward method to run the
-      network backward over the same range of layers.
+      network backward over the same range of layers. With checkpoint_every
+      set it holds only the inputs of the checkpointed layers.
     """
     X = X.astype(self.dtype)
     if start is None: start = 0
     if end is None: end = len(self.conv_params) + 1
+    checkpoint = self.checkpoint_every
     layer_caches = []
+    checkpoints = []
 
     prev_a = X
     for i in xrange(start, end + 1):
-      i1 = i + 1
-      if 0 <= i < len(self.conv_params):
-        # This is a conv layer
-        w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
-        conv_param = self.conv_params[i]
-        bn_param = self.bn_params[i]
-        bn_param['mode'] = mode
-
-        next_a, cache = conv_bn_relu_forward(prev_a, w, b, gamma, beta, conv_param, bn_param)
-      elif i == len(self.conv_params):
-        # This is the fully-connected hidden layer
-        w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
-        bn_param = self.bn_params[i]
-        bn_param['mode'] = mode
-        next_a, cache = affine_bn_relu_forward(prev_a, w, b, gamma, beta, bn_param)
-      elif i == len(self.conv_params) + 1:
-        # This is the last fully-connected layer that produces scores
-        w, b = self.params['W%d' % i1], self.params['b%d' % i1]
-        next_a, cache = affine_forward(prev_a, w, b)
+      if checkpoint:
+        if (i - start) % checkpoint == 0:
+          checkpoints.append(prev_a)
+        next_a, _ = self.layer_forward(i, prev_a, mode)
+        layer_caches.append(None)
       else:
-        raise ValueError('Invalid layer index %d' % i)
-
-      layer_caches.append(cache)
+        next_a, cache = self.layer_forward(i, prev_a, mode)
+        layer_caches.append(cache)
       prev_a = next_a
 
     out = prev_a
-    cache = (start, end, layer_caches)
+    cache = (start, end, mode, layer_caches, checkpoints)
     return out, cache
 
 
+  def layer_forward(self, i, x, mode, bn_param=None):
+    """
+    Run the single layer i forward; see forward for the layer numbering.
+    bn_param overrides self.bn_params[i], which lets backward recompute a
+    layer without updating the running averages a second time.
+
+    Returns a tuple of:
+    - out: Output from layer i
+    - cache: Object to give to layer_backward
+    """
+    i1 = i + 1
+    if 0 <= i < len(self.conv_params):
+      # This is a conv layer
+      w, b = self.params['W%d' % i1], self.params['b%d' % i1]
+      conv_param = self.conv_params[i]
+      if not self.use_batchnorm:
+        return conv_relu_forward(x, w, b, conv_param)
+      gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
+      if bn_param is None: bn_param = self.bn_params[i]
+      bn_param['mode'] = mode
+      return conv_bn_relu_forward(x, w, b, gamma, beta, conv_param, bn_param)
+    elif i == len(self.conv_params):
+      # This is the fully-connected hidden layer
+      w, b = self.params['W%d' % i1], self.params['b%d' % i1]
+      if not self.use_batchnorm:
+        return affine_relu_forward(x, w, b)
+      gamma, beta = self.params['gamma%d' % i1], self.params['beta%d' % i1]
+      if bn_param is None: bn_param = self.bn_params[i]
+      bn_param['mode'] = mode
+      return affine_bn_relu_forward(x, w, b, gamma, beta, bn_param)
+    elif i == len(self.conv_params) + 1:
+      # This is the last fully-connected layer that produces scores
+      w, b = self.params['W%d' % i1], self.params['b%d' % i1]
+      return affine_forward(x, w, b)
+    else:
+      raise ValueError('Invalid layer index %d' % i)
+
+
   def backward(self, dout, cache):
     """
     Run the model backward over a sequence of layers that were previously run
@@ -191,38 +237,58 @@ class PretrainedCNN(object):
       layers. The grads dictionary will therefore contain a subset of the keys
       of self.params, and grads[k] and self.params[k] will have the same shape.
     """
-    start, end, layer_caches = cache
+    start, end, mode, layer_caches, checkpoints = cache
+    checkpoint = self.checkpoint_every
     dnext_a = dout
     grads = {}
     for i in reversed(range(start, end + 1)):
-      i1 = i + 1
-      if i == len(self.conv_params) + 1:
-        # This is the last fully-connected layer
-        dprev_a, dw, db = affine_backward(dnext_a, layer_caches.pop())
-        grads['W%d' % i1] = dw
-        grads['b%d' % i1] = db
-      elif i == len(self.conv_params):
-        # This is the fully-connected hidden layer
-        temp = affine_bn_relu_backward(dnext_a, layer_caches.pop())
-        dprev_a, dw, db, dgamma, dbeta = temp
-        grads['W%d' % i1] = dw
-        grads['b%d' % i1] = db
+      if layer_caches[i - start] is None:
+        # Recompute the segment that ends at layer i from its checkpoint.
+        # The copied bn_params keep the running averages from being updated
+        # twice; in train mode the batch statistics come out the same.
+        seg = (i - start) / checkpoint
+        a = checkpoints.pop(seg)
+        for j in xrange(start + seg * checkpoint, i + 1):
+          bn_param = None
+          if self.use_batchnorm and j < len(self.bn_params):
+            bn_param = copy.deepcopy(self.bn_params[j])
+          a, layer_caches[j - start] = self.layer_forward(j, a, mode, bn_param)
+      dnext_a = self.layer_backward(i, dnext_a, layer_caches.pop(), grads)
+
+    dX = dnext_a
+    return dX, grads
+
+
+  def layer_backward(self, i, dout, cache, grads):
+    """
+    Run the single layer i backward, storing the gradients of its parameters
+    in grads. Returns the gradient with respect to the input of layer i.
+    """
+    i1 = i + 1
+    if i == len(self.conv_params) + 1:
+      # This is the last fully-connected layer
+      dx, dw, db = affine_backward(dout, cache)
+    elif i == len(self.conv_params):
+      # This is the fully-connected hidden layer
+      if not self.use_batchnorm:
+        dx, dw, db = affine_relu_backward(dout, cache)
+      else:
+        dx, dw, db, dgamma, dbeta = affine_bn_relu_backward(dout, cache)
         grads['gamma%d' % i1] = dgamma
         grads['beta%d' % i1] = dbeta
-      elif 0 <= i < len(self.conv_params):
-        # This is a conv layer
-        temp = conv_bn_relu_backward(dnext_a, layer_caches.pop())
-        dprev_a, dw, db, dgamma, dbeta = temp
-        grads['W%d' % i1] = dw
-        grads['b%d' % i1] = db
+    elif 0 <= i < len(self.conv_params):
+      # This is a conv layer
+      if not self.use_batchnorm:
+        dx, dw, db = conv_relu_backward(dout, cache)
+      else:
+        dx, dw, db, dgamma, dbeta = conv_bn_relu_backward(dout, cache)
         grads['gamma%d' % i1] = dgamma
         grads['beta%d' % i1] = dbeta
-      else:
-        raise ValueError('Invalid layer index %d' % i)
-      dnext_a = dprev_a
-
-    dX = dnext_a
-    return dX, grads
+    else:
+      raise ValueError('Invalid layer index %d' % i)
+    grads['W%d' % i1] = dw
+    grads['b%d' % i1] = db
+    return dx
 
 
   def loss(self, X, y=None):
@@ -250,3 +316,172 @@ class PretrainedCNN(object):
     dX, grads = self.backward(dscores, cache)
     return loss, grads
 
+
+  def freeze(self):
+    """
+    Return an inference-only copy of the model in which every spatial and
+    vanilla batchnorm has been folded into the conv or affine layer before it
+    using the running statistics (see batchnorm_fold). The copy has no gamma
+    or beta parameters and no bn_params, and its loss(X) gives the same
+    scores as test mode here without any batchnorm passes.
+    """
+    model = copy.copy(self)
+    model.params = {}
+    for k, v in self.params.iteritems():
+      if not (k.startswith('gamma') or k.startswith('beta')):
+        model.params[k] = v.copy()
+    if self.use_batchnorm:
+      for i, bn_param in enumerate(self.bn_params):
+        i1 = i + 1
+        w, b = batchnorm_fold(self.params['W%d' % i1], self.params['b%d' % i1],
+                              self.params['gamma%d' % i1],
+                              self.params['beta%d' % i1], bn_param)
+        model.params['W%d' % i1], model.params['b%d' % i1] = w, b
+    model.use_batchnorm = False
+    model.bn_params = []
+    return model
+
+
+  def quantize(self, X_calib, batch_size=50):
+    """
+    Build an int8 copy of the model for inference by post-training
+    quantization. The batchnorms are folded first (see freeze), then the
+    weights of every conv and affine layer are quantized per output channel
+    and the input of every layer is given a per-tensor scale from the range
+    it takes when the calibration images are run through the folded model.
+
+    Inputs:
+    - X_calib: Array of shape (N, 3, 64, 64) of calibration images; a few
+      hundred images like the ones the model will be run on are enough.
+    - batch_size: Number of calibration images to run at a time.
+
+    Returns a QuantizedPretrainedCNN.
+    """
+    model = self.freeze()
+    num_layers = len(model.conv_params) + 2
+    lo = [np.inf] * num_layers
+    hi = [-np.inf] * num_layers
+    for i in xrange(0, X_calib.shape[0], batch_size):
+      a = X_calib[i:i + batch_size].astype(self.dtype)
+      for j in xrange(num_layers):
+        lo[j] = min(lo[j], a.min())
+        hi[j] = max(hi[j], a.max())
+        a, _ = model.layer_forward(j, a, 'test')
+
+    qmodel = QuantizedPretrainedCNN()
+    qmodel.conv_params = [dict(p) for p in model.conv_params]
+    for j in xrange(num_layers):
+      j1 = j + 1
+      axis = 0 if j < len(model.conv_params) else 1
+      w_q, w_scale = quantize_weights(model.params['W%d' % j1], axis)
+      x_scale, x_dtype = activation_scale(lo[j], hi[j])
+      qmodel.params['W%d' % j1] = w_q
+      qmodel.params['w_scale%d' % j1] = w_scale
+      qmodel.params['b%d' % j1] = model.params['b%d' % j1].astype(np.float32)
+      qmodel.x_scales.append(x_scale)
+      qmodel.x_dtypes.append(x_dtype)
+    return qmodel
+
+
+class QuantizedPretrainedCNN(object):
+  """
+  Int8 inference-only version of PretrainedCNN, built by
+  PretrainedCNN.quantize or loaded from a file written by save.
+
+  The weights are int8 with a float32 scale per output channel, and the
+  activations passed between layers are uint8 (the input images are int8)
+  with one scale per layer. Conv and affine layers accumulate in int32 and
+  requantize their output for the next layer, so float activations are only
+  formed for the output of the last layer run. The layers are the same as
+  those of a frozen PretrainedCNN: [conv - relu] x 9, [affine - relu] and
+  [affine].
+  """
+
+  def __init__(self, h5_file=None):
+    """
+    Inputs:
+    - h5_file: If not None, path to an HDF5 file written by save.
+    """
+    self.conv_params = []
+    self.params = {}
+    self.x_scales = []
+    self.x_dtypes = []
+    if h5_file is not None:
+      self.load(h5_file)
+
+
+  def save(self, h5_file):
+    """
+    Save the quantized model to an HDF5 file. The weights are stored as int8,
+    so the file is about a quarter of the size of the float32 weights.
+    """
+    with h5py.File(h5_file, 'w') as f:
+      for k, v in self.params.iteritems():
+        f.create_dataset(k, data=v)
+      f.attrs['conv_stride'] = [p['stride'] for p in self.conv_params]
+      f.attrs['conv_pad'] = [p['pad'] for p in self.conv_params]
+      f.attrs['x_scales'] = np.array(self.x_scales, dtype=np.float32)
+      f.attrs['x_signed'] = [d == np.int8 for d in self.x_dtypes]
+
+
+  def load(self, h5_file):
+    """
+    Load a quantized model written by save.
+    """
+    with h5py.File(h5_file, 'r') as f:
+      self.params = dict((k, np.asarray(v)) for k, v in f.iteritems())
+      self.conv_params = [{'stride': int(s), 'pad': int(p)} for s, p in
+                          zip(f.attrs['conv_stride'], f.attrs['conv_pad'])]
+      self.x_scales = list(f.attrs['x_scales'])
+      self.x_dtypes = [np.int8 if s else np.uint8 for s in f.attrs['x_signed']]
+
+
+  def forward(self, X, start=None, end=None):
+    """
+    Run part of the model forward, starting and ending at an arbitrary layer;
+    see PretrainedCNN.forward for the layer numbering.
+
+    Inputs:
+    - X: Float input to the starting layer. If start=0, then this should be
+      an array of shape (N, C, 64, 64).
+    - start: The index of the layer to start from. Default is 0.
+    - end: The index of the layer to end at. Default is 11.
+
+    Returns:
+    - out: float32 output from the end layer.
+    """
+    if start is None: start = 0
+    if end is None: end = len(self.conv_params) + 1
+    a = quantize(X, self.x_scales[start], self.x_dtypes[start])
+    for i in xrange(start, end + 1):
+      out_scale = self.x_scales[i + 1] if i < end else None
+      a = self.layer_forward(i, a, out_scale)
+    return a
+
+
+  def layer_forward(self, i, x_q, out_scale=None):
+    """
+    Run the single layer i forward on the quantized input x_q. If out_scale
+    is None the output is returned as float32; otherwise it is quantized
+    with that scale, as the input of layer i + 1.
+    """
+    i1 = i + 1
+    w_q, b = self.params['W%d' % i1], self.params['b%d' % i1]
+    scale = self.x_scales[i] * self.params['w_scale%d' % i1]
+    if 0 <= i < len(self.conv_params):
+      return conv_forward_int8(x_q, w_q, scale, b, self.conv_params[i],
+                               out_scale)
+    elif i == len(self.conv_params):
+      return affine_forward_int8(x_q, w_q, scale, b, out_scale)
+    elif i == len(self.conv_params) + 1:
+      return affine_forward_int8(x_q, w_q, scale, b, out_scale, relu=False)
+    else:
+      raise ValueError('Invalid layer index %d' % i)
+
+
+  def loss(self, X):
+    """
+    Compute class scores for the images in X, an array of shape
+    (N, 3, 64, 64). Returns an array of shape (N, 100).
+    """
+    return self.forward(X)
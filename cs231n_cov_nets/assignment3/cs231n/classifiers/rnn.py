@@ -2,6 +2,7 @@ import numpy as np
 
 from cs231n.layers import *
 from cs231n.rnn_layers import *
+from cs231n.mixed_precision import *
 
 
 class CaptioningRNN(object):
@@ -17,7 +18,8 @@ class CaptioningRNN(object):
   """
   
   def __init__(self, word_to_idx, input_dim=512, wordvec_dim=128,
-               hidden_dim=128, cell_type='rnn', dtype=np.float32):
+               hidden_dim=128, cell_type='rnn', dtype=np.float32,
+               mixed_precision=False):
     """
     Construct a new CaptioningRNN instance.
 
@@ -30,12 +32,19 @@ class CaptioningRNN(object):
     - cell_type: What type of RNN to use; either 'rnn' or 'lstm'.
     - dtype: numpy datatype to use; use float32 for training and float64 for
       numeric gradient checking.
+    - mixed_precision: If True, loss stores activations, caches and the
+      gradients passed between layers in float16 while every layer computes
+      in float32 (see cs231n/mixed_precision.py). The params stay in dtype,
+      which should then be float32. The upstream gradient is multiplied by
+      self.loss_scale and the parameter gradients are divided by it again.
     """
     if cell_type not in {'rnn', 'lstm'}:
       raise ValueError('Invalid cell_type "%s"' % cell_type)
     
     self.cell_type = cell_type
     self.dtype = dtype
+    self.mixed_precision = mixed_precision
+    self.loss_scale = 1.0
     self.word_to_idx = word_to_idx
     self.idx_to_word = {i: w for w, i in word_to_idx.iteritems()}
     self.params = {}
@@ -114,6 +123,9 @@ class CaptioningRNN(object):
     W_vocab, b_vocab = self.params['W_vocab'], self.params['b_vocab']
     
     loss, grads = 0.0, {}
+    forward, backward = layer_runners(self.mixed_precision)
+    if self.mixed_precision:
+      features = features.astype(np.float16)
     ############################################################################
     # TODO: Implement the forward and backward passes for the CaptioningRNN.   #
     # In the forward pass you will need to do the following:                   #
@@ -137,22 +149,24 @@ class CaptioningRNN(object):
     ############################################################################
     
     # Step 1 
-    affine_first, affine_first_cache = affine_forward(features, W_proj, b_proj)
+    affine_first, affine_first_cache = forward(affine_forward, features, W_proj, b_proj)
     
     # Step 2
-    word_forward, embedding_cache = word_embedding_forward(captions_in, W_embed)
+    word_forward, embedding_cache = forward(word_embedding_forward, captions_in, W_embed)
 
     # Step 3
     if self.cell_type == 'rnn':
-        rnn_NTH, rnn_lstm_cache = rnn_forward(word_forward, affine_first, Wx, Wh, b)
+        rnn_NTH, rnn_lstm_cache = forward(rnn_forward, word_forward, affine_first, Wx, Wh, b)
     else:
-        rnn_NTH, rnn_lstm_cache = lstm_forward(word_forward, affine_first, Wx, Wh, b)
+        rnn_NTH, rnn_lstm_cache = forward(lstm_forward, word_forward, affine_first, Wx, Wh, b)
 
     # Step 4 
-    affine_second, affine_second_cache = temporal_affine_forward(rnn_NTH, W_vocab, b_vocab )
+    affine_second, affine_second_cache = forward(temporal_affine_forward, rnn_NTH, W_vocab, b_vocab )
 
     # Step 5
-    loss, dout = temporal_softmax_loss(affine_second, captions_out, mask)
+    loss, dout = temporal_softmax_loss(to_float(affine_second), captions_out, mask)
+    if self.mixed_precision:
+        dout = to_half(dout * self.loss_scale)
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
@@ -162,24 +176,27 @@ class CaptioningRNN(object):
     grads = {}
 
     # step 4 back
-    affine_back2, dW_vocab, db_vocab = temporal_affine_backward(dout, affine_second_cache)
+    affine_back2, dW_vocab, db_vocab = backward(temporal_affine_backward, dout, affine_second_cache)
 
     # Step 3 back
     if self.cell_type == 'rnn':
-        dx, dh0, dWx, dWh, db = rnn_backward(affine_back2, rnn_lstm_cache)
+        dx, dh0, dWx, dWh, db = backward(rnn_backward, affine_back2, rnn_lstm_cache)
     else:
-        dx, dh0, dWx, dWh, db = lstm_backward(affine_back2, rnn_lstm_cache)
+        dx, dh0, dWx, dWh, db = backward(lstm_backward, affine_back2, rnn_lstm_cache)
 
     # Step 2 back
-    dW_embed = word_embedding_backward(dx, embedding_cache)
+    dW_embed = backward(word_embedding_backward, dx, embedding_cache)
 
     # Step 1 back
-    abc, dW_proj, db_proj = affine_backward(dh0, affine_first_cache)
+    abc, dW_proj, db_proj = backward(affine_backward, dh0, affine_first_cache)
 
     grads["W_vocab"], grads["b_vocab"] = dW_vocab, db_vocab
     grads["W_proj"], grads["b_proj"] = dW_proj, db_proj
     grads["W_embed"] = dW_embed
     grads["Wx"], grads["Wh"], grads["b"] = dWx, dWh, db
+    if self.mixed_precision:
+        for k in grads:
+            grads[k] /= self.loss_scale
     return loss, grads
 
 
@@ -1,6 +1,12 @@
+import multiprocessing
+import os
+
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel cimport prange
+
+from cs231n.workspace import workspace
 
 # DTYPE = np.float64
 # ctypedef np.float64_t DTYPE_t
@@ -9,113 +15,188 @@ ctypedef fused DTYPE_t:
     np.float32_t
     np.float64_t
 
+def default_num_threads():
+    """
+    Return the number of threads given by the first field of
+    OMP_NUM_THREADS (which may list one count per nesting level, as in
+    "4,2"), or the number of cores if it is unset or not a positive integer.
+    """
+    value = os.environ.get('OMP_NUM_THREADS', '').split(',')[0]
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        n = multiprocessing.cpu_count()
+    return n
+
+
+# The kernels below release the GIL and split their outer loop across this
+# many OpenMP threads. It defaults to OMP_NUM_THREADS, or to the number of
+# cores if that is not set. If the extension was built without OpenMP the
+# loops simply run on one thread.
+cdef int num_threads = default_num_threads()
+
+
+def set_num_threads(int n):
+    """
+    Set the number of threads used by the im2col / col2im kernels.
+    """
+    global num_threads
+    if n < 1:
+        raise ValueError('num_threads must be positive, got %d' % n)
+    num_threads = n
+
+
+def get_num_threads():
+    return num_threads
+
+
 def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
                   int field_width, int padding, int stride):
     cdef int N = x.shape[0]
     cdef int C = x.shape[1]
     cdef int H = x.shape[2]
     cdef int W = x.shape[3]
-    
+
     cdef int HH = (H + 2 * padding - field_height) / stride + 1
     cdef int WW = (W + 2 * padding - field_width) / stride + 1
 
-    cdef int p = padding
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.pad(x,
-            ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+    cdef np.ndarray[DTYPE_t, ndim=4] x_padded
+    if padding > 0:
+        x_padded = workspace.pad(x, padding)
+    else:
+        x_padded = np.ascontiguousarray(x)
 
-    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.zeros(
+    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.empty(
             (C * field_height * field_width, N * HH * WW),
             dtype=x.dtype)
 
-    # Moving the inner loop to a C function with no bounds checking works, but does
-    # not seem to help performance in any measurable way.
-
-    im2col_cython_inner(cols, x_padded, N, C, H, W, HH, WW,
-                        field_height, field_width, padding, stride)
+    cdef DTYPE_t[:, ::1] cols_view = cols
+    cdef DTYPE_t[:, :, :, ::1] x_view = x_padded
+    with nogil:
+        im2col_cython_inner(cols_view, x_view, N, C, HH, WW,
+                            field_height, field_width, stride)
+    if padding > 0:
+        workspace.put(x_padded)
     return cols
 
 
 @cython.boundscheck(False)
-cdef int im2col_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void im2col_cython_inner(DTYPE_t[:, ::1] cols,
+                              DTYPE_t[:, :, :, ::1] x_padded,
+                              int N, int C, int HH, int WW,
+                              int field_height, int field_width,
+                              int stride) nogil:
+    # Each thread fills whole rows of cols, one (c, ii, jj) at a time, so the
+    # writes are sequential and no two threads touch the same cache line.
     cdef int c, ii, jj, row, yy, xx, i, col
+    cdef int K = field_height * field_width
 
-    for c in range(C):
+    for row in prange(C * K, num_threads=num_threads, schedule='static'):
+        c = row / K
+        ii = (row % K) / field_width
+        jj = row % field_width
+        col = 0
         for yy in range(HH):
             for xx in range(WW):
-                for ii in range(field_height):
-                    for jj in range(field_width):
-                        row = c * field_width * field_height + ii * field_height + jj
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
-
+                for i in range(N):
+                    cols[row, col] = x_padded[i, c, stride * yy + ii,
+                                              stride * xx + jj]
+                    col = col + 1
 
 
 def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
                   int field_height, int field_width, int padding, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
     cdef int HH = (H + 2 * padding - field_height) / stride + 1
     cdef int WW = (W + 2 * padding - field_width) / stride + 1
     cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
                                         dtype=cols.dtype)
+    cols = np.ascontiguousarray(cols)
 
-    # Moving the inner loop to a C-function with no bounds checking improves
-    # performance quite a bit for col2im.
-    col2im_cython_inner(cols, x_padded, N, C, H, W, HH, WW, 
-                        field_height, field_width, padding, stride)
+    cdef DTYPE_t[:, ::1] cols_view = cols
+    cdef DTYPE_t[:, :, :, ::1] x_view = x_padded
+    with nogil:
+        col2im_cython_inner(cols_view, x_view, N, C, HH, WW,
+                            field_height, field_width, stride)
     if padding > 0:
         return x_padded[:, :, padding:-padding, padding:-padding]
     return x_padded
 
 
 @cython.boundscheck(False)
-cdef int col2im_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
-                             int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void col2im_cython_inner(DTYPE_t[:, ::1] cols,
+                              DTYPE_t[:, :, :, ::1] x_padded,
+                              int N, int C, int HH, int WW,
+                              int field_height, int field_width,
+                              int stride) nogil:
+    # Overlapping receptive fields of one image plane are summed by a single
+    # thread, so work is split across channels and, when there are fewer
+    # channels than threads, across blocks of images; no locks are needed.
+    # Within a block the images are the innermost loop, which reads cols
+    # sequentially.
+    cdef int t, n, c, ii, jj, row, yy, xx, col, n_start, n_end
+    cdef int K = field_height * field_width
+    cdef int num_blocks = num_threads / C
+    if num_blocks < 1:
+        num_blocks = 1
+    if num_blocks > N:
+        num_blocks = N
+    cdef int block_size = (N + num_blocks - 1) / num_blocks
+
+    for t in prange(C * num_blocks, num_threads=num_threads, schedule='static'):
+        c = t / num_blocks
+        n_start = (t % num_blocks) * block_size
+        n_end = n_start + block_size
+        if n_end > N:
+            n_end = N
         for ii in range(field_height):
             for jj in range(field_width):
-                row = c * field_width * field_height + ii * field_height + jj
+                row = c * K + ii * field_width + jj
                 for yy in range(HH):
                     for xx in range(WW):
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += cols[row, col]
+                        col = (yy * WW + xx) * N
+                        for n in range(n_start, n_end):
+                            x_padded[n, c, stride * yy + ii, stride * xx + jj] += cols[row, col + n]
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef col2im_6d_cython_inner(np.ndarray[DTYPE_t, ndim=6] cols,
-                            np.ndarray[DTYPE_t, ndim=4] x_padded,
-                            int N, int C, int H, int W, int HH, int WW,
-                            int out_h, int out_w, int pad, int stride):
-
-    cdef int c, hh, ww, n, h, w
-    for n in range(N):
-        for c in range(C):
-            for hh in range(HH):
-                for ww in range(WW):
-                    for h in range(out_h):
-                        for w in range(out_w):
-                            x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
-    
+@cython.cdivision(True)
+cdef void col2im_6d_cython_inner(DTYPE_t[:, :, :, :, :, ::1] cols,
+                                 DTYPE_t[:, :, :, ::1] x_padded,
+                                 int N, int C, int HH, int WW,
+                                 int out_h, int out_w, int stride) nogil:
+
+    cdef int nc, c, hh, ww, n, h, w
+    for nc in prange(N * C, num_threads=num_threads, schedule='static'):
+        n = nc / C
+        c = nc % C
+        for hh in range(HH):
+            for ww in range(WW):
+                for h in range(out_h):
+                    for w in range(out_w):
+                        x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
+
 
 def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int W,
         int HH, int WW, int pad, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
     cdef int out_h = (H + 2 * pad - HH) / stride + 1
     cdef int out_w = (W + 2 * pad - WW) / stride + 1
     cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad),
                                                   dtype=cols.dtype)
+    cols = np.ascontiguousarray(cols)
 
-    col2im_6d_cython_inner(cols, x_padded, N, C, H, W, HH, WW, out_h, out_w, pad, stride)
+    cdef DTYPE_t[:, :, :, :, :, ::1] cols_view = cols
+    cdef DTYPE_t[:, :, :, ::1] x_view = x_padded
+    with nogil:
+        col2im_6d_cython_inner(cols_view, x_view, N, C, HH, WW, out_h, out_w,
+                               stride)
 
     if pad > 0:
         return x_padded[:, :, pad:-pad, pad:-pad]
-    return x_padded 
+    return x_padded
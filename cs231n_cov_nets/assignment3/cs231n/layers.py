@@ -218,15 +218,27 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
       default of momentum=0.9 should work well in most situations.
     - running_mean: Array of shape (D,) giving running mean of features
     - running_var Array of shape (D,) giving running variance of features
+    - layout: 'NCHW' (default) or 'NHWC'. With 'NHWC' x has shape
+      (N, H, W, C) and so does out.
     
   Returns a tuple of:
   - out: Output data, of shape (N, C, H, W)
   - cache: Values needed for the backward pass
   """
-  N, C, H, W = x.shape
-  x_flat = x.transpose(0, 2, 3, 1).reshape(-1, C)
-  out_flat, cache = batchnorm_forward(x_flat, gamma, beta, bn_param)
-  out = out_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+  layout = bn_param.get('layout', 'NCHW')
+  if layout == 'NHWC':
+    C = x.shape[3]
+    out_flat, bn_cache = batchnorm_forward(x.reshape(-1, C), gamma, beta,
+                                           bn_param)
+    out = out_flat.reshape(x.shape)
+  elif layout == 'NCHW':
+    N, C, H, W = x.shape
+    x_flat = x.transpose(0, 2, 3, 1).reshape(-1, C)
+    out_flat, bn_cache = batchnorm_forward(x_flat, gamma, beta, bn_param)
+    out = out_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+  else:
+    raise ValueError('Unrecognized layout "%s"' % layout)
+  cache = (layout, bn_cache)
   return out, cache
 
 
@@ -243,14 +255,157 @@ def spatial_batchnorm_backward(dout, cache):
   - dgamma: Gradient with respect to scale parameter, of shape (C,)
   - dbeta: Gradient with respect to shift parameter, of shape (C,)
   """
-  N, C, H, W = dout.shape
-  dout_flat = dout.transpose(0, 2, 3, 1).reshape(-1, C)
-  dx_flat, dgamma, dbeta = batchnorm_backward(dout_flat, cache)
-  dx = dx_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+  layout, bn_cache = cache
+  if layout == 'NHWC':
+    C = dout.shape[3]
+    dx_flat, dgamma, dbeta = batchnorm_backward(dout.reshape(-1, C), bn_cache)
+    dx = dx_flat.reshape(dout.shape)
+  else:
+    N, C, H, W = dout.shape
+    dout_flat = dout.transpose(0, 2, 3, 1).reshape(-1, C)
+    dx_flat, dgamma, dbeta = batchnorm_backward(dout_flat, bn_cache)
+    dx = dx_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
   return dx, dgamma, dbeta
 
 
-def svm_loss(x, y):
+def batchnorm_fold(w, b, gamma, beta, bn_param):
+  """
+  Folds a test-mode batch normalization into the affine or convolutional
+  layer that feeds it. At test time batchnorm is a fixed per-feature scale
+  and shift,
+
+  out = gamma * (x.dot(w) + b - running_mean) / sqrt(running_var + eps) + beta
+
+  so it can be applied to the weights once instead of to every activation.
+
+  Inputs:
+  - w: Weights of the preceding layer; either of shape (D, M) for an affine
+    layer or of shape (M, C, HH, WW) for a convolutional layer.
+  - b: Biases, of shape (M,)
+  - gamma, beta: Scale and shift parameters, of shape (M,)
+  - bn_param: Dictionary holding running_mean and running_var, and
+    optionally eps, as left by batchnorm_forward or
+    spatial_batchnorm_forward.
+
+  Returns a tuple of:
+  - w_folded: Weights of the same shape as w
+  - b_folded: Biases of shape (M,)
+  """
+  if 'running_mean' not in bn_param:
+    raise ValueError('bn_param has no running statistics to fold')
+  eps = bn_param.get('eps', 1e-5)
+  scale = gamma / np.sqrt(bn_param['running_var'] + eps)
+  if w.ndim == 2:
+    w_folded = w * scale
+  else:
+    w_folded = w * scale.reshape(-1, *([1] * (w.ndim - 1)))
+  b_folded = (b - bn_param['running_mean']) * scale + beta
+  return w_folded.astype(w.dtype), b_folded.astype(b.dtype)
+
+
+# Number of rows of scores the loss functions below work on at a time. Their
+# temporaries are at most LOSS_BLOCK_SIZE x C, however large the minibatch.
+LOSS_BLOCK_SIZE = 1024
+
+
+def svm_loss_block(scores, y):
+  """
+  Multiclass SVM loss of a block of scores. The scores are overwritten with
+  the gradient of the summed loss with respect to them.
+
+  Inputs:
+  - scores: Array of shape (n, C), overwritten
+  - y: Vector of labels, of shape (n,)
+
+  Returns the loss summed over the n rows.
+  """
+  rows = np.arange(scores.shape[0])
+  correct_class_scores = scores[rows, y]
+  scores -= correct_class_scores[:, np.newaxis]
+  scores += 1.0
+  np.maximum(scores, 0, out=scores)
+  scores[rows, y] = 0
+  loss = np.sum(scores)
+  # The margins are non-negative, so their sign is the indicator margin > 0
+  np.sign(scores, out=scores)
+  scores[rows, y] = -np.sum(scores, axis=1)
+  return loss
+
+
+def softmax_loss_block(scores, y):
+  """
+  Softmax loss of a block of scores. The scores are overwritten with the
+  gradient of the summed loss with respect to them, the class
+  probabilities minus the one-hot labels.
+
+  Inputs:
+  - scores: Array of shape (n, C), overwritten
+  - y: Vector of labels, of shape (n,)
+
+  Returns the loss summed over the n rows.
+  """
+  rows = np.arange(scores.shape[0])
+  scores -= np.max(scores, axis=1, keepdims=True)
+  correct_class_scores = scores[rows, y]
+  np.exp(scores, out=scores)
+  sums = np.sum(scores, axis=1)
+  # -log(p_y) = log(sum_j exp(s_j)) - s_y, which stays finite when p_y
+  # underflows to zero
+  loss = np.sum(np.log(sums) - correct_class_scores)
+  scores /= sums[:, np.newaxis]
+  scores[rows, y] -= 1
+  return loss
+
+
+def blocked_loss(loss_block, x, y, block_size):
+  """
+  Run loss_block over x in blocks of rows, building the gradient in place
+  in dx. Returns the mean loss and dx.
+  """
+  N = x.shape[0]
+  dx = np.empty_like(x)
+  loss = 0.0
+  for i in xrange(0, N, block_size):
+    block = dx[i:i + block_size]
+    block[...] = x[i:i + block_size]
+    loss += loss_block(block, y[i:i + block_size])
+  dx /= N
+  return loss / N, dx
+
+
+def blocked_affine_loss(loss_block, x, w, b, y, block_size, out=None):
+  """
+  Run an affine layer and loss_block over x in blocks of rows. The scores
+  of one block are computed, turned into their gradient and backpropagated
+  through the affine layer before the next block is scored, so the full
+  (N, M) score matrix is never built. If out is given, the gradients are
+  written into its arrays (dx, dw, db).
+  """
+  N = x.shape[0]
+  x2 = x.reshape(N, -1)
+  if out is None:
+    dx = np.empty(x2.shape, dtype=np.result_type(x, w))
+    dw = np.zeros_like(w)
+    db = np.zeros_like(b)
+  else:
+    dx, dw, db = out
+    dx = dx.reshape(x2.shape)
+    dw.fill(0)
+    db.fill(0)
+  loss = 0.0
+  for i in xrange(0, N, block_size):
+    x_block = x2[i:i + block_size]
+    dscores = x_block.dot(w)
+    dscores += b
+    loss += loss_block(dscores, y[i:i + block_size])
+    dscores /= N
+    dw += x_block.T.dot(dscores)
+    db += np.sum(dscores, axis=0)
+    np.dot(dscores, w.T, out=dx[i:i + block_size])
+  return loss / N, dx.reshape(x.shape), dw, db
+
+
+def svm_loss(x, y, block_size=None):
   """
   Computes the loss and gradient using for multiclass SVM classification.
 
@@ -259,25 +414,17 @@ def svm_loss(x, y):
     for the ith input.
   - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
     0 <= y[i] < C
+  - block_size: Number of rows worked on at a time; defaults to
+    LOSS_BLOCK_SIZE
 
   Returns a tuple of:
   - loss: Scalar giving the loss
   - dx: Gradient of the loss with respect to x
   """
-  N = x.shape[0]
-  correct_class_scores = x[np.arange(N), y]
-  margins = np.maximum(0, x - correct_class_scores[:, np.newaxis] + 1.0)
-  margins[np.arange(N), y] = 0
-  loss = np.sum(margins) / N
-  num_pos = np.sum(margins > 0, axis=1)
-  dx = np.zeros_like(x)
-  dx[margins > 0] = 1
-  dx[np.arange(N), y] -= num_pos
-  dx /= N
-  return loss, dx
+  return blocked_loss(svm_loss_block, x, y, block_size or LOSS_BLOCK_SIZE)
 
 
-def softmax_loss(x, y):
+def softmax_loss(x, y, block_size=None):
   """
   Computes the loss and gradient for softmax classification.
 
@@ -286,17 +433,58 @@ def softmax_loss(x, y):
     for the ith input.
   - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
     0 <= y[i] < C
+  - block_size: Number of rows worked on at a time; defaults to
+    LOSS_BLOCK_SIZE
 
   Returns a tuple of:
   - loss: Scalar giving the loss
   - dx: Gradient of the loss with respect to x
   """
-  probs = np.exp(x - np.max(x, axis=1, keepdims=True))
-  probs /= np.sum(probs, axis=1, keepdims=True)
-  N = x.shape[0]
-  loss = -np.sum(np.log(probs[np.arange(N), y])) / N
-  dx = probs.copy()
-  dx[np.arange(N), y] -= 1
-  dx /= N
-  return loss, dx
+  return blocked_loss(softmax_loss_block, x, y, block_size or LOSS_BLOCK_SIZE)
+
+
+def affine_svm_loss(x, w, b, y, block_size=None, out=None):
+  """
+  Computes the multiclass SVM loss of the scores of an affine layer, and the
+  gradients with respect to the layer input and parameters, without holding
+  more than block_size rows of scores at a time.
+
+  Inputs:
+  - x: Input to the affine layer, of shape (N, d_1, ..., d_k)
+  - w, b: Weights of shape (D, C) and biases of shape (C,)
+  - y: Vector of labels, of shape (N,)
+  - block_size: Number of rows worked on at a time; defaults to
+    LOSS_BLOCK_SIZE
+  - out: If not None, a tuple of arrays (dx, dw, db) of the shapes and dtype
+    of the gradients, which are written into them
+
+  Returns a tuple of:
+  - loss: Scalar giving the loss
+  - dx, dw, db: Gradients with respect to x, w and b
+  """
+  return blocked_affine_loss(svm_loss_block, x, w, b, y,
+                             block_size or LOSS_BLOCK_SIZE, out)
+
+
+def affine_softmax_loss(x, w, b, y, block_size=None, out=None):
+  """
+  Computes the softmax loss of the scores of an affine layer, and the
+  gradients with respect to the layer input and parameters, without holding
+  more than block_size rows of scores or probabilities at a time.
+
+  Inputs:
+  - x: Input to the affine layer, of shape (N, d_1, ..., d_k)
+  - w, b: Weights of shape (D, C) and biases of shape (C,)
+  - y: Vector of labels, of shape (N,)
+  - block_size: Number of rows worked on at a time; defaults to
+    LOSS_BLOCK_SIZE
+  - out: If not None, a tuple of arrays (dx, dw, db) of the shapes and dtype
+    of the gradients, which are written into them
+
+  Returns a tuple of:
+  - loss: Scalar giving the loss
+  - dx, dw, db: Gradients with respect to x, w and b
+  """
+  return blocked_affine_loss(softmax_loss_block, x, w, b, y,
+                             block_size or LOSS_BLOCK_SIZE, out)
 
@@ -0,0 +1,156 @@
+"""
+Helpers for mixed-precision training. The model parameters stay in float32;
+they are the master weights the optimizer updates. The activations passed
+between layers, the layer caches kept for the backward pass and the
+gradients passed back between layers are stored in float16, which halves
+the memory they take and the bandwidth spent reading them back. Every layer
+still computes in float32: its float16 inputs are converted just before it
+runs, so GEMMs and reductions accumulate in float32, and its outputs are
+converted back to float16 afterwards.
+
+Gradients that are too small for float16 flush to zero, so the model scales
+the loss by model.loss_scale before the backward pass and divides the
+parameter gradients by it afterwards. LossScaler picks the scale
+dynamically.
+"""
+
+import numpy as np
+
+
+def to_half(obj, keep=(), memo=None):
+  """
+  Convert the float arrays with at least two dimensions in obj, which may be
+  an array or a nested tuple / list of them, to float16. Vectors such as
+  biases and batchnorm statistics are small and are left alone, as are the
+  arrays in keep (the parameters) and everything that is not a float array.
+
+  An array that appears more than once is converted once, and a reshaped
+  view of an array that has already been converted becomes a view of the
+  converted array, so the result shares memory the way obj did.
+  """
+  if memo is None:
+    memo = dict((id(a), a) for a in keep if isinstance(a, np.ndarray))
+  if isinstance(obj, tuple):
+    return tuple(to_half(o, keep, memo) for o in obj)
+  if isinstance(obj, list):
+    return [to_half(o, keep, memo) for o in obj]
+  if not isinstance(obj, np.ndarray) or obj.dtype.kind != 'f' or obj.ndim < 2:
+    return obj
+  return convert(obj, np.float16, memo)
+
+
+def to_float(obj, memo=None):
+  """
+  Convert the float16 arrays in obj, which may be an array or a nested
+  tuple / list of them, back to float32.
+  """
+  if memo is None:
+    memo = {}
+  if isinstance(obj, tuple):
+    return tuple(to_float(o, memo) for o in obj)
+  if isinstance(obj, list):
+    return [to_float(o, memo) for o in obj]
+  if not isinstance(obj, np.ndarray) or obj.dtype != np.float16:
+    return obj
+  return convert(obj, np.float32, memo)
+
+
+def convert(a, dtype, memo):
+  key = id(a)
+  if key not in memo:
+    base = a.base
+    if (base is not None and id(base) in memo and a.size == base.size and
+        a.flags.c_contiguous and base.flags.c_contiguous):
+      memo[key] = memo[id(base)].reshape(a.shape)
+    else:
+      memo[key] = a.astype(dtype)
+  return memo[key]
+
+
+def half_forward(layer_forward, *args):
+  """
+  Run layer_forward(*args) in mixed precision. float16 arguments are
+  converted to float32 first; the output and the cache are returned in
+  float16, except for the arguments that were passed in at full precision
+  (the parameters), which the cache keeps as they are. Where the cache holds
+  the float32 conversion of a float16 argument (or a reshaped view of it),
+  it gets the float16 argument back instead of a second float16 copy.
+  """
+  inputs = to_float(args)
+  out, cache = layer_forward(*inputs)
+  memo = dict((id(x), a) for a, x in zip(args, inputs)
+              if isinstance(a, np.ndarray))
+  return to_half((out, cache), memo=memo)
+
+
+def half_backward(layer_backward, dout, cache):
+  """
+  Run layer_backward(dout, cache) in float32 on a float16 upstream gradient
+  and cache from half_forward. The gradient with respect to the layer input
+  is returned in float16 and the parameter gradients in float32. A scaled
+  gradient that overflowed float16 turns into infs and nans here without
+  warnings; LossScaler catches them.
+  """
+  with np.errstate(over='ignore', invalid='ignore'):
+    grads = layer_backward(to_float(dout), to_float(cache))
+  if not isinstance(grads, tuple):
+    return grads
+  return (to_half(grads[0]),) + grads[1:]
+
+
+def full_forward(layer_forward, *args):
+  return layer_forward(*args)
+
+
+def full_backward(layer_backward, dout, cache):
+  return layer_backward(dout, cache)
+
+
+def layer_runners(mixed_precision):
+  """
+  Return the (forward, backward) pair a model uses to run its layers:
+  half_forward and half_backward in mixed precision, and plain calls
+  otherwise.
+  """
+  if mixed_precision:
+    return half_forward, half_backward
+  return full_forward, full_backward
+
+
+class LossScaler(object):
+  """
+  Dynamic loss scaling. The scale starts high; whenever a step produces
+  non-finite gradients (the scaled float16 gradients overflowed) the step
+  is skipped and the scale is cut by backoff_factor, and after
+  growth_interval good steps in a row it is raised by growth_factor again.
+  This keeps the scale close to the largest value that does not overflow,
+  which keeps small gradients from underflowing.
+  """
+
+  def __init__(self, init_scale=2.0 ** 15, growth_factor=2.0,
+               backoff_factor=0.5, growth_interval=1000):
+    self.scale = init_scale
+    self.growth_factor = growth_factor
+    self.backoff_factor = backoff_factor
+    self.growth_interval = growth_interval
+    self.good_steps = 0
+    self.skipped_steps = 0
+
+
+  def update(self, grads):
+    """
+    Update the scale after a step that produced the (unscaled) gradients in
+    the dictionary grads. Returns True if the gradients are finite and the
+    step should be applied, False if it should be skipped.
+    """
+    finite = all(np.all(np.isfinite(g)) for g in grads.itervalues())
+    if finite:
+      self.good_steps += 1
+      if self.good_steps == self.growth_interval:
+        self.scale *= self.growth_factor
+        self.good_steps = 0
+    else:
+      self.scale *= self.backoff_factor
+      self.good_steps = 0
+      self.skipped_steps += 1
+    return finite
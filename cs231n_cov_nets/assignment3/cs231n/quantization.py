@@ -0,0 +1,189 @@
+"""
+Int8 kernels for post-training quantized inference. Weights are quantized
+symmetrically per output channel to int8, activations per tensor to uint8
+(the outputs of a ReLU, which are never negative) or int8, in both cases
+with a zero point of 0 so that zero padding stays zero. A conv or affine
+layer multiplies the quantized integers and sums the products in an int32
+accumulator; one multiply per output channel then takes the accumulator
+back to real units, adds the bias, applies the ReLU and quantizes the result
+for the next layer in the same pass.
+
+numpy has no integer GEMM that uses BLAS, so int_matmul feeds the integers
+to the float32 GEMM in blocks small enough that every partial sum is exact
+and adds the blocks up in int32.
+"""
+
+import numpy as np
+
+
+# |int8 * uint8| <= 127 * 255, so a dot product over up to this many terms
+# stays below 2 ** 24 and is computed exactly by float32 arithmetic.
+GEMM_BLOCK = 512
+
+
+def quantize_weights(w, axis=0):
+  """
+  Quantize weights symmetrically to int8 with one scale per output channel.
+
+  Inputs:
+  - w: Float weights; conv weights of shape (F, C, HH, WW) or affine weights
+    of shape (D, M).
+  - axis: Axis of w that indexes the output channels; 0 for conv weights and
+    1 for affine weights.
+
+  Returns a tuple of:
+  - w_q: int8 array of the same shape as w, in [-127, 127]
+  - scale: float32 array of per-channel scales with w ~= w_q * scale
+  """
+  axes = tuple(a for a in xrange(w.ndim) if a != axis)
+  w_max = np.abs(w).max(axis=axes).astype(np.float32)
+  scale = w_max / 127
+  scale[scale == 0] = 1
+  shape = [1] * w.ndim
+  shape[axis] = -1
+  w_q = np.clip(np.rint(w / scale.reshape(shape)), -127, 127).astype(np.int8)
+  return w_q, scale
+
+
+def activation_scale(lo, hi):
+  """
+  Choose the quantization of an activation from the range [lo, hi] it took
+  over the calibration set: uint8 if it is never negative and int8
+  otherwise.
+
+  Returns a tuple of:
+  - scale: float32 scale with x ~= x_q * scale
+  - dtype: np.uint8 or np.int8
+  """
+  if lo >= 0:
+    scale, dtype = hi / 255.0, np.uint8
+  else:
+    scale, dtype = max(-lo, hi) / 127.0, np.int8
+  if scale == 0: scale = 1
+  return np.float32(scale), dtype
+
+
+def quantize(x, scale, dtype):
+  """
+  Quantize the float array x to dtype (np.uint8 or np.int8) with the given
+  scale, rounding to nearest and saturating; int8 uses [-127, 127].
+  """
+  lo = 0 if dtype == np.uint8 else -127
+  hi = np.iinfo(dtype).max
+  q = x / scale
+  np.rint(q, out=q)
+  np.clip(q, lo, hi, out=q)
+  return q.astype(dtype)
+
+
+def int_matmul(a, b):
+  """
+  Exact integer matrix product of a, of shape (M, K), and b, of shape (K, N),
+  whose entries are int8 / uint8 values, accumulated in int32.
+  """
+  M, K = a.shape
+  acc = None
+  for k in xrange(0, K, GEMM_BLOCK):
+    a_k = a[:, k:k + GEMM_BLOCK].astype(np.float32)
+    b_k = b[k:k + GEMM_BLOCK].astype(np.float32)
+    part = np.dot(a_k, b_k)
+    if acc is None:
+      acc = part.astype(np.int32)
+    else:
+      acc += part.astype(np.int32)
+  return acc
+
+
+def requantize(acc, scale, b, out_scale=None, relu=True):
+  """
+  Convert an int32 accumulator to the output of a layer.
+
+  Inputs:
+  - acc: int32 accumulator
+  - scale: float32 per-channel value of one unit of acc (the input scale
+    times the weight scales), shaped to broadcast against acc
+  - b: float32 per-channel bias, shaped like scale
+  - out_scale: If None the output is returned as float32. Otherwise it is
+    quantized with this scale: to uint8 if relu is True and to int8 if not.
+  - relu: Whether to apply a ReLU
+
+  Returns the output, of the same shape as acc.
+  """
+  out = acc.astype(np.float32)
+  if out_scale is None:
+    out *= scale
+    out += b
+    if relu:
+      np.maximum(out, 0, out=out)
+    return out
+  # Dividing through by out_scale up front makes the requantization a single
+  # multiply-add; the ReLU is the lower end of the uint8 clip.
+  out *= scale / out_scale
+  out += b / out_scale
+  np.rint(out, out=out)
+  if relu:
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
+  np.clip(out, -127, 127, out=out)
+  return out.astype(np.int8)
+
+
+def conv_forward_int8(x_q, w_q, scale, b, conv_param, out_scale=None,
+                      relu=True):
+  """
+  Quantized convolution, optionally followed by a ReLU.
+
+  Inputs:
+  - x_q: Quantized input of shape (N, C, H, W), uint8 or int8
+  - w_q: int8 weights of shape (F, C, HH, WW)
+  - scale: float32 array of shape (F,); the input scale times the weight
+    scales
+  - b: float32 biases of shape (F,)
+  - conv_param: Dictionary with the keys 'stride' and 'pad'
+  - out_scale, relu: See requantize
+
+  Returns the output, of shape (N, F, H', W').
+  """
+  N, C, H, W = x_q.shape
+  F, _, HH, WW = w_q.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  # im2col by picking strides, as in conv_forward_strides, but on the 8-bit
+  # input; the zero point is 0 so padding with zeros is exact.
+  x_padded = np.pad(x_q, ((0, 0), (0, 0), (pad, pad), (pad, pad)),
+                    mode='constant')
+  H += 2 * pad
+  W += 2 * pad
+  out_h = (H - HH) / stride + 1
+  out_w = (W - WW) / stride + 1
+  shape = (C, HH, WW, N, out_h, out_w)
+  strides = (H * W, W, 1, C * H * W, stride * W, stride)
+  strides = x_padded.itemsize * np.array(strides)
+  x_stride = np.lib.stride_tricks.as_strided(x_padded,
+                shape=shape, strides=strides)
+  x_cols = np.ascontiguousarray(x_stride)
+  x_cols.shape = (C * HH * WW, N * out_h * out_w)
+
+  acc = int_matmul(w_q.reshape(F, -1), x_cols)
+  res = requantize(acc, scale.reshape(-1, 1), b.reshape(-1, 1),
+                   out_scale, relu)
+  out = res.reshape(F, N, out_h, out_w).transpose(1, 0, 2, 3)
+  return np.ascontiguousarray(out)
+
+
+def affine_forward_int8(x_q, w_q, scale, b, out_scale=None, relu=True):
+  """
+  Quantized affine layer, optionally followed by a ReLU.
+
+  Inputs:
+  - x_q: Quantized input of shape (N, d_1, ..., d_k), uint8 or int8
+  - w_q: int8 weights of shape (D, M), where D = d_1 * ... * d_k
+  - scale: float32 array of shape (M,); the input scale times the weight
+    scales
+  - b: float32 biases of shape (M,)
+  - out_scale, relu: See requantize
+
+  Returns the output, of shape (N, M).
+  """
+  acc = int_matmul(x_q.reshape(x_q.shape[0], -1), w_q)
+  return requantize(acc, scale, b, out_scale, relu)
@@ -1,11 +1,21 @@
+import sys
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 
+# The im2col kernels are parallelized with OpenMP. Apple's clang does not
+# ship it, so on macOS they are built single-threaded.
+if sys.platform == 'darwin':
+  openmp_args = []
+else:
+  openmp_args = ['-fopenmp']
+
 extensions = [
   Extension('im2col_cython', ['im2col_cython.pyx'],
-            include_dirs = [numpy.get_include()]
+            include_dirs = [numpy.get_include()],
+            extra_compile_args = openmp_args,
+            extra_link_args = openmp_args,
   ),
 ]
 
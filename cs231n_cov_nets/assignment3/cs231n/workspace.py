@@ -0,0 +1,138 @@
+import numpy as np
+from collections import OrderedDict
+
+
+class Workspace(object):
+  """
+  A pool of scratch arrays that the fast layers draw their large temporaries
+  from (padded inputs, im2col matrices, GEMM outputs) instead of allocating
+  new ones on every call. In a training loop the same shapes come back on
+  every iteration, so after the first iteration almost every request is
+  served from the pool.
+
+  Arrays are keyed by shape and dtype. get() hands out a free array of the
+  requested shape if there is one (a hit) and allocates a new one otherwise
+  (a miss); put() gives arrays back once they are dead. The total size of
+  the free arrays is capped at max_bytes; when the cap is exceeded the least
+  recently used shapes are evicted first.
+
+  An array given back with put() may be handed out again by the next get(),
+  so callers must not keep any reference to it.
+  """
+
+  def __init__(self, max_bytes=512 * 1024 * 1024):
+    """
+    Inputs:
+    - max_bytes: Maximum total size of the free arrays held by the pool.
+      Setting this to 0 disables pooling.
+    """
+    self.max_bytes = max_bytes
+    self.free = OrderedDict()
+    self.free_ids = set()
+    self.bytes = 0
+    self.reset_stats()
+
+
+  def reset_stats(self):
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+
+  def stats(self):
+    """
+    Return a dictionary with the hit, miss and eviction counters, the hit
+    rate and the number of bytes currently held.
+    """
+    requests = self.hits + self.misses
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'hit_rate': float(self.hits) / requests if requests > 0 else 0.0,
+      'bytes': self.bytes,
+    }
+
+
+  def get(self, shape, dtype):
+    """
+    Return an uninitialized C-contiguous array of the given shape and dtype.
+    """
+    key = (tuple(shape), np.dtype(dtype).str)
+    arrays = self.free.get(key)
+    if arrays:
+      self.hits += 1
+      a = arrays.pop()
+      if not arrays:
+        del self.free[key]
+      self.free_ids.discard(id(a))
+      self.bytes -= a.nbytes
+      return a
+    self.misses += 1
+    return np.empty(shape, dtype=dtype)
+
+
+  def zeros(self, shape, dtype):
+    """
+    Return a zero-filled array of the given shape and dtype.
+    """
+    a = self.get(shape, dtype)
+    a.fill(0)
+    return a
+
+
+  def put(self, *arrays):
+    """
+    Give arrays back to the pool. Views and non-contiguous arrays are
+    ignored, since their memory belongs to some other array.
+    """
+    for a in arrays:
+      if a is None or a.base is not None or not a.flags.c_contiguous:
+        continue
+      if id(a) in self.free_ids or a.nbytes > self.max_bytes:
+        continue
+      key = (a.shape, a.dtype.str)
+      free = self.free.pop(key, [])
+      free.append(a)
+      self.free[key] = free
+      self.free_ids.add(id(a))
+      self.bytes += a.nbytes
+
+    while self.bytes > self.max_bytes:
+      _, free = self.free.popitem(last=False)
+      for a in free:
+        self.free_ids.discard(id(a))
+        self.bytes -= a.nbytes
+        self.evictions += 1
+
+
+  def clear(self):
+    """
+    Drop all free arrays.
+    """
+    self.free.clear()
+    self.free_ids.clear()
+    self.bytes = 0
+
+
+  def pad(self, x, pad):
+    """
+    Zero-pad the last two axes of x by pad on each side into a pooled array;
+    only the border is cleared, the interior is copied from x.
+    """
+    N, C, H, W = x.shape
+    p = pad
+    x_padded = self.get((N, C, H + 2 * p, W + 2 * p), x.dtype)
+    if p > 0:
+      x_padded[:, :, :p, :] = 0
+      x_padded[:, :, -p:, :] = 0
+      x_padded[:, :, p:-p, :p] = 0
+      x_padded[:, :, p:-p, -p:] = 0
+      x_padded[:, :, p:-p, p:-p] = x
+    else:
+      x_padded[...] = x
+    return x_padded
+
+
+# The workspace used by fast_layers.py
+workspace = Workspace()